@@ -0,0 +1,376 @@
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+from minerule.analyze import HostStatisticsRefreshRunner, RouteRuleAnalyzer
+from minerule.hoststatistics import HostStatisticRepository
+from minerule.utiltypes import TimeWindow
+
+from .fakes import (
+    CallCounter,
+    FakeShellAgent,
+    InMemorySocketEventRepository,
+    InMemoryTable,
+)
+from .workloads import SyntheticTopology
+
+
+def measure(name: str, fn: Callable, counters: dict, **labels) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    wall_time = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "benchmark": name,
+        **labels,
+        "wall_time_s": round(wall_time, 6),
+        "peak_memory_bytes": peak_memory,
+        "calls": {k: dict(v.calls) for k, v in counters.items()},
+    }
+
+
+class Workload:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.topology = SyntheticTopology(args.hosts, seed=args.seed)
+        self.window = TimeWindow.past_days(1)
+        self.events = self.topology.socket_events(
+            self.window.from_time + 1, 86400 - 60, args.sessions or args.hosts
+        )
+        self.sample = self.topology.rnd.sample(
+            self.topology.hosts, min(args.sample, args.hosts)
+        )
+
+    def labels(self) -> dict:
+        return {"hosts": self.args.hosts, "events": len(self.events)}
+
+    def vms(self, latency: float) -> dict[str, FakeShellAgent]:
+        return {
+            c: FakeShellAgent(c, self.topology, latency)
+            for c in SyntheticTopology.CONTINENTS
+        }
+
+    def analyzer(self) -> tuple[RouteRuleAnalyzer, dict]:
+        latency = self.args.latency
+        socket_events = CallCounter(InMemorySocketEventRepository(self.events), latency)
+        table = CallCounter(InMemoryTable(), latency)
+        vms = {k: CallCounter(v) for k, v in self.vms(latency).items()}
+        repository = HostStatisticRepository(table)
+        runner = HostStatisticsRefreshRunner(
+            repository,
+            vms.pop("central"),
+            vms.pop("domestic"),
+            **vms,
+        )
+        counters = {
+            "socketevents": socket_events,
+            "hoststatistics": table,
+            "central_vm": runner.central_vm,
+            "domestic_vm": runner.domestic_vm,
+        }
+        for continent in runner.other_vms:
+            counters[f"{continent}_vm"] = runner.other_vms[continent]
+        return RouteRuleAnalyzer(socket_events, repository, runner), counters
+
+
+def bench_socketevents_memory(w: Workload) -> dict:
+    repo = CallCounter(InMemorySocketEventRepository(w.events), w.args.latency)
+
+    def run():
+        repo.aggregate_on_hosts(w.window)
+        for host in w.sample:
+            repo.find_correlated_hosts(host)
+
+    return measure("socketevents.memory", run, {"socketevents": repo}, **w.labels())
+
+
+def bench_socketevents_duckdb(w: Workload) -> dict:
+    from minerule.localevents import DuckDBSocketEventRepository
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "socketevents.csv")
+        InMemorySocketEventRepository(w.events).to_csv(path)
+        repo = CallCounter(DuckDBSocketEventRepository.create_instance(path))
+
+        def run():
+            repo.aggregate_on_hosts(w.window)
+            for host in w.sample:
+                repo.find_correlated_hosts(host)
+
+        return measure("socketevents.duckdb", run, {"socketevents": repo}, **w.labels())
+
+
+def bench_hoststatistics(w: Workload) -> dict:
+    analyzer, counters = w.analyzer()
+    analyzer.refresh_runner.refresh_all(w.topology.hosts, 1)
+    counters = {"hoststatistics": counters["hoststatistics"]}
+    counters["hoststatistics"].calls.clear()
+    repo = analyzer.host_statistic_repository
+
+    def run():
+        for host in w.sample:
+            repo.exists(host)
+            repo.find(host)
+            ip = w.topology.resolve(host)
+            repo.ip_exists(ip)
+            repo.find_by_ip(ip)
+
+    return measure("hoststatistics", run, counters, **w.labels())
+
+
+def bench_refresh(w: Workload) -> dict:
+    analyzer, counters = w.analyzer()
+    return measure(
+        "refresh",
+        lambda: analyzer.refresh_runner.refresh_all(
+            w.topology.hosts, w.args.ping_count
+        ),
+        counters,
+        **w.labels(),
+    )
+
+
+def bench_refresh_scheduled(w: Workload) -> dict:
+    from minerule.probescheduler import ProbeScheduler
+
+    analyzer, counters = w.analyzer()
+    scheduler = ProbeScheduler(vm_rate=w.args.vm_rate or None)
+    analyzer.refresh_runner.scheduler = scheduler
+    result = measure(
+        "refresh.scheduled",
+        lambda: analyzer.refresh_runner.refresh_all(
+            w.topology.hosts, w.args.ping_count
+        ),
+        counters,
+        **w.labels(),
+    )
+    result["scheduler"] = scheduler.stats()
+    return result
+
+
+def bench_calculate_rules(w: Workload) -> dict:
+    analyzer, counters = w.analyzer()
+    return measure(
+        "calculate_rules",
+        lambda: analyzer.calculate_rules(1, w.args.ping_count),
+        counters,
+        **w.labels(),
+    )
+
+
+def bench_parallel_rules(w: Workload) -> dict:
+    from minerule.parallel import ParallelRuleCalculator
+
+    analyzer, counters = w.analyzer()
+    analyzer.refresh_runner.refresh_all(w.topology.hosts, w.args.ping_count)
+    statistics = {
+        h: analyzer.host_statistic_repository.find(h) for h in w.topology.hosts
+    }
+    correlated = analyzer.socket_event_repository.find_correlated_hosts_many(
+        w.topology.hosts
+    )
+    processes = [1]
+    while processes[-1] * 2 <= (w.args.processes or os.cpu_count()):
+        processes.append(processes[-1] * 2)
+    scaling = []
+    for p in processes:
+        calculator = ParallelRuleCalculator(analyzer, p)
+        start = time.perf_counter()
+        calculator.calculate_rules_from(statistics, correlated)
+        wall_time = time.perf_counter() - start
+        baseline = scaling[0]["wall_time_s"] if scaling else wall_time
+        scaling.append(
+            {
+                "processes": p,
+                "wall_time_s": round(wall_time, 6),
+                "speedup": round(baseline / wall_time, 3),
+            }
+        )
+    return {"benchmark": "parallel_rules", **w.labels(), "scaling": scaling}
+
+
+def bench_rulematcher(w: Workload) -> dict:
+    from minerule.rulematcher import RouteMatcher
+
+    rules = {}
+    for host in w.topology.hosts:
+        continent = w.topology.continent_of(host)
+        if continent != "central":
+            rules.setdefault(continent, []).append(host)
+    start = time.perf_counter()
+    matcher = RouteMatcher.from_rules(rules)
+    build_time = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rules.bin")
+        matcher.save(path)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        loaded = RouteMatcher.load(path)
+        load_time = time.perf_counter() - start
+        queries = [
+            f"q{i}.{w.topology.rnd.choice(w.topology.hosts)}"
+            for i in range(min(w.args.lookups, 10000))
+        ]
+        lookup = loaded.lookup
+        start = time.perf_counter()
+        for i in range(w.args.lookups):
+            lookup(queries[i % len(queries)])
+        lookup_time = time.perf_counter() - start
+        loaded.close()
+    return {
+        "benchmark": "rulematcher",
+        **w.labels(),
+        "lookups": w.args.lookups,
+        "build_time_s": round(build_time, 6),
+        "load_time_s": round(load_time, 6),
+        "file_size_bytes": size,
+        "lookup_ns": round(lookup_time / max(1, w.args.lookups) * 1e9, 1),
+        "lookups_per_s": round(w.args.lookups / lookup_time) if lookup_time else 0,
+    }
+
+
+def bench_cooccurrence(w: Workload) -> dict:
+    from minerule.cooccurrence import SketchedSocketEventRepository, recall_precision
+
+    repo = InMemorySocketEventRepository(w.events)
+    start = time.perf_counter()
+    exact = repo.find_correlated_hosts_many(w.topology.hosts)
+    exact_time = time.perf_counter() - start
+    tradeoff = []
+    for bands in (8, 16, 32, 64):
+        sketch = SketchedSocketEventRepository(repo, w.window, bands=bands)
+        start = time.perf_counter()
+        approximate = sketch.find_correlated_hosts_many(w.topology.hosts)
+        wall_time = time.perf_counter() - start
+        recall, precision = recall_precision(approximate, exact)
+        tradeoff.append(
+            {
+                "bands": bands,
+                "wall_time_s": round(wall_time, 6),
+                "candidates": sum(
+                    len(sketch.index().candidates(h)) for h in w.topology.hosts
+                ),
+                "recall": round(recall, 4),
+                "precision": round(precision, 4),
+            }
+        )
+    return {
+        "benchmark": "cooccurrence",
+        **w.labels(),
+        "exact_wall_time_s": round(exact_time, 6),
+        "tradeoff": tradeoff,
+    }
+
+
+def _import_time(module: str) -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    return float(subprocess.check_output([sys.executable, "-c", code], text=True))
+
+
+def bench_coldstart(w: Workload) -> dict:
+    import main
+
+    def factory(build):
+        def create(*args):
+            if w.args.latency:
+                time.sleep(w.args.latency)
+            return build(*args)
+
+        return create
+
+    socket_events = CallCounter(InMemorySocketEventRepository(w.events))
+    table = CallCounter(InMemoryTable())
+    main._new_socket_event_repository = factory(lambda *args: socket_events)
+    main._new_host_statistic_repository = factory(
+        lambda *args: HostStatisticRepository(table)
+    )
+    main._new_shell_agent = factory(
+        lambda host, user: FakeShellAgent(host, w.topology, w.args.latency)
+    )
+    vms = {c: {"host": c, "user": "root"} for c in SyntheticTopology.CONTINENTS}
+    event = {
+        "data": base64.b64encode(
+            json.dumps(
+                {
+                    "HostsQuery": {"dataset_id": "bench", "days_delta": 1},
+                    "Proxies": {
+                        "central_vm": vms.pop("central"),
+                        "domestic_vm": vms.pop("domestic"),
+                        "other_vms": vms,
+                    },
+                    "ping_count": w.args.ping_count,
+                }
+            ).encode("utf-8")
+        )
+    }
+    main._instances.clear()
+    result = measure(
+        "coldstart",
+        lambda: main.handle_event(event, None),
+        {"socketevents": socket_events, "hoststatistics": table},
+        **w.labels(),
+    )
+    start = time.perf_counter()
+    main.handle_event(event, None)
+    result["warm_wall_time_s"] = round(time.perf_counter() - start, 6)
+    result["import_main_s"] = round(_import_time("main"), 6)
+    result["import_analyze_s"] = round(_import_time("minerule.analyze"), 6)
+    return result
+
+
+BENCHMARKS = {
+    "socketevents.memory": bench_socketevents_memory,
+    "socketevents.duckdb": bench_socketevents_duckdb,
+    "hoststatistics": bench_hoststatistics,
+    "refresh": bench_refresh,
+    "refresh.scheduled": bench_refresh_scheduled,
+    "calculate_rules": bench_calculate_rules,
+    "coldstart": bench_coldstart,
+    "parallel_rules": bench_parallel_rules,
+    "rulematcher": bench_rulematcher,
+    "cooccurrence": bench_cooccurrence,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--sessions", type=int, default=0)
+    parser.add_argument("--sample", type=int, default=100)
+    parser.add_argument("--ping-count", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=0)
+    parser.add_argument("--lookups", type=int, default=1000000)
+    parser.add_argument("--vm-rate", type=float, default=0.0)
+    parser.add_argument("--output", type=argparse.FileType("a"), default=sys.stdout)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    unknown = set(args.benchmarks) - BENCHMARKS.keys()
+    if unknown:
+        raise SystemExit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    workload = Workload(args)
+    for name in args.benchmarks or BENCHMARKS:
+        result = BENCHMARKS[name](workload)
+        args.output.write(json.dumps(result) + "\n")
+        args.output.flush()
+
+
+if __name__ == "__main__":
+    main()
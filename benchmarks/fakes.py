@@ -0,0 +1,249 @@
+import bisect
+import collections
+import copy
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Iterable
+
+from minerule.shellagent import (
+    PingResult,
+    RemoteCommandError,
+    TcpConnectResult,
+)
+from minerule.utiltypes import HostUsage, TimeWindow, host_slots
+
+
+class CallCounter:
+    def __init__(self, target, latency: float = 0.0) -> None:
+        self._target = target
+        self._latency = latency
+        self.calls = collections.Counter()
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class InMemoryTable:
+    def __init__(
+        self, hash_key: str = "host", range_key: str = None, page_size: int = None
+    ) -> None:
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.page_size = page_size
+        self.items = {}
+
+    def _key(self, item: dict):
+        if self.range_key is None:
+            return item[self.hash_key]
+        return (item[self.hash_key], item[self.range_key])
+
+    def _key_dict(self, item: dict) -> dict:
+        keys = [self.hash_key] + ([self.range_key] if self.range_key else [])
+        return {k: item[k] for k in keys}
+
+    @staticmethod
+    def _matches(item: dict, condition) -> bool:
+        if condition is None:
+            return True
+        expression = condition.get_expression()
+        if expression["operator"] in ("AND", "OR"):
+            matches = [InMemoryTable._matches(item, c) for c in expression["values"]]
+            return all(matches) if expression["operator"] == "AND" else any(matches)
+        if expression["operator"] == "attribute_not_exists":
+            return expression["values"][0].name not in item
+        attr, value = expression["values"]
+        if expression["operator"] == "begins_with":
+            return str(item.get(attr.name, "")).startswith(value)
+        if expression["operator"] == "=":
+            return item.get(attr.name) == value
+        if expression["operator"] == "contains":
+            return value in item.get(attr.name, ())
+        raise NotImplementedError(expression["operator"])
+
+    def _page(
+        self,
+        select: str,
+        keys: list,
+        condition,
+        start_key: dict = None,
+        limit: int = None,
+    ) -> dict:
+        start = 0
+        if start_key is not None:
+            start = keys.index(self._key(start_key)) + 1
+        limit = limit or self.page_size or len(keys)
+        page = [self.items[k] for k in keys[start : start + limit]]
+        items = [e for e in page if self._matches(e, condition)]
+        result = {"Count": len(items), "ScannedCount": len(page)}
+        if select != "COUNT":
+            result["Items"] = [copy.deepcopy(e) for e in items]
+        if start + limit < len(keys):
+            result["LastEvaluatedKey"] = self._key_dict(page[-1])
+        return result
+
+    def query(
+        self,
+        Select="ALL_ATTRIBUTES",
+        KeyConditionExpression=None,
+        ExclusiveStartKey=None,
+        Limit=None,
+    ) -> dict:
+        keys = [
+            k
+            for k, e in sorted(self.items.items(), key=lambda i: str(i[0]))
+            if self._matches(e, KeyConditionExpression)
+        ]
+        return self._page(Select, keys, None, ExclusiveStartKey, Limit)
+
+    def scan(
+        self,
+        Select="ALL_ATTRIBUTES",
+        FilterExpression=None,
+        ExclusiveStartKey=None,
+        Limit=None,
+        Segment=0,
+        TotalSegments=1,
+    ) -> dict:
+        keys = [
+            k
+            for k in sorted(self.items, key=str)
+            if zlib.crc32(str(k).encode("utf-8")) % TotalSegments == Segment
+        ]
+        return self._page(Select, keys, FilterExpression, ExclusiveStartKey, Limit)
+
+    def get_item(self, Key: dict) -> dict:
+        item = self.items.get(self._key(Key))
+        return {"Item": copy.deepcopy(item)} if item else {}
+
+    def put_item(self, Item: dict, ConditionExpression=None) -> None:
+        current = self.items.get(self._key(Item), {})
+        if not self._matches(current, ConditionExpression):
+            from botocore.exceptions import ClientError
+
+            raise ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem"
+            )
+        self.items[self._key(Item)] = copy.deepcopy(Item)
+
+    def delete_item(self, Key: dict) -> None:
+        self.items.pop(self._key(Key), None)
+
+
+class InMemorySocketEventRepository:
+    def __init__(self, events: Iterable[tuple[str, float]]) -> None:
+        self.events = sorted(events, key=lambda e: e[1])
+        self.timestamps = [e[1] for e in self.events]
+        self.host_events = collections.defaultdict(list)
+        for host, ts in self.events:
+            self.host_events[host].append(ts)
+
+    def aggregate_on_hosts(self, tw: TimeWindow) -> set[str]:
+        start = bisect.bisect_left(self.timestamps, tw.from_time)
+        end = bisect.bisect_left(self.timestamps, tw.to_time)
+        return {host for host, _ in self.events[start:end]}
+
+    def aggregate_host_usage(self, tw: TimeWindow) -> dict[str, HostUsage]:
+        start = bisect.bisect_left(self.timestamps, tw.from_time)
+        end = bisect.bisect_left(self.timestamps, tw.to_time)
+        counts = collections.Counter(host for host, _ in self.events[start:end])
+        return {host: HostUsage(n, {443: n}) for host, n in counts.items()}
+
+    def aggregate_host_slots(
+        self, tw: TimeWindow, diff_seconds: int = 30
+    ) -> dict[str, list[int]]:
+        start = bisect.bisect_left(self.timestamps, tw.from_time)
+        end = bisect.bisect_left(self.timestamps, tw.to_time)
+        slots = {(host, int(ts) // diff_seconds) for host, ts in self.events[start:end]}
+        return host_slots(sorted(slots))
+
+    def find_correlated_hosts(self, host: str, diff_seconds: int = 30) -> set[str]:
+        access_times = self.host_events.get(host, [])
+        if len(access_times) <= 1:
+            return set()
+        matched = collections.Counter()
+        matched_groups = 0
+        for ts in access_times:
+            start = bisect.bisect_left(self.timestamps, ts - diff_seconds)
+            end = bisect.bisect_right(self.timestamps, ts + diff_seconds)
+            peers = {h for h, _ in self.events[start:end] if h != host}
+            matched.update(peers)
+            matched_groups += 1 if peers else 0
+        return {h for h, n in matched.items() if n / matched_groups > 0.95}
+
+    def find_correlated_hosts_many(
+        self, hosts: Iterable[str], diff_seconds: int = 30, max_in_flight: int = 1
+    ) -> dict[str, set[str]]:
+        return {host: self.find_correlated_hosts(host, diff_seconds) for host in hosts}
+
+    def to_csv(self, path: str) -> None:
+        with open(path, "w") as fp:
+            fp.write("host,port,access_timestamp\n")
+            for host, ts in self.events:
+                dt = datetime.fromtimestamp(ts, timezone.utc)
+                fp.write(f"{host},443,{dt.strftime('%Y-%m-%dT%H:%M:%SZ')}\n")
+
+
+class FakeShellAgent:
+    def __init__(
+        self, continent: str, topology, latency: float = 0.0, loss: float = 0.5
+    ) -> None:
+        self.continent = continent
+        self.topology = topology
+        self.latency = latency
+        self.loss = loss
+
+    def ping(self, host: str, count: int) -> PingResult:
+        if self.latency:
+            time.sleep(self.latency)
+        ip = self.topology.resolve(host)
+        if ip is None:
+            raise RemoteCommandError(f"Failed to run command: ping {host}")
+        if self.topology.continent_of(host) == self.continent:
+            received = count
+        else:
+            received = int(count * (1 - self.loss))
+        return PingResult(ip, count, received)
+
+    def resolve_many(self, hosts: Iterable[str]) -> dict[str, str]:
+        if self.latency:
+            time.sleep(self.latency)
+        return {h: self.topology.resolve(h) for h in hosts if self.topology.resolve(h)}
+
+    def ping_many(self, hosts: Iterable[str], count: int) -> dict[str, PingResult]:
+        if self.latency:
+            time.sleep(self.latency)
+        result = {}
+        for ip in hosts:
+            if self.topology.continent_of_ip(ip) == self.continent:
+                received = count
+            else:
+                received = int(count * (1 - self.loss))
+            result[ip] = PingResult(ip, count, received)
+        return result
+
+    def tcp_connect_many(
+        self, targets: Iterable[tuple[str, int]], count: int
+    ) -> dict[tuple[str, int], TcpConnectResult]:
+        if self.latency:
+            time.sleep(self.latency)
+        result = {}
+        for host, port in targets:
+            ip = self.topology.resolve(host)
+            if ip is None:
+                continue
+            successes = (
+                count if self.topology.continent_of(host) == self.continent else 0
+            )
+            result[(host, port)] = TcpConnectResult(ip, port, count, successes)
+        return result
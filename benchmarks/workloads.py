@@ -0,0 +1,83 @@
+import ipaddress
+import random
+
+
+class SyntheticTopology:
+    CONTINENTS = ["central", "domestic", "ap", "eu"]
+
+    def __init__(
+        self,
+        hosts: int,
+        subdomains_per_domain: int = 4,
+        ips_per_domain: int = 2,
+        ip_host_ratio: float = 0.05,
+        shared_ip_ratio: float = 0.1,
+        seed: int = 0,
+    ) -> None:
+        rnd = random.Random(seed)
+        self.host_ips: dict[str, str] = {}
+        self.host_continents: dict[str, str] = {}
+        self.domains: dict[str, list[str]] = {}
+        ip_pool = ipaddress.ip_network("10.0.0.0/8").hosts()
+        shared_ips = []
+        ip_hosts = int(hosts * ip_host_ratio)
+        domain_count = max(1, (hosts - ip_hosts) // subdomains_per_domain)
+        for d in range(domain_count):
+            domain = f"domain{d}.com"
+            continent = rnd.choice(self.CONTINENTS)
+            ips = []
+            for _ in range(ips_per_domain):
+                if shared_ips and rnd.random() < shared_ip_ratio:
+                    ips.append(rnd.choice(shared_ips))
+                else:
+                    ips.append(str(next(ip_pool)))
+                    shared_ips.append(ips[-1])
+            self.domains[domain] = []
+            for s in range(subdomains_per_domain):
+                host = domain if s == 0 else f"s{s}.{domain}"
+                self.domains[domain].append(host)
+                self.host_ips[host] = ips[s % len(ips)]
+                self.host_continents[host] = continent
+        for _ in range(hosts - len(self.host_ips)):
+            ip = str(next(ip_pool))
+            self.host_ips[ip] = ip
+            self.host_continents[ip] = rnd.choice(self.CONTINENTS)
+        self.rnd = rnd
+
+    @property
+    def hosts(self) -> list[str]:
+        return list(self.host_ips)
+
+    def resolve(self, host: str) -> str:
+        return self.host_ips.get(host)
+
+    def continent_of(self, host: str) -> str:
+        return self.host_continents.get(host)
+
+    def continent_of_ip(self, ip: str) -> str:
+        if not hasattr(self, "_ip_continents"):
+            self._ip_continents = {}
+            for host, address in self.host_ips.items():
+                self._ip_continents.setdefault(address, self.host_continents[host])
+        return self._ip_continents.get(ip)
+
+    def socket_events(
+        self,
+        start_time: float,
+        duration_seconds: int,
+        sessions: int,
+        hosts_per_session: int = 3,
+    ) -> list[tuple[str, float]]:
+        domains = list(self.domains)
+        ip_hosts = [h for h in self.host_ips if h == self.host_ips[h]]
+        events = []
+        for host in self.host_ips:
+            events.append((host, start_time + self.rnd.randrange(duration_seconds)))
+        for _ in range(sessions):
+            ts = start_time + self.rnd.randrange(duration_seconds)
+            members = self.domains[self.rnd.choice(domains)][:hosts_per_session]
+            if ip_hosts and self.rnd.random() < 0.2:
+                members = members + [self.rnd.choice(ip_hosts)]
+            for host in members:
+                events.append((host, ts + self.rnd.randrange(5)))
+        return events
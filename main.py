@@ -1,22 +1,241 @@
-from minerule.analyze import HostsQuery, Proxies, analyze_rules
-from minerule.shellagent import ShellAgent
 import base64
 import json
 
+_instances = {}
 
-def p1(args) -> HostsQuery:
-    return HostsQuery(**args)
 
+def _cached(key: tuple, factory):
+    instance = _instances.get(key)
+    if instance is None:
+        instance = _instances[key] = factory()
+    return instance
 
-def p2(args) -> Proxies:
-    proxies = Proxies(
-        ShellAgent(**args["central_vm"]), ShellAgent(**args["domestic_vm"])
+
+def _new_socket_event_repository(dataset_id: str, project: str = None):
+    from minerule.socketevents import SocketEventRepository
+
+    return SocketEventRepository.create_instance(dataset_id, project)
+
+
+def _new_host_statistic_repository(table: str):
+    from minerule.hoststatistics import HostStatisticRepository
+
+    return HostStatisticRepository(table)
+
+
+def _new_shell_agent(host: str, user: str):
+    from minerule.shellagent import ShellAgent
+
+    return ShellAgent(host, user)
+
+
+def socket_event_repository(args: dict):
+    dataset_id, project = args["dataset_id"], args.get("project")
+    return _cached(
+        ("socketevents", dataset_id, project),
+        lambda: _new_socket_event_repository(dataset_id, project),
+    )
+
+
+def host_statistic_repository(args: dict):
+    table = args.get("table", "hoststatistics")
+    return _cached(
+        ("hoststatistics", table), lambda: _new_host_statistic_repository(table)
+    )
+
+
+def _new_resilient_shell_agent(host: str, user: str, options: dict):
+    from minerule.resilience import ResilientShellAgent
+
+    hedge_agent = None
+    if options.get("hedge_after") is not None:
+        hedge_agent = _new_shell_agent(host, user)
+    return ResilientShellAgent(
+        _new_shell_agent(host, user), host, hedge_agent=hedge_agent, **options
     )
-    if "other_vms" in args:
-        for k in args["other_vms"]:
-            proxies.other_vms[k] = ShellAgent(**args["other_vms"][k])
+
+
+def shell_agent(args: dict):
+    host, user = args["host"], args["user"]
+    return _cached(
+        ("shellagent", host, user),
+        lambda: _new_resilient_shell_agent(host, user, args.get("resilience", {})),
+    )
+
+
+def route_rule_analyzer(args: dict):
+    from minerule.analyze import HostStatisticsRefreshRunner, RouteRuleAnalyzer
+
+    hosts_query, proxies = args["HostsQuery"], args["Proxies"]
+    repository = host_statistic_repository(hosts_query)
+    scheduler, options = None, dict(args.get("Scheduler", {}))
+    hot_hosts = options.pop("hot_hosts", 0)
+    reprobe_after = options.pop("reprobe_after_seconds", None)
+    if "Scheduler" in args:
+        from minerule.probescheduler import ProbeScheduler
+
+        scheduler = ProbeScheduler(**options)
+    refresh_runner = HostStatisticsRefreshRunner(
+        repository,
+        shell_agent(proxies["central_vm"]),
+        shell_agent(proxies["domestic_vm"]),
+        scheduler,
+        **{k: shell_agent(v) for k, v in proxies.get("other_vms", {}).items()},
+    )
+    return RouteRuleAnalyzer(
+        _analyzer_socket_events(args),
+        repository,
+        refresh_runner,
+        hot_hosts=hot_hosts,
+        reprobe_after=reprobe_after,
+    )
+
+
+def _analyzer_socket_events(args: dict):
+    hosts_query = args["HostsQuery"]
+    socket_events = socket_event_repository(hosts_query)
+    if "Rollups" in args:
+        from minerule.rollups import RolledUpSocketEventRepository, SocketEventRollups
+        from minerule.utiltypes import TimeWindow
+
+        socket_events = RolledUpSocketEventRepository(
+            socket_events,
+            SocketEventRollups(socket_events),
+            TimeWindow.past_days(hosts_query.get("days_delta", 1)),
+        )
+    if "Cooccurrence" in args:
+        from minerule.cooccurrence import SketchedSocketEventRepository
+        from minerule.utiltypes import TimeWindow
+
+        socket_events = SketchedSocketEventRepository(
+            socket_events,
+            TimeWindow.past_days(hosts_query.get("days_delta", 1)),
+            **args["Cooccurrence"],
+        )
+    return socket_events
 
 
 def handle_event(event, context):
     args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
-    analyze_rules(p1(args["HostsQuery"]), p2(args["Proxies"]), args["ping_count"])
+    if "Budget" in args:
+        return _calculate_rules_until(args)
+    return route_rule_analyzer(args).calculate_rules(
+        args["HostsQuery"].get("days_delta", 1), args["ping_count"]
+    )
+
+
+def _calculate_rules_until(args: dict) -> dict:
+    import time
+    from minerule.analyze import RuleCursor
+
+    budget = args["Budget"]
+    cursor = None
+    if budget.get("cursor"):
+        cursor = RuleCursor.from_dict(budget["cursor"])
+    rules, cursor = route_rule_analyzer(args).calculate_rules_until(
+        time.time() + budget["seconds"],
+        args["ping_count"],
+        args["HostsQuery"].get("days_delta", 1),
+        cursor,
+    )
+    return {"rules": rules, "cursor": cursor.to_dict() if cursor else None}
+
+
+def sharded_rule_runner(args: dict):
+    from minerule.sharding import ShardCheckpointRepository, ShardedRuleRunner
+
+    shard = args["Shard"]
+    table = shard.get("table", "rulecheckpoints")
+    checkpoints = _cached(
+        ("rulecheckpoints", table), lambda: ShardCheckpointRepository(table)
+    )
+    return ShardedRuleRunner(
+        route_rule_analyzer(args), checkpoints, shard["total_shards"]
+    )
+
+
+def handle_shard_event(event, context):
+    from minerule.utiltypes import TimeWindow
+
+    args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+    shard = args["Shard"]
+    checkpoint = sharded_rule_runner(args).run_shard(
+        shard["run_id"],
+        shard["shard"],
+        TimeWindow(shard["from_time"], shard["to_time"]),
+        args["ping_count"],
+    )
+    return checkpoint.done
+
+
+def handle_merge_event(event, context):
+    args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+    return sharded_rule_runner(args).merge(args["Shard"]["run_id"])
+
+
+def handle_diff_event(event, context):
+    from minerule.rulediffs import (
+        RuleDiffPublisher,
+        RuleSnapshotRepository,
+        S3DiffSink,
+    )
+
+    args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+    diffs = args.get("Diffs", {})
+    table = diffs.get("table", "rulesnapshots")
+    rule_set = diffs.get("rule_set", "default")
+    repository = _cached(
+        ("rulesnapshots", table), lambda: RuleSnapshotRepository(table)
+    )
+    sink, snapshot = None, None
+    if "bucket" in diffs:
+        key = ("s3diffsink", diffs["bucket"], diffs.get("prefix", ""), rule_set)
+        sink = _cached(key, lambda: S3DiffSink(*key[1:]))
+        snapshot = sink.snapshot
+    rules = route_rule_analyzer(args).calculate_rules(
+        args["HostsQuery"].get("days_delta", 1), args["ping_count"]
+    )
+    publisher = RuleDiffPublisher(
+        repository, sink, rule_set, snapshot, diffs.get("snapshot_every", 10)
+    )
+    return publisher.publish(rules).to_dict()
+
+
+def handle_rollup_event(event, context):
+    import datetime
+    from minerule.rollups import SocketEventRollups
+
+    args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+    options = args.get("Rollups", {})
+    rollups = SocketEventRollups(socket_event_repository(args["HostsQuery"]))
+    rollups.create_tables()
+    since = options.get("since")
+    days = rollups.roll_up(
+        datetime.date.fromisoformat(since) if since else None,
+        diff_seconds=options.get("diff_seconds", 30),
+    )
+    return [day.isoformat() for day in days]
+
+
+def handle_topology_event(event, context):
+    from minerule.analyze import RouteRuleAnalyzer
+    from minerule.topology import TopologySimulator
+    from minerule.utiltypes import TimeWindow, hottest_first
+
+    args = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+    hosts_query, options = args["HostsQuery"], args.get("Topology", {})
+    socket_events = _analyzer_socket_events(args)
+    usage = socket_events.aggregate_host_usage(
+        TimeWindow.past_days(hosts_query.get("days_delta", 1))
+    )
+    repository = host_statistic_repository(hosts_query)
+    known = {s.host for s in repository.iter_scan() if s.host in usage}
+    analyzer = RouteRuleAnalyzer(socket_events, repository, None)
+    simulator = TopologySimulator(
+        analyzer.clusters([h for h in hottest_first(usage) if h in known]),
+        {h: u.accesses for h, u in usage.items()},
+    )
+    reports = simulator.evaluate(
+        options.get("candidates"), options.get("required", ["central"])
+    )
+    return [r.to_dict() for r in reports]
@@ -1,17 +1,32 @@
+import copy
+import functools
 import ipaddress
+import threading
 import time
 import logging
-from typing import Iterable
-from tldextract import TLDExtract
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
 
-from .socketevents import SocketEventRepository
+from . import instrumentation
 from .hoststatistics import HostStatistic, HostStatisticRepository
-from .shellagent import PingResult, RemoteCommandError, ShellAgent
-from .utiltypes import TimeWindow
+from .probescheduler import LANE_BACKGROUND, LANE_HOT, LANE_NEW, ProbeScheduler
+from .shellagent import PingResult, RemoteCommandError, ShellAgent, TcpConnectResult
+from .utiltypes import TimeWindow, hottest_first
+
+if TYPE_CHECKING:
+    from .socketevents import SocketEventRepository
 
 
 RouteRules = dict[str, list[str]]
-_domain_extrac_func = TLDExtract()
+_domain_extrac_func = None
+
+
+def domain_extract(host: str):
+    global _domain_extrac_func
+    if _domain_extrac_func is None:
+        from tldextract import TLDExtract
+
+        _domain_extrac_func = TLDExtract()
+    return _domain_extrac_func(host)
 
 
 def silent_run_shell(cmd_call, *args):
@@ -31,7 +46,8 @@ def is_ip_address(address: str) -> bool:
 
 
 def is_same_top_domain(d1: str, d2: str) -> bool:
-    return _domain_extrac_func(d1).domain == _domain_extrac_func(d2).domain
+    with instrumentation.span("analyzer.tld_extract"):
+        return domain_extract(d1).domain == domain_extract(d2).domain
 
 
 class HostStatisticsRefreshRunner:
@@ -40,16 +56,31 @@ class HostStatisticsRefreshRunner:
         repository: HostStatisticRepository,
         central_vm: ShellAgent,
         domestic_vm: ShellAgent,
+        scheduler: ProbeScheduler = None,
         **other_vms: ShellAgent
     ) -> None:
         self.repository = repository
         self.central_vm = central_vm
         self.domestic_vm = domestic_vm
+        self.scheduler = scheduler
         self.other_vms = other_vms
+        self.clock = time.time
 
-    def refresh(self, host: str, ping_count: int) -> None:
-        if self.repository.exists(host) or self.repository.ip_exists(host):
-            return
+    def vms(self) -> dict[str, ShellAgent]:
+        return {
+            "central": self.central_vm,
+            "domestic": self.domestic_vm,
+            **self.other_vms,
+        }
+
+    def _expired(self, deadline: float) -> bool:
+        return deadline is not None and self.clock() >= deadline
+
+    def _needs_refresh(self, host: str) -> bool:
+        return not (self.repository.exists(host) or self.repository.ip_exists(host))
+
+    def _ping(self, host: str, ping_count: int) -> HostStatistic:
+        instrumentation.count("refresh.probed_hosts")
         result = HostStatistic(host, time.time(), is_ip_address(host))
         result.central = silent_run_shell(self.central_vm.ping, host, ping_count)
         result.domestic = silent_run_shell(self.domestic_vm.ping, host, ping_count)
@@ -57,68 +88,402 @@ class HostStatisticsRefreshRunner:
             r = silent_run_shell(self.other_vms[continent].ping, host, ping_count)
             if r:
                 result.other_continents[continent] = r
+        return result
+
+    @staticmethod
+    def _unreachable(result: HostStatistic, vantage: str) -> bool:
+        ping_result = result.ping_result(vantage)
+        return not ping_result or ping_result.packets_received == 0
+
+    @staticmethod
+    def _connected(result: HostStatistic, vantage: str) -> bool:
+        probe = result.tcp_connect.get(vantage)
+        return bool(probe and probe.successes)
+
+    @staticmethod
+    def _probe_domain(host: str) -> str:
+        if is_ip_address(host):
+            return host
+        return domain_extract(host).domain or host
+
+    def _dispatch(
+        self,
+        method: str,
+        targets: dict[str, list],
+        options: dict = None,
+        domains: dict = None,
+        lane: int = LANE_NEW,
+        deadline: float = None,
+    ) -> dict[str, dict]:
+        vms, options = self.vms(), options or {}
+        if self.scheduler is None:
+            results = {}
+            for vantage, t in targets.items():
+                if self._expired(deadline):
+                    raise TimeoutError(f"Deadline reached before {method} on {vantage}")
+                run = functools.partial(getattr(vms[vantage], method), **options)
+                results[vantage] = silent_run_shell(run, t) or {}
+            return results
+        timeout = None if deadline is None else max(0.0, deadline - self.clock())
+        return self.scheduler.probe(
+            {
+                vantage: (
+                    t,
+                    functools.partial(getattr(vms[vantage], method), **options),
+                )
+                for vantage, t in targets.items()
+            },
+            domains,
+            lane,
+            timeout,
+        )
+
+    def _probe_fallbacks(
+        self,
+        results: list[HostStatistic],
+        ports: dict[str, int],
+        ping_count: int,
+        mtr_cycles: int = 0,
+        lane: int = LANE_NEW,
+        deadline: float = None,
+    ) -> None:
+        targets = {}
+        for vantage in self.vms():
+            targets[vantage] = [
+                (r.host, ports[r.host])
+                for r in results
+                if r.host in ports and self._unreachable(r, vantage)
+            ]
+            instrumentation.count(
+                "refresh.tcp_fallbacks", len(targets[vantage]), vantage=vantage
+            )
+        domains = {}
+        if self.scheduler:
+            domains = {
+                t: self._probe_domain(t[0]) for ts in targets.values() for t in ts
+            }
+        probes = self._dispatch(
+            "tcp_connect_many",
+            {v: t for v, t in targets.items() if t},
+            {"count": ping_count},
+            domains,
+            lane,
+            deadline,
+        )
+        traced = {}
+        for vantage in self.vms():
+            for r in results:
+                probe = probes.get(vantage, {}).get((r.host, ports.get(r.host)))
+                if probe:
+                    r.tcp_connect[vantage] = probe
+            hosts = [
+                r.host
+                for r in results
+                if self._unreachable(r, vantage) and not self._connected(r, vantage)
+            ]
+            if mtr_cycles > 0 and hosts:
+                traced[vantage] = hosts
+        if not traced:
+            return
+        domains = {}
+        if self.scheduler:
+            domains = {h: self._probe_domain(h) for hs in traced.values() for h in hs}
+        traces = self._dispatch(
+            "mtr_many", traced, {"cycles": mtr_cycles}, domains, lane, deadline
+        )
+        for vantage, hosts in traces.items():
+            for r in results:
+                if r.host in hosts:
+                    r.mtr[vantage] = hosts[r.host]
+
+    def refresh(
+        self, host: str, ping_count: int, port: int = None, mtr_cycles: int = 0
+    ) -> None:
+        if not self._needs_refresh(host):
+            return
+        result = self._ping(host, ping_count)
+        if port:
+            self._probe_fallbacks([result], {host: port}, ping_count, mtr_cycles)
         self.repository.save(result)
 
-    def refresh_all(self, hosts: Iterable[str], ping_count: int) -> None:
+    def _ping_batch(
+        self,
+        hosts: list[str],
+        ping_count: int,
+        probed: dict[str, dict[str, PingResult]],
+        lane: int = LANE_NEW,
+        deadline: float = None,
+    ) -> list[HostStatistic]:
+        instrumentation.count("refresh.probed_hosts", len(hosts))
+        results = [HostStatistic(h, time.time(), is_ip_address(h)) for h in hosts]
+        names = [r.host for r in results if not r.is_ip_address]
+        resolved, targets, domains = {}, {}, {}
+        names_resolved = {}
+        if names:
+            names_resolved = self._dispatch(
+                "resolve_many",
+                {vantage: names for vantage in self.vms()},
+                lane=lane,
+                deadline=deadline,
+            )
+        for vantage in self.vms():
+            resolved[vantage] = {r.host: r.host for r in results if r.is_ip_address}
+            resolved[vantage].update(names_resolved.get(vantage, {}))
+            cache = probed.setdefault(vantage, {})
+            ips = sorted(set(resolved[vantage].values()) - cache.keys())
+            instrumentation.count(
+                "refresh.deduplicated_probes",
+                len(resolved[vantage]) - len(ips),
+                vantage=vantage,
+            )
+            if ips:
+                targets[vantage] = ips
+            if self.scheduler:
+                for host, ip in resolved[vantage].items():
+                    domains.setdefault(ip, self._probe_domain(host))
+        pings = self._dispatch(
+            "ping_many", targets, {"count": ping_count}, domains, lane, deadline
+        )
+        for vantage in self.vms():
+            cache = probed[vantage]
+            for ip in targets.get(vantage, []):
+                if ip in pings.get(vantage, {}):
+                    cache[ip] = pings[vantage][ip]
+            for r in results:
+                ping_result = cache.get(resolved[vantage].get(r.host))
+                if ping_result:
+                    r.set_ping_result(vantage, copy.copy(ping_result))
+        return results
+
+    def refresh_all(
+        self,
+        hosts: Iterable[str],
+        ping_count: int,
+        ports: dict[str, int] = None,
+        mtr_cycles: int = 0,
+        batch_size: int = 50,
+        lane: int = LANE_NEW,
+        hot: int = 0,
+        deadline: float = None,
+    ) -> list[str]:
+        hosts = list(hosts)
+        probed: dict[str, dict[str, PingResult]] = {}
+        batch, submitted = [], 0
+        for i, host in enumerate(hosts):
+            if self._expired(deadline):
+                return batch + hosts[i:]
+            if self._needs_refresh(host):
+                batch.append(host)
+            if len(batch) >= batch_size:
+                batch_lane = LANE_HOT if submitted < hot else lane
+                if not self._refresh_batch(
+                    batch, ping_count, probed, ports, mtr_cycles, batch_lane, deadline
+                ):
+                    return batch + hosts[i + 1 :]
+                submitted += len(batch)
+                batch = []
+        if batch:
+            batch_lane = LANE_HOT if submitted < hot else lane
+            if not self._refresh_batch(
+                batch, ping_count, probed, ports, mtr_cycles, batch_lane, deadline
+            ):
+                return batch
+        return []
+
+    def refresh_stale(
+        self,
+        hosts: Iterable[str],
+        ping_count: int,
+        max_age_seconds: float,
+        ports: dict[str, int] = None,
+        batch_size: int = 50,
+        stop: threading.Event = None,
+    ) -> int:
+        probed: dict[str, dict[str, PingResult]] = {}
+        batch, refreshed = [], 0
         for host in hosts:
-            self.refresh(host, ping_count)
+            if stop is not None and stop.is_set():
+                return refreshed
+            statistic = self.repository.find(host)
+            if statistic is None:
+                continue
+            if time.time() - float(statistic.last_updated) < max_age_seconds:
+                continue
+            batch.append(host)
+            if len(batch) >= batch_size:
+                self._refresh_batch(
+                    batch, ping_count, probed, ports, lane=LANE_BACKGROUND
+                )
+                refreshed += len(batch)
+                batch = []
+        if batch and not (stop is not None and stop.is_set()):
+            self._refresh_batch(batch, ping_count, probed, ports, lane=LANE_BACKGROUND)
+            refreshed += len(batch)
+        instrumentation.count("refresh.stale_reprobed", refreshed)
+        return refreshed
+
+    def _refresh_batch(
+        self,
+        batch: list[str],
+        ping_count: int,
+        probed: dict[str, dict[str, PingResult]],
+        ports: dict[str, int] = None,
+        mtr_cycles: int = 0,
+        lane: int = LANE_NEW,
+        deadline: float = None,
+    ) -> bool:
+        try:
+            results = self._ping_batch(batch, ping_count, probed, lane, deadline)
+        except TimeoutError as err:
+            logging.warning(err)
+            instrumentation.count("refresh.deadline_aborts")
+            return False
+        if ports:
+            try:
+                self._probe_fallbacks(
+                    results, ports, ping_count, mtr_cycles, lane, deadline
+                )
+            except TimeoutError as err:
+                logging.warning(err)
+        for result in results:
+            self.repository.save(result)
+        return True
 
 
 class RouteEvaluator:
     @staticmethod
-    def add_to_scores(scores, key: str, ping_result: PingResult) -> None:
+    def add_to_scores(
+        scores,
+        key: str,
+        ping_result: PingResult,
+        tcp_result: TcpConnectResult = None,
+        weight: float = 1.0,
+    ) -> None:
+        if (not ping_result or ping_result.packets_received == 0) and (
+            tcp_result and tcp_result.successes
+        ):
+            if scores[key] >= 0:
+                scores[key] += weight * tcp_result.successes / tcp_result.attempts
+            return
         if not ping_result or ping_result.packets_received == 0:
             scores[key] = -1.0
         if scores[key] < 0:
             return
-        scores[key] += ping_result.packets_received / ping_result.packets_transmitted
+        scores[key] += (
+            weight * ping_result.packets_received / ping_result.packets_transmitted
+        )
 
     @staticmethod
     def init_score(statistics: list[HostStatistic]):
         scores = {"central": 0.0, "domestic": 0.0, "others": {}}
         for s in statistics:
-            for c in s.other_continents:
-                if c not in scores["others"]:
+            for c in [*s.other_continents, *s.tcp_connect]:
+                if c not in scores and c not in scores["others"]:
                     scores["others"][c] = 0.0
         return scores
 
     @staticmethod
-    def determine_route_continent(statistics: list[HostStatistic]) -> str:
+    def continent_scores(
+        statistics: list[HostStatistic], weights: dict[str, float] = None
+    ) -> dict[str, float]:
         scores = RouteEvaluator.init_score(statistics)
+        weights = weights or {}
 
         for statistic in statistics:
-            RouteEvaluator.add_to_scores(scores, "central", statistic.central)
-            RouteEvaluator.add_to_scores(scores, "domestic", statistic.domestic)
+            tcp = statistic.tcp_connect
+            weight = weights.get(statistic.host, 1.0)
+            RouteEvaluator.add_to_scores(
+                scores, "central", statistic.central, tcp.get("central"), weight
+            )
+            RouteEvaluator.add_to_scores(
+                scores, "domestic", statistic.domestic, tcp.get("domestic"), weight
+            )
             for continent in scores["others"]:
                 RouteEvaluator.add_to_scores(
                     scores["others"],
                     continent,
-                    statistic.other_continents[continent]
-                    if continent in statistic.other_continents
-                    else None,
+                    (
+                        statistic.other_continents[continent]
+                        if continent in statistic.other_continents
+                        else None
+                    ),
+                    tcp.get(continent),
+                    weight,
                 )
+        others = scores.pop("others")
+        return {**scores, **others}
+
+    @staticmethod
+    def determine_route_continent(
+        statistics: list[HostStatistic], weights: dict[str, float] = None
+    ) -> str:
+        scores = RouteEvaluator.continent_scores(statistics, weights)
         optimal_continent = "central"
         max_score = scores["central"]
-        if scores["domestic"] > max_score:
-            max_score = scores["domestic"]
-            optimal_continent = "domestic"
-        for continent in scores["others"]:
-            if scores["others"][continent] > max_score:
-                max_score = scores["others"][continent]
+        for continent, score in scores.items():
+            if score > max_score:
+                max_score = score
                 optimal_continent = continent
         return optimal_continent
 
 
+class RuleCursor:
+    def __init__(
+        self, snapshot: TimeWindow, remaining: list[str], rules: RouteRules = None
+    ) -> None:
+        self.snapshot = snapshot
+        self.remaining = remaining
+        self.rules = rules or {}
+
+    def to_dict(self) -> dict:
+        return {
+            "fromTime": self.snapshot.from_time,
+            "toTime": self.snapshot.to_time,
+            "remaining": self.remaining,
+            "rules": self.rules,
+        }
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        return cls(
+            TimeWindow(float(obj["fromTime"]), float(obj["toTime"])),
+            list(obj["remaining"]),
+            {c: list(hosts) for c, hosts in obj["rules"].items()},
+        )
+
+
 class RouteRuleAnalyzer:
     def __init__(
         self,
-        socket_event_repository: SocketEventRepository,
+        socket_event_repository: "SocketEventRepository",
         host_statistic_repository: HostStatisticRepository,
         refresh_runner: HostStatisticsRefreshRunner,
+        max_in_flight_queries: int = 1,
+        hot_hosts: int = 0,
+        reprobe_after: float = None,
     ) -> None:
         self.socket_event_repository = socket_event_repository
         self.host_statistic_repository = host_statistic_repository
         self.refresh_runner = refresh_runner
+        self.max_in_flight_queries = max_in_flight_queries
+        self.hot_hosts = hot_hosts
+        self.reprobe_after = reprobe_after
+
+    def _start_reprobe(
+        self, hosts: list[str], ping_count: int, ports: dict[str, int]
+    ) -> tuple[threading.Thread, threading.Event]:
+        stop = threading.Event()
+        if self.reprobe_after is None or self.refresh_runner.scheduler is None:
+            return None, stop
+        worker = threading.Thread(
+            target=self.refresh_runner.refresh_stale,
+            args=(hosts, ping_count, self.reprobe_after, ports),
+            kwargs={"stop": stop},
+            name="reprobe",
+            daemon=True,
+        )
+        worker.start()
+        return worker, stop
 
     @staticmethod
     def create_instance(
@@ -127,7 +492,9 @@ class RouteRuleAnalyzer:
         domestic_vm: ShellAgent,
         **other_vms: ShellAgent
     ):
-        socket_event_repository = SocketEventRepository(dataset_id)
+        from .socketevents import SocketEventRepository
+
+        socket_event_repository = SocketEventRepository.create_instance(dataset_id)
         host_statistic_repository = HostStatisticRepository()
         refresh_runner = HostStatisticsRefreshRunner(
             host_statistic_repository, central_vm, domestic_vm, **other_vms
@@ -138,23 +505,44 @@ class RouteRuleAnalyzer:
 
     def _init_rules(self) -> RouteRules:
         route_rules = {"domestic": []}
-        for continent in self.other_vms:
+        for continent in self.refresh_runner.other_vms:
             route_rules[continent] = []
         return route_rules
 
+    def _find_correlated_hosts(
+        self, statistics: list[HostStatistic], i: int, correlated: dict[str, set[str]]
+    ) -> set[str]:
+        host = statistics[i].host
+        if self.max_in_flight_queries <= 1:
+            return self.socket_event_repository.find_correlated_hosts(host)
+        if host not in correlated:
+            pending = {s.host for s in statistics[i:] if s.host not in correlated}
+            correlated.update(
+                self.socket_event_repository.find_correlated_hosts_many(
+                    pending, max_in_flight=self.max_in_flight_queries
+                )
+            )
+        return correlated[host]
+
     def find_related_hosts(
-        self, seed: HostStatistic, hosts: set[str]
+        self, seed: HostStatistic, hosts: set[str], links: set[str] = None
     ) -> list[HostStatistic]:
         result = [seed]
+        correlated = {}
         i = 0
         while i < len(result):
-            ips = hosts & (result[i].ip_addresses() | self.socket_event_repository.find_correlated_hosts(result[i].host))  # fmt: skip
+            candidates = result[i].ip_addresses() | self._find_correlated_hosts(result, i, correlated)  # fmt: skip
+            ips = hosts & candidates
+            if links is not None:
+                links.update(candidates - hosts)
             for ip in ips:
                 result.append(self.host_statistic_repository.find(ip))
             hosts -= ips
             if result[i].is_ip_address:
                 for s in self.host_statistic_repository.find_by_ip(result[i].host):
                     if s.host not in hosts:
+                        if links is not None:
+                            links.add(s.host)
                         continue
                     result.append(s)
                     hosts.remove(s.host)
@@ -167,15 +555,94 @@ class RouteRuleAnalyzer:
             i += 1
         return result
 
+    def clusters(self, order: list[str]) -> Iterator[list[HostStatistic]]:
+        hosts = set(order)
+        for host in order:
+            if host not in hosts:
+                continue
+            hosts.remove(host)
+            seed = self.host_statistic_repository.find(host)
+            if seed is not None:
+                yield self.find_related_hosts(seed, hosts)
+
     def calculate_rules(self, days_delta: int, ping_count: int) -> RouteRules:
-        route_rules: RouteRules = self._init_rules()
-        snapshot = TimeWindow.past_days(days_delta)
-        hosts = self.socket_event_repository.aggregate_on_hosts(snapshot)
-        self.refresh_runner.refresh_all(hosts, ping_count)
-        while hosts:
-            seed = self.host_statistic_repository.find(hosts.pop())
-            statistics = self.find_related_hosts(seed, hosts)
-            continent = RouteEvaluator.determine_route_continent(statistics)
+        route_rules, _ = self.calculate_rules_until(None, ping_count, days_delta)
+        return route_rules
+
+    def calculate_rules_until(
+        self,
+        deadline: float,
+        ping_count: int,
+        days_delta: int = 1,
+        cursor: RuleCursor = None,
+        batch_size: int = 50,
+        clock: Callable = time.time,
+        refresh_share: float = 0.8,
+    ) -> tuple[RouteRules, RuleCursor]:
+        if cursor is None:
+            cursor = RuleCursor(TimeWindow.past_days(days_delta), None)
+        route_rules = self._init_rules()
+        for continent, hosts in cursor.rules.items():
+            route_rules.setdefault(continent, []).extend(hosts)
+        with instrumentation.span("analyzer.aggregate_host_usage"):
+            usage = self.socket_event_repository.aggregate_host_usage(cursor.snapshot)
+        order = hottest_first(usage) if cursor.remaining is None else cursor.remaining
+        instrumentation.count("analyzer.snapshot_hosts", len(order))
+        ports = {h: u.top_port for h, u in usage.items()}
+        weights = {h: u.accesses for h, u in usage.items()}
+
+        def expired(until: float = deadline) -> bool:
+            return until is not None and clock() >= until
+
+        refresh_deadline, limits = None, {}
+        if deadline is not None:
+            start = clock()
+            refresh_deadline = start + (deadline - start) * refresh_share
+            limits["deadline"] = refresh_deadline
+        refreshed, pending = 0, set()
+        step = len(order) if deadline is None else batch_size
+        reprobe, stop = self._start_reprobe(order, ping_count, ports)
+        with instrumentation.span("analyzer.refresh_all"):
+            while refreshed < len(order) and not pending:
+                if expired(refresh_deadline):
+                    break
+                batch = order[refreshed : refreshed + step]
+                pending = set(
+                    self.refresh_runner.refresh_all(
+                        batch,
+                        ping_count,
+                        ports,
+                        hot=max(0, self.hot_hosts - refreshed),
+                        **limits,
+                    )
+                )
+                refreshed += len(batch)
+        hosts = {h for h in order[:refreshed] if h not in pending}
+        for host in order[:refreshed]:
+            if host not in hosts:
+                continue
+            if expired():
+                break
+            hosts.remove(host)
+            seed = self.host_statistic_repository.find(host)
+            with instrumentation.span("analyzer.find_related_hosts"):
+                statistics = self.find_related_hosts(seed, hosts)
+            with instrumentation.span("analyzer.determine_route_continent"):
+                continent = RouteEvaluator.determine_route_continent(
+                    statistics, weights
+                )
+            instrumentation.count("analyzer.clusters")
             if continent in route_rules:
                 route_rules[continent].extend([e.host for e in statistics])
-        return route_rules
+        stop.set()
+        if reprobe is not None:
+            reprobe.join()
+        remaining = [h for h in order[:refreshed] if h in hosts or h in pending]
+        remaining += order[refreshed:]
+        if not remaining:
+            return route_rules, None
+        instrumentation.count("analyzer.deferred_hosts", len(remaining))
+        logging.warning(
+            "Deadline reached with %d of %d hosts remaining", len(remaining), len(order)
+        )
+        return route_rules, RuleCursor(cursor.snapshot, remaining, route_rules)
@@ -0,0 +1,126 @@
+import random
+from typing import Iterable
+
+from . import instrumentation
+from .utiltypes import TimeWindow
+
+PRIME = (1 << 61) - 1
+
+
+def _neighbourhood(slots: Iterable[int]) -> set[int]:
+    return {s + d for s in slots for d in (-1, 0, 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, seed: int = 0) -> None:
+        rnd = random.Random(seed)
+        self.num_perm = num_perm
+        self.coefficients = [
+            (rnd.randrange(1, PRIME), rnd.randrange(0, PRIME)) for _ in range(num_perm)
+        ]
+
+    def signature(self, values: Iterable[int]) -> tuple[int, ...]:
+        values = list(values)
+        if not values:
+            return (PRIME,) * self.num_perm
+        return tuple(
+            min((a * v + b) % PRIME for v in values) for a, b in self.coefficients
+        )
+
+
+class CooccurrenceIndex:
+    def __init__(
+        self,
+        host_slots: dict[str, Iterable[int]],
+        num_perm: int = 64,
+        bands: int = 32,
+        seed: int = 0,
+    ) -> None:
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.host_slots = {h: frozenset(s) for h, s in host_slots.items()}
+        self.rows = num_perm // bands
+        self.bands = bands
+        hasher = MinHasher(num_perm, seed)
+        self.buckets: dict[tuple, list[str]] = {}
+        self.keys: dict[str, list[tuple]] = {}
+        with instrumentation.span("cooccurrence.index", hosts=len(host_slots)):
+            for host, slots in self.host_slots.items():
+                if len(slots) <= 1:
+                    continue
+                signature = hasher.signature(_neighbourhood(slots))
+                keys = [
+                    (b, signature[b * self.rows : (b + 1) * self.rows])
+                    for b in range(bands)
+                ]
+                for key in keys:
+                    self.buckets.setdefault(key, []).append(host)
+                self.keys[host] = keys
+
+    def candidates(self, host: str) -> set[str]:
+        result = set()
+        for key in self.keys.get(host, []):
+            result.update(self.buckets[key])
+        result.discard(host)
+        return result
+
+
+class SketchedSocketEventRepository:
+    def __init__(
+        self,
+        repository,
+        snapshot: TimeWindow,
+        num_perm: int = 64,
+        bands: int = 32,
+        seed: int = 0,
+    ) -> None:
+        self.repository = repository
+        self.snapshot = snapshot
+        self.options = {
+            "num_perm": num_perm,
+            "bands": bands,
+            "seed": seed,
+        }
+        self._indexes: dict[int, CooccurrenceIndex] = {}
+
+    def __getattr__(self, name: str):
+        return getattr(self.repository, name)
+
+    def index(self, diff_seconds: int = 30) -> CooccurrenceIndex:
+        if diff_seconds not in self._indexes:
+            slots = self.repository.aggregate_host_slots(self.snapshot, diff_seconds)
+            self._indexes[diff_seconds] = CooccurrenceIndex(slots, **self.options)
+        return self._indexes[diff_seconds]
+
+    def find_correlated_hosts(self, host: str, diff_seconds: int = 30) -> set[str]:
+        return self.find_correlated_hosts_many([host], diff_seconds)[host]
+
+    def find_correlated_hosts_many(
+        self, hosts: Iterable[str], diff_seconds: int = 30, max_in_flight: int = 1
+    ) -> dict[str, set[str]]:
+        index = self.index(diff_seconds)
+        candidates = {host: index.candidates(host) for host in hosts}
+        verify = [host for host, peers in candidates.items() if peers]
+        instrumentation.count(
+            "cooccurrence.candidates", sum(len(c) for c in candidates.values())
+        )
+        instrumentation.count("cooccurrence.verified_hosts", len(verify))
+        exact = {}
+        if verify:
+            exact = self.repository.find_correlated_hosts_many(
+                verify, diff_seconds, max_in_flight
+            )
+        return {
+            host: peers & set(exact.get(host, ())) for host, peers in candidates.items()
+        }
+
+
+def recall_precision(
+    approximate: dict[str, set[str]], exact: dict[str, set[str]]
+) -> tuple[float, float]:
+    found = {(h, c) for h, peers in approximate.items() for c in peers}
+    expected = {(h, c) for h, peers in exact.items() for c in peers}
+    hits = len(found & expected)
+    recall = hits / len(expected) if expected else 1.0
+    precision = hits / len(found) if found else 1.0
+    return recall, precision
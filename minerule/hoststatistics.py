@@ -1,7 +1,10 @@
-from .shellagent import PingResult
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import instrumentation
+from .shellagent import MtrHop, MtrResult, PingResult, TcpConnectResult
 from decimal import Decimal
+from typing import Iterator
 
 
 class HostStatistic:
@@ -12,14 +15,33 @@ class HostStatistic:
         is_ip_address: bool,
         central: PingResult = None,
         domestic: PingResult = None,
-        other_continents: dict[str, PingResult] = {},
+        other_continents: dict[str, PingResult] = None,
+        tcp_connect: dict[str, TcpConnectResult] = None,
+        mtr: dict[str, MtrResult] = None,
     ) -> None:
         self.host = host
         self.last_updated = last_updated
         self.is_ip_address = is_ip_address
         self.central = central
         self.domestic = domestic
-        self.other_continents = other_continents
+        self.other_continents = other_continents or {}
+        self.tcp_connect = tcp_connect or {}
+        self.mtr = mtr or {}
+
+    def ping_result(self, vantage: str) -> PingResult:
+        if vantage == "central":
+            return self.central
+        if vantage == "domestic":
+            return self.domestic
+        return self.other_continents.get(vantage)
+
+    def set_ping_result(self, vantage: str, result: PingResult) -> None:
+        if vantage == "central":
+            self.central = result
+        elif vantage == "domestic":
+            self.domestic = result
+        else:
+            self.other_continents[vantage] = result
 
     def ip_addresses(self) -> set[str]:
         if self.is_ip_address:
@@ -30,14 +52,18 @@ class HostStatistic:
         if self.domestic:
             result.add(self.domestic.destination_ip)
         result.update([e.destination_ip for e in self.other_continents.values()])
+        result.update([e.destination_ip for e in self.tcp_connect.values()])
         return result
 
 
 class HostStatisticRepository:
-    def __init__(self, table="hoststatistics") -> None:
-        self.table = (
-            boto3.resource("dynamodb").Table(table) if type(table) == str else table
-        )
+    def __init__(self, table="hoststatistics", total_segments: int = 1) -> None:
+        if type(table) == str:
+            import boto3
+
+            table = boto3.resource("dynamodb").Table(table)
+        self.table = table
+        self.total_segments = total_segments
 
     @staticmethod
     def schema() -> dict:
@@ -46,17 +72,117 @@ class HostStatisticRepository:
             "AttributeDefinitions": [{"AttributeName": "host", "AttributeType": "S"}],
         }
 
-    def exists(self, host: str) -> bool:
-        result = self.table.query(
-            Select="COUNT", KeyConditionExpression=Key("host").eq(host)
+    @staticmethod
+    def _record_read(operation: str, result: dict) -> None:
+        instrumentation.count(
+            "hoststatistics.items_read", result.get("Count", 0), operation=operation
         )
+        if "ScannedCount" in result:
+            instrumentation.count(
+                "hoststatistics.items_scanned",
+                result["ScannedCount"],
+                operation=operation,
+            )
+
+    def exists(self, host: str) -> bool:
+        from boto3.dynamodb.conditions import Key
+
+        with instrumentation.span("hoststatistics.query", operation="exists"):
+            result = self.table.query(
+                Select="COUNT", KeyConditionExpression=Key("host").eq(host)
+            )
+        self._record_read("exists", result)
         return result["Count"] > 0
 
+    def _scan_segment(
+        self, operation: str, segment: int = None, total_segments: int = None, **kwargs
+    ) -> Iterator[dict]:
+        if total_segments and total_segments > 1:
+            kwargs.update(Segment=segment, TotalSegments=total_segments)
+        while True:
+            with instrumentation.span("hoststatistics.scan", operation=operation):
+                page = self.table.scan(**kwargs)
+            self._record_read(operation, page)
+            yield page
+            if "LastEvaluatedKey" not in page:
+                return
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def scan_pages(
+        self, operation: str = "scan", total_segments: int = None, **kwargs
+    ) -> Iterator[dict]:
+        total_segments = total_segments or self.total_segments
+        if total_segments <= 1:
+            yield from self._scan_segment(operation, **kwargs)
+            return
+        pages = queue.Queue(maxsize=total_segments * 2)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run(segment: int) -> None:
+            try:
+                for page in self._scan_segment(
+                    operation, segment, total_segments, **kwargs
+                ):
+                    if not put(page):
+                        return
+            except Exception as err:
+                put(err)
+            put(done)
+
+        executor = ThreadPoolExecutor(
+            max_workers=total_segments, thread_name_prefix="hoststatistics-scan"
+        )
+        try:
+            for segment in range(total_segments):
+                executor.submit(run, segment)
+            remaining = total_segments
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True)
+
+    def iter_scan(
+        self,
+        filter_expression=None,
+        total_segments: int = None,
+        operation: str = "iter_scan",
+    ) -> Iterator[HostStatistic]:
+        kwargs = {"Select": "ALL_ATTRIBUTES"}
+        if filter_expression is not None:
+            kwargs["FilterExpression"] = filter_expression
+        for page in self.scan_pages(operation, total_segments, **kwargs):
+            for doc in page["Items"]:
+                yield self._dict_to_host_statistic(doc)
+
     def ip_exists(self, host: str) -> bool:
-        result = self.table.scan(
-            Select="COUNT", FilterExpression=Attr("ipAddresses").contains(host)
+        from boto3.dynamodb.conditions import Attr
+
+        pages = self.scan_pages(
+            "ip_exists",
+            Select="COUNT",
+            FilterExpression=Attr("ipAddresses").contains(host),
         )
-        return result["Count"] > 0
+        try:
+            return any(page["Count"] > 0 for page in pages)
+        finally:
+            pages.close()
 
     @classmethod
     def _dict_to_ping_result(cls, obj: dict) -> PingResult:
@@ -73,6 +199,38 @@ class HostStatisticRepository:
             result.round_trip_ms_stddev = obj["roundTripMsStddev"]
         return result
 
+    @classmethod
+    def _dict_to_tcp_connect_result(cls, obj: dict) -> TcpConnectResult:
+        return TcpConnectResult(
+            obj["destinationIp"],
+            int(obj["port"]),
+            int(obj["attempts"]),
+            int(obj["successes"]),
+            obj.get("connectMsMin"),
+            obj.get("connectMsAvg"),
+            obj.get("connectMsMax"),
+        )
+
+    @classmethod
+    def _dict_to_mtr_result(cls, obj: dict) -> MtrResult:
+        return MtrResult(
+            obj["destination"],
+            [
+                MtrHop(
+                    int(hop["index"]),
+                    hop["host"],
+                    hop.get("lossPercent"),
+                    int(hop["sent"]) if "sent" in hop else None,
+                    hop.get("lastMs"),
+                    hop.get("avgMs"),
+                    hop.get("bestMs"),
+                    hop.get("worstMs"),
+                    hop.get("stddevMs"),
+                )
+                for hop in obj["hops"]
+            ],
+        )
+
     @classmethod
     def _dict_to_host_statistic(cls, obj: dict) -> HostStatistic:
         result = HostStatistic(obj["host"], obj["lastUpdated"], obj["isIpAddress"])
@@ -86,19 +244,28 @@ class HostStatisticRepository:
                 result.other_continents[continent] = cls._dict_to_ping_result(
                     obj["otherContinents"][continent]
                 )
+        for vantage, probe in obj.get("tcpConnect", {}).items():
+            result.tcp_connect[vantage] = cls._dict_to_tcp_connect_result(probe)
+        for vantage, trace in obj.get("mtr", {}).items():
+            result.mtr[vantage] = cls._dict_to_mtr_result(trace)
         return result
 
     def find(self, host: str) -> HostStatistic:
-        result = self.table.get_item(Key={"host": host})
+        with instrumentation.span("hoststatistics.get_item", operation="find"):
+            result = self.table.get_item(Key={"host": host})
+        instrumentation.count(
+            "hoststatistics.items_read", 1 if "Item" in result else 0, operation="find"
+        )
         return (
             self._dict_to_host_statistic(result["Item"]) if "Item" in result else None
         )
 
     def find_by_ip(self, host: str) -> list[HostStatistic]:
-        result = self.table.scan(
-            Select="ALL_ATTRIBUTES", FilterExpression=Attr("ipAddresses").contains(host)
+        from boto3.dynamodb.conditions import Attr
+
+        return list(
+            self.iter_scan(Attr("ipAddresses").contains(host), operation="find_by_ip")
         )
-        return [self._dict_to_host_statistic(doc) for doc in result["Items"]]
 
     @classmethod
     def _ping_result_to_dict(cls, pr: PingResult) -> dict:
@@ -117,6 +284,40 @@ class HostStatisticRepository:
             result["roundTripMsStddev"] = pr.round_trip_ms_stddev
         return result
 
+    @classmethod
+    def _tcp_connect_result_to_dict(cls, tr: TcpConnectResult) -> dict:
+        result = {
+            "destinationIp": tr.destination_ip,
+            "port": tr.port,
+            "attempts": tr.attempts,
+            "successes": tr.successes,
+        }
+        if tr.connect_ms_min is not None:
+            result["connectMsMin"] = tr.connect_ms_min
+        if tr.connect_ms_avg is not None:
+            result["connectMsAvg"] = tr.connect_ms_avg
+        if tr.connect_ms_max is not None:
+            result["connectMsMax"] = tr.connect_ms_max
+        return result
+
+    @classmethod
+    def _mtr_result_to_dict(cls, mr: MtrResult) -> dict:
+        hops = []
+        for hop in mr.hops:
+            fields = {
+                "index": hop.index,
+                "host": hop.host,
+                "lossPercent": hop.loss_percent,
+                "sent": hop.sent,
+                "lastMs": hop.last_ms,
+                "avgMs": hop.avg_ms,
+                "bestMs": hop.best_ms,
+                "worstMs": hop.worst_ms,
+                "stddevMs": hop.stddev_ms,
+            }
+            hops.append({k: v for k, v in fields.items() if v is not None})
+        return {"destination": mr.destination, "hops": hops}
+
     @classmethod
     def _host_statistic_to_dict(cls, obj: HostStatistic) -> dict:
         result = {
@@ -134,9 +335,20 @@ class HostStatisticRepository:
                 result["otherContinents"][continent] = cls._ping_result_to_dict(
                     obj.other_continents[continent]
                 )
+        if obj.tcp_connect:
+            result["tcpConnect"] = {
+                vantage: cls._tcp_connect_result_to_dict(probe)
+                for vantage, probe in obj.tcp_connect.items()
+            }
+        if obj.mtr:
+            result["mtr"] = {
+                vantage: cls._mtr_result_to_dict(trace)
+                for vantage, trace in obj.mtr.items()
+            }
         if not obj.is_ip_address and obj.ip_addresses():
             result["ipAddresses"] = obj.ip_addresses()
         return result
 
     def save(self, entity: HostStatistic) -> None:
-        self.table.put_item(Item=self._host_statistic_to_dict(entity))
+        with instrumentation.span("hoststatistics.put_item", operation="save"):
+            self.table.put_item(Item=self._host_statistic_to_dict(entity))
@@ -0,0 +1,234 @@
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+_recorder = None
+_null_span = contextlib.nullcontext()
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Sink:
+    def on_span(self, name: str, labels: dict, start: float, duration: float, error):
+        pass
+
+    def on_metric(self, kind: str, name: str, value: float, labels: dict) -> None:
+        pass
+
+    def flush(self, recorder) -> None:
+        pass
+
+
+class Recorder:
+    def __init__(self, *sinks: Sink) -> None:
+        self.sinks = list(sinks)
+        self.counters: dict[tuple, float] = {}
+        self.gauges: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, labels: dict):
+        start = time.time()
+        begin = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            duration = time.perf_counter() - begin
+            self.observe(f"{name}_seconds", duration, labels)
+            if error is not None:
+                self.count(f"{name}_errors", 1, labels)
+            for sink in self.sinks:
+                sink.on_span(name, labels, start, duration, error)
+
+    def count(self, name: str, value: float, labels: dict) -> None:
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.on_metric("counter", name, value, labels)
+
+    def gauge(self, name: str, value: float, labels: dict) -> None:
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+        for sink in self.sinks:
+            sink.on_metric("gauge", name, value, labels)
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+        for sink in self.sinks:
+            sink.on_metric("histogram", name, value, labels)
+
+    def flush(self) -> None:
+        for sink in self.sinks:
+            sink.flush(self)
+
+
+class LogSink(Sink):
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger("minerule.instrumentation")
+        self.level = level
+
+    def on_span(self, name: str, labels: dict, start: float, duration: float, error):
+        record = {"span": name, "start": start, "duration_s": duration, **labels}
+        if error is not None:
+            record["error"] = type(error).__name__
+        self.logger.log(self.level, json.dumps(record, default=str))
+
+
+def _prometheus_name(name: str) -> str:
+    return "minerule_" + name.replace(".", "_")
+
+
+def _prometheus_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in items
+    )
+    return "{" + pairs + "}"
+
+
+def prometheus_text(recorder: Recorder) -> str:
+    lines = []
+    with recorder.lock:
+        for kind, metrics, suffix in (
+            ("counter", recorder.counters, "_total"),
+            ("gauge", recorder.gauges, ""),
+        ):
+            for name in sorted({k[0] for k in metrics}):
+                metric = _prometheus_name(name) + suffix
+                lines.append(f"# TYPE {metric} {kind}")
+                for (n, labels), value in sorted(metrics.items()):
+                    if n == name:
+                        lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+        for name in sorted({k[0] for k in recorder.histograms}):
+            metric = _prometheus_name(name)
+            lines.append(f"# TYPE {metric} histogram")
+            for (n, labels), histogram in sorted(recorder.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                bounds = [str(b) for b in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{metric}_bucket{_prometheus_labels(labels, le=bound)} {cumulative}"
+                    )
+                lines.append(
+                    f"{metric}_sum{_prometheus_labels(labels)} {histogram.sum}"
+                )
+                lines.append(
+                    f"{metric}_count{_prometheus_labels(labels)} {histogram.count}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink(Sink):
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def flush(self, recorder: Recorder) -> None:
+        with open(self.path, "w") as fp:
+            fp.write(prometheus_text(recorder))
+
+
+class OpenTelemetrySink(Sink):
+    def __init__(self, tracer=None, meter=None) -> None:
+        from opentelemetry import metrics, trace
+
+        self.tracer = tracer or trace.get_tracer("minerule")
+        self.meter = meter or metrics.get_meter("minerule")
+        self.instruments = {}
+
+    def on_span(self, name: str, labels: dict, start: float, duration: float, error):
+        span = self.tracer.start_span(
+            name, attributes=labels, start_time=int(start * 1e9)
+        )
+        if error is not None:
+            span.record_exception(error)
+        span.end(end_time=int((start + duration) * 1e9))
+
+    def _instrument(self, kind: str, name: str):
+        if name not in self.instruments:
+            if kind == "counter":
+                self.instruments[name] = self.meter.create_counter(name).add
+            elif kind == "histogram":
+                self.instruments[name] = self.meter.create_histogram(name).record
+            else:
+                self.instruments[name] = self.meter.create_gauge(name).set
+        return self.instruments[name]
+
+    def on_metric(self, kind: str, name: str, value: float, labels: dict) -> None:
+        self._instrument(kind, name)(value, attributes=labels)
+
+
+def enable(*sinks: Sink) -> Recorder:
+    global _recorder
+    _recorder = Recorder(*sinks)
+    return _recorder
+
+
+def disable() -> None:
+    global _recorder
+    _recorder = None
+
+
+def recorder() -> Recorder:
+    return _recorder
+
+
+def span(name: str, **labels):
+    if _recorder is None:
+        return _null_span
+    return _recorder.span(name, labels)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    if _recorder is not None:
+        _recorder.count(name, value, labels)
+
+
+def gauge(name: str, value: float, **labels) -> None:
+    if _recorder is not None:
+        _recorder.gauge(name, value, labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if _recorder is not None:
+        _recorder.observe(name, value, labels)
+
+
+def flush() -> None:
+    if _recorder is not None:
+        _recorder.flush()
@@ -0,0 +1,104 @@
+from typing import Callable, Iterable
+from datetime import datetime
+import duckdb
+from . import instrumentation
+from .utiltypes import HostUsage, TimeWindow, host_slots, host_usage
+
+
+class DuckDBSocketEventRepository:
+    TABLE_NAME = "socketevents"
+    SECONDS_BETWEEN = "DATE_SUB('second', {1}, {0})"
+    SLOT = "CAST(EPOCH({0}) AS BIGINT) // CAST({1} AS BIGINT)"
+    COLUMNS = {
+        "host": "VARCHAR",
+        "port": "BIGINT",
+        "access_timestamp": "TIMESTAMP",
+    }
+
+    def __init__(self, connection: duckdb.DuckDBPyConnection, source: str = None):
+        self.connection = connection
+        if source:
+            self.connection.execute(
+                f"CREATE OR REPLACE TEMP VIEW {self.TABLE_NAME} AS SELECT * FROM {self._source_relation(source)}"
+            )
+
+    @classmethod
+    def create_instance(cls, source: str, database: str = ":memory:"):
+        return cls(duckdb.connect(database), source)
+
+    @classmethod
+    def _source_relation(cls, source: str) -> str:
+        path = source.replace("'", "''")
+        if source.endswith(".parquet"):
+            return f"read_parquet('{path}')"
+        columns = ", ".join(f"'{k}': '{v}'" for k, v in cls.COLUMNS.items())
+        return f"read_csv('{path}', header = true, columns = {{{columns}}})"
+
+    def _query(self, sql: str, result_extractor: Callable, *params):
+        with instrumentation.span("socketevents.query", backend="duckdb"):
+            rows = self.connection.execute(sql, list(params)).fetchall()
+        instrumentation.count("socketevents.rows_read", len(rows), backend="duckdb")
+        return result_extractor(rows)
+
+    def execute(self, sql: str, *params) -> list[tuple]:
+        return self._query(sql, lambda rows: rows, *params)
+
+    def aggregate_on_hosts(self, tw: TimeWindow) -> set[str]:
+        return self._query(
+            "SELECT DISTINCT host from socketevents WHERE access_timestamp >= ? AND access_timestamp < ?",
+            lambda rows: {row[0] for row in rows},
+            datetime.utcfromtimestamp(tw.from_time),
+            datetime.utcfromtimestamp(tw.to_time),
+        )
+
+    def aggregate_host_usage(self, tw: TimeWindow) -> dict[str, HostUsage]:
+        return self._query(
+            "SELECT host, port, COUNT(*) AS accesses FROM socketevents WHERE access_timestamp >= ? AND access_timestamp < ? GROUP BY host, port",
+            host_usage,
+            datetime.utcfromtimestamp(tw.from_time),
+            datetime.utcfromtimestamp(tw.to_time),
+        )
+
+    def aggregate_host_slots(
+        self, tw: TimeWindow, diff_seconds: int = 30
+    ) -> dict[str, list[int]]:
+        return self._query(
+            "SELECT DISTINCT host, CAST(EPOCH(access_timestamp) AS BIGINT) // CAST(? AS BIGINT) AS slot FROM socketevents WHERE access_timestamp >= ? AND access_timestamp < ? ORDER BY host, slot",
+            host_slots,
+            diff_seconds,
+            datetime.utcfromtimestamp(tw.from_time),
+            datetime.utcfromtimestamp(tw.to_time),
+        )
+
+    def find_correlated_hosts(self, host: str, diff_seconds: int = 30) -> set[str]:
+        return self._query(
+            """
+            SELECT DISTINCT host
+            FROM (
+                SELECT
+                    host,
+                    COUNT(DISTINCT group_id) OVER (PARTITION BY host) / COUNT(DISTINCT group_id) OVER () AS scoring
+                FROM (
+                    SELECT DISTINCT c.group_id, a.host
+                    FROM (
+                        SELECT *, ROW_NUMBER() OVER (ORDER BY access_timestamp) AS group_id
+                        FROM socketevents
+                        WHERE host = ?
+                        QUALIFY COUNT(*) OVER() > 1
+                    ) AS c, socketevents AS a
+                    WHERE
+                        a.host != c.host AND
+                        ABS(DATE_SUB('second', a.access_timestamp, c.access_timestamp)) <= ?
+                ) t
+            ) t
+            WHERE scoring > 0.95
+        """,
+            lambda rows: {row[0] for row in rows},
+            host,
+            diff_seconds,
+        )
+
+    def find_correlated_hosts_many(
+        self, hosts: Iterable[str], diff_seconds: int = 30, max_in_flight: int = 1
+    ) -> dict[str, set[str]]:
+        return {host: self.find_correlated_hosts(host, diff_seconds) for host in hosts}
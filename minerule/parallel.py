@@ -0,0 +1,235 @@
+import math
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from . import instrumentation
+from .analyze import RouteRuleAnalyzer, RouteRules, domain_extract
+from .hoststatistics import HostStatistic
+from .shellagent import PingResult, TcpConnectResult
+from .utiltypes import TimeWindow, hottest_first
+
+FIXED_COLUMNS = ["central", "domestic"]
+
+
+def _extract_domains(hosts: list[str]) -> list[str]:
+    return [domain_extract(h).domain for h in hosts]
+
+
+def _ratio(ping_result: PingResult, tcp_result: TcpConnectResult = None) -> float:
+    if not ping_result or ping_result.packets_received == 0:
+        if tcp_result and tcp_result.successes:
+            return tcp_result.successes / tcp_result.attempts
+        return -1.0
+    return ping_result.packets_received / ping_result.packets_transmitted
+
+
+def _best_column(scores, width: int, rows) -> int:
+    totals = [0.0] * width
+    present = [i < len(FIXED_COLUMNS) for i in range(width)]
+    absent = [False] * width
+    for row in rows:
+        base = row * width
+        for c in range(width):
+            value = scores[base + c]
+            if math.isnan(value):
+                absent[c] = True
+                continue
+            present[c] = True
+            if value < 0 or totals[c] < 0:
+                totals[c] = -1.0
+            else:
+                totals[c] += value
+    best, max_score = 0, totals[0]
+    for c in range(1, width):
+        if not present[c]:
+            continue
+        total = -1.0 if absent[c] else totals[c]
+        if total > max_score:
+            best, max_score = c, total
+    return best
+
+
+def _score_clusters(shm_name: str, width: int, members: bytes, offsets: bytes):
+    shm = SharedMemory(name=shm_name)
+    scores = shm.buf.cast("d")
+    try:
+        rows = array("i")
+        rows.frombytes(members)
+        bounds = array("i")
+        bounds.frombytes(offsets)
+        result = array("i")
+        for i in range(len(bounds) - 1):
+            result.append(_best_column(scores, width, rows[bounds[i] : bounds[i + 1]]))
+        return result.tobytes()
+    finally:
+        scores.release()
+        shm.close()
+
+
+def _chunks(items: list, count: int) -> list[list]:
+    size = max(1, math.ceil(len(items) / count))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class _DisjointSet:
+    def __init__(self, size: int) -> None:
+        self.parents = list(range(size))
+
+    def root(self, i: int) -> int:
+        parents = self.parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(self, a: int, b: int) -> None:
+        ra, rb = self.root(a), self.root(b)
+        if ra != rb:
+            self.parents[max(ra, rb)] = min(ra, rb)
+
+
+class ParallelRuleCalculator:
+    def __init__(self, analyzer: RouteRuleAnalyzer, processes: int = None) -> None:
+        self.analyzer = analyzer
+        self.processes = processes
+
+    @staticmethod
+    def _map(executor, fn, calls: list[tuple]) -> list:
+        if executor is None:
+            return [fn(*args) for args in calls]
+        return [f.result() for f in [executor.submit(fn, *args) for args in calls]]
+
+    def cluster(
+        self,
+        statistics: dict[str, HostStatistic],
+        correlated: dict[str, set[str]],
+        executor=None,
+    ) -> list[list[str]]:
+        hosts = sorted(statistics)
+        index = {h: i for i, h in enumerate(hosts)}
+        clusters = _DisjointSet(len(hosts))
+        domains = [h for h in hosts if not statistics[h].is_ip_address]
+        chunks = _chunks(domains, self._workers())
+        extracted = self._map(executor, _extract_domains, [(c,) for c in chunks])
+        labels = {}
+        for chunk, result in zip(chunks, extracted):
+            for host, label in zip(chunk, result):
+                if not label:
+                    continue
+                if label in labels:
+                    clusters.union(index[host], labels[label])
+                else:
+                    labels[label] = index[host]
+        for host in hosts:
+            related = statistics[host].ip_addresses() | correlated.get(host, set())
+            for other in related:
+                if other in index:
+                    clusters.union(index[host], index[other])
+        groups: dict[int, list[str]] = {}
+        for host in hosts:
+            groups.setdefault(clusters.root(index[host]), []).append(host)
+        return sorted(groups.values())
+
+    def _workers(self) -> int:
+        return self.processes or 1
+
+    @staticmethod
+    def columns(statistics: dict[str, HostStatistic]) -> list[str]:
+        others = {
+            c
+            for s in statistics.values()
+            for c in [*s.other_continents, *s.tcp_connect]
+            if c not in FIXED_COLUMNS
+        }
+        return FIXED_COLUMNS + sorted(others)
+
+    def score(
+        self,
+        statistics: dict[str, HostStatistic],
+        clusters: list[list[str]],
+        executor=None,
+        weights: dict[str, float] = None,
+    ) -> list[str]:
+        columns = self.columns(statistics)
+        width = len(columns)
+        hosts = sorted(statistics)
+        weights = weights or {}
+        index = {h: i for i, h in enumerate(hosts)}
+        shm = SharedMemory(create=True, size=max(8, len(hosts) * width * 8))
+        try:
+            scores = shm.buf.cast("d")
+            for i, host in enumerate(hosts):
+                s = statistics[host]
+                weight = weights.get(host, 1.0)
+                for c in range(width):
+                    r = s.ping_result(columns[c])
+                    t = s.tcp_connect.get(columns[c])
+                    if c >= len(FIXED_COLUMNS) and r is None and t is None:
+                        scores[i * width + c] = math.nan
+                    else:
+                        ratio = _ratio(r, t)
+                        scores[i * width + c] = ratio * weight if ratio >= 0 else ratio
+            scores.release()
+            chunks = []
+            for part in _chunks(clusters, self._workers() * 4):
+                members = array("i", [index[h] for c in part for h in c])
+                offsets = array("i", [0])
+                for c in part:
+                    offsets.append(offsets[-1] + len(c))
+                chunks.append((shm.name, width, members.tobytes(), offsets.tobytes()))
+            result = array("i")
+            for data in self._map(executor, _score_clusters, chunks):
+                result.frombytes(data)
+            return [columns[c] for c in result]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def calculate_rules_from(
+        self,
+        statistics: dict[str, HostStatistic],
+        correlated: dict[str, set[str]],
+        weights: dict[str, float] = None,
+    ) -> RouteRules:
+        route_rules = self.analyzer._init_rules()
+        executor = None
+        if self._workers() > 1:
+            executor = ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            with instrumentation.span("parallel.cluster"):
+                clusters = self.cluster(statistics, correlated, executor)
+            with instrumentation.span("parallel.score"):
+                continents = self.score(statistics, clusters, executor, weights)
+        finally:
+            if executor:
+                executor.shutdown()
+        for cluster, continent in zip(clusters, continents):
+            if continent in route_rules:
+                route_rules[continent].extend(cluster)
+        for continent in route_rules:
+            route_rules[continent].sort()
+        return route_rules
+
+    def calculate_rules(self, days_delta: int, ping_count: int) -> RouteRules:
+        snapshot = TimeWindow.past_days(days_delta)
+        repository = self.analyzer.socket_event_repository
+        usage = repository.aggregate_host_usage(snapshot)
+        hosts = set(usage)
+        self.analyzer.refresh_runner.refresh_all(
+            hottest_first(usage),
+            ping_count,
+            {h: u.top_port for h, u in usage.items()},
+        )
+        with instrumentation.span("parallel.prefetch"):
+            statistics = {
+                h: self.analyzer.host_statistic_repository.find(h) for h in hosts
+            }
+            correlated = (
+                self.analyzer.socket_event_repository.find_correlated_hosts_many(
+                    hosts, max_in_flight=self.analyzer.max_in_flight_queries
+                )
+            )
+        return self.calculate_rules_from(
+            statistics, correlated, {h: u.accesses for h, u in usage.items()}
+        )
@@ -0,0 +1,278 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Callable, Hashable, Iterable
+
+from . import instrumentation
+
+LANE_HOT = 0
+LANE_NEW = 1
+LANE_BACKGROUND = 2
+LANES = {LANE_HOT: "hot", LANE_NEW: "new", LANE_BACKGROUND: "background"}
+EPSILON = 1e-9
+
+
+class TokenBucket:
+    def __init__(
+        self, rate: float, capacity: float = None, clock: Callable = time.monotonic
+    ) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens + EPSILON < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def delay(self, tokens: float = 1.0) -> float:
+        self._refill()
+        return max(EPSILON, (tokens - self.tokens) / self.rate)
+
+
+class ProbeTask:
+    def __init__(
+        self,
+        target: Hashable,
+        dispatch: Callable[[list], dict],
+        domain: str,
+        lane: int,
+        enqueued: float,
+    ) -> None:
+        self.target = target
+        self.dispatch = dispatch
+        self.domain = domain
+        self.lane = lane
+        self.enqueued = enqueued
+        self.future = Future()
+
+
+class ProbeScheduler:
+    def __init__(
+        self,
+        vm_rate: float = None,
+        vm_burst: float = None,
+        domain_rate: float = None,
+        domain_burst: float = None,
+        batch_size: int = 20,
+        idle_seconds: float = 1.0,
+        clock: Callable = time.monotonic,
+        sleep: Callable = time.sleep,
+    ) -> None:
+        self.vm_rate = vm_rate
+        self.vm_burst = vm_burst
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.queues: dict[str, dict[Callable, list]] = {}
+        self.vm_buckets: dict[str, TokenBucket] = {}
+        self.domain_buckets: dict[str, TokenBucket] = {}
+        self.dispatched: dict[str, int] = {}
+        self.busy_seconds: dict[str, float] = {}
+        self.started: dict[str, float] = {}
+        self.workers: dict[str, threading.Thread] = {}
+        self.sequence = itertools.count()
+        self.lock = threading.Condition()
+
+    def _vm_bucket(self, vm: str) -> TokenBucket:
+        if self.vm_rate is None:
+            return None
+        if vm not in self.vm_buckets:
+            self.vm_buckets[vm] = TokenBucket(self.vm_rate, self.vm_burst, self.clock)
+        return self.vm_buckets[vm]
+
+    def _domain_bucket(self, domain: str) -> TokenBucket:
+        if self.domain_rate is None or domain is None:
+            return None
+        if domain not in self.domain_buckets:
+            self.domain_buckets[domain] = TokenBucket(
+                self.domain_rate, self.domain_burst, self.clock
+            )
+        return self.domain_buckets[domain]
+
+    def submit(
+        self,
+        vm: str,
+        target: Hashable,
+        dispatch: Callable[[list], dict],
+        domain: str = None,
+        lane: int = LANE_NEW,
+    ) -> Future:
+        task = ProbeTask(target, dispatch, domain, lane, self.clock())
+        with self.lock:
+            self.started.setdefault(vm, task.enqueued)
+            queue = self.queues.setdefault(vm, {}).setdefault(dispatch, [])
+            heapq.heappush(queue, (lane, next(self.sequence), task))
+            self.lock.notify_all()
+        return task.future
+
+    def queue_depth(self, vm: str) -> dict[str, int]:
+        with self.lock:
+            depth = {name: 0 for name in LANES.values()}
+            for queue in self.queues.get(vm, {}).values():
+                for lane, _, _ in queue:
+                    depth[LANES[lane]] += 1
+            return depth
+
+    def _next_batch(self, vm: str) -> tuple[list[ProbeTask], float]:
+        with self.lock:
+            queues = self.queues.get(vm, {})
+            if not queues:
+                return [], None
+            dispatch = min(queues, key=lambda d: queues[d][0][:2])
+            queue = queues[dispatch]
+            vm_bucket = self._vm_bucket(vm)
+            batch, deferred, wait = [], [], None
+            while queue and len(batch) < self.batch_size:
+                if queue[0][2].future.cancelled():
+                    heapq.heappop(queue)
+                    continue
+                if vm_bucket and not vm_bucket.try_acquire():
+                    wait = vm_bucket.delay()
+                    break
+                entry = heapq.heappop(queue)
+                domain_bucket = self._domain_bucket(entry[2].domain)
+                if domain_bucket and not domain_bucket.try_acquire():
+                    if vm_bucket:
+                        vm_bucket.tokens = min(vm_bucket.capacity, vm_bucket.tokens + 1)
+                    delay = domain_bucket.delay()
+                    wait = delay if wait is None else min(wait, delay)
+                    deferred.append(entry)
+                    continue
+                batch.append(entry[2])
+            for entry in deferred:
+                heapq.heappush(queue, entry)
+            if not queue:
+                del queues[dispatch]
+            return batch, (wait or 0.0) if queues else None
+
+    def _record(self, vm: str) -> None:
+        for lane, depth in self.queue_depth(vm).items():
+            instrumentation.gauge("probescheduler.queue_depth", depth, vm=vm, lane=lane)
+        elapsed = self.clock() - self.started.get(vm, self.clock())
+        if elapsed > 0:
+            instrumentation.gauge(
+                "probescheduler.utilization",
+                min(1.0, self.busy_seconds.get(vm, 0.0) / elapsed),
+                vm=vm,
+            )
+
+    def _run_batch(self, vm: str, batch: list[ProbeTask]) -> None:
+        batch = [task for task in batch if task.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        start = self.clock()
+        for task in batch:
+            instrumentation.observe(
+                "probescheduler.wait_seconds",
+                start - task.enqueued,
+                vm=vm,
+                lane=LANES[task.lane],
+            )
+        try:
+            results = batch[0].dispatch([task.target for task in batch])
+        except Exception as err:
+            logging.error("Probe batch on %s failed: %s", vm, err)
+            results = {}
+        finally:
+            with self.lock:
+                self.busy_seconds[vm] = self.busy_seconds.get(vm, 0.0) + (
+                    self.clock() - start
+                )
+                self.dispatched[vm] = self.dispatched.get(vm, 0) + len(batch)
+        instrumentation.count("probescheduler.dispatched", len(batch), vm=vm)
+        self._record(vm)
+        for task in batch:
+            task.future.set_result(results.get(task.target))
+
+    def _drain(self, vm: str) -> None:
+        while True:
+            batch, wait = self._next_batch(vm)
+            if not batch:
+                if wait is None:
+                    return
+                instrumentation.count("probescheduler.throttled", vm=vm)
+                self.sleep(wait)
+                continue
+            self._run_batch(vm, batch)
+
+    def _work(self, vm: str) -> None:
+        while True:
+            batch, wait = self._next_batch(vm)
+            if batch:
+                self._run_batch(vm, batch)
+            elif wait is not None:
+                instrumentation.count("probescheduler.throttled", vm=vm)
+                self.sleep(wait)
+            else:
+                with self.lock:
+                    if not self.lock.wait_for(
+                        lambda: self.queues.get(vm), self.idle_seconds
+                    ):
+                        del self.workers[vm]
+                        return
+
+    def start(self, vm: str) -> None:
+        with self.lock:
+            if vm not in self.workers:
+                worker = threading.Thread(
+                    target=self._work, args=(vm,), name=f"probe-{vm}", daemon=True
+                )
+                self.workers[vm] = worker
+                worker.start()
+
+    def probe(
+        self,
+        jobs: dict[str, tuple[Iterable[Hashable], Callable[[list], dict]]],
+        domains: dict = None,
+        lane: int = LANE_NEW,
+        timeout: float = None,
+    ) -> dict[str, dict]:
+        domains = domains or {}
+        futures = {
+            vm: {t: self.submit(vm, t, dispatch, domains.get(t), lane) for t in targets}
+            for vm, (targets, dispatch) in jobs.items()
+        }
+        for vm in jobs:
+            self.start(vm)
+        _, not_done = wait(
+            [f for tasks in futures.values() for f in tasks.values()], timeout
+        )
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            instrumentation.count("probescheduler.expired", len(not_done))
+            raise TimeoutError(f"{len(not_done)} probes did not finish in time")
+        return {
+            vm: {t: f.result() for t, f in tasks.items() if f.result() is not None}
+            for vm, tasks in futures.items()
+        }
+
+    def stats(self) -> dict[str, dict]:
+        now = self.clock()
+        result = {}
+        for vm in list(self.started):
+            elapsed = now - self.started[vm]
+            busy = self.busy_seconds.get(vm, 0.0)
+            result[vm] = {
+                "queued": self.queue_depth(vm),
+                "dispatched": self.dispatched.get(vm, 0),
+                "busy_seconds": busy,
+                "utilization": min(1.0, busy / elapsed) if elapsed > 0 else 0.0,
+            }
+        return result
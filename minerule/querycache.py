@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from . import instrumentation
+
+
+class QueryCache:
+    def __init__(
+        self,
+        path: str = ".minerule_query_cache.sqlite3",
+        ttl_seconds: float = 86400,
+        bucket_seconds: int = 3600,
+    ) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.bucket_seconds = bucket_seconds
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS query_cache (key TEXT PRIMARY KEY, created REAL NOT NULL, value BLOB NOT NULL)"
+        )
+        self.connection.commit()
+
+    def normalize(self, value):
+        if isinstance(value, datetime):
+            ts = value.replace(tzinfo=timezone.utc).timestamp()
+            ts -= ts % self.bucket_seconds
+            return datetime.utcfromtimestamp(ts)
+        return value
+
+    def normalize_all(self, params) -> tuple:
+        return tuple(self.normalize(param) for param in params)
+
+    @staticmethod
+    def key(sql: str, params: tuple) -> str:
+        digest = hashlib.sha256(" ".join(sql.split()).encode("utf-8"))
+        for param in params:
+            digest.update(b"\0")
+            digest.update(repr(param).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT created, value FROM query_cache WHERE key = ?", (key,)
+            ).fetchone()
+            hit = bool(row) and time.time() - row[0] < self.ttl_seconds
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            instrumentation.count("querycache.hits")
+            logging.debug("Query cache hit: %s", key)
+            return pickle.loads(row[1])
+        instrumentation.count("querycache.misses")
+        logging.debug("Query cache miss: %s", key)
+        return None
+
+    def put(self, key: str, value) -> None:
+        value = pickle.dumps(value)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO query_cache (key, created, value) VALUES (?, ?, ?)",
+                (key, time.time(), value),
+            )
+            self.connection.commit()
+
+    def evict_expired(self) -> int:
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM query_cache WHERE created <= ?",
+                (time.time() - self.ttl_seconds,),
+            )
+            self.connection.commit()
+            return cursor.rowcount
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM query_cache")
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,175 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+from . import instrumentation
+from .shellagent import RemoteCommandError, RemoteConnectionError
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(RemoteConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        clock: Callable = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._state = CLOSED
+        self.lock = threading.Lock()
+
+    def _transition(self, state: str) -> None:
+        if state != self._state:
+            logging.warning(
+                "Circuit %s changed %s -> %s", self.name, self._state, state
+            )
+            instrumentation.count(
+                "resilience.breaker_transitions", vm=self.name, state=state
+            )
+        self._state = state
+        instrumentation.gauge("resilience.breaker_state", STATES[state], vm=self.name)
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self._state == OPEN:
+                if self.clock() - self.opened_at >= self.reset_timeout:
+                    self._transition(HALF_OPEN)
+            return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        with self.lock:
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+        instrumentation.count("resilience.breaker_rejections", vm=self.name)
+        return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.trial = False
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self._state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self._transition(OPEN)
+
+
+class ResilientShellAgent:
+    def __init__(
+        self,
+        agent,
+        name: str,
+        breaker: CircuitBreaker = None,
+        retries: int = 2,
+        backoff: float = 0.2,
+        max_backoff: float = 5.0,
+        hedge_after: float = None,
+        hedge_agent=None,
+        rnd: random.Random = None,
+        sleep: Callable = time.sleep,
+    ) -> None:
+        self.agent = agent
+        self.hedge_agent = hedge_agent
+        self.name = name
+        self.breaker = breaker or CircuitBreaker(name)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.rnd = rnd or random.Random()
+        self.sleep = sleep
+        self._executor = None
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.agent, name)
+        if not callable(attr):
+            return attr
+
+        hedge = None
+        if self.hedge_agent is not None:
+            hedge = getattr(self.hedge_agent, name)
+
+        def call(*args, **kwargs):
+            return self._call(attr, hedge, args, kwargs)
+
+        return call
+
+    def _hedged(self, fn: Callable, hedge: Callable, args: tuple, kwargs: dict):
+        if self.hedge_after is None or hedge is None:
+            return fn(*args, **kwargs)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix=f"hedge-{self.name}")
+        futures = [self._executor.submit(fn, *args, **kwargs)]
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done:
+            instrumentation.count("resilience.hedged_requests", vm=self.name)
+            futures.append(self._executor.submit(hedge, *args, **kwargs))
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        errors = []
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            errors.append(future.exception())
+        for future in futures:
+            if future not in done:
+                try:
+                    return future.result()
+                except Exception as err:
+                    errors.append(err)
+        raise errors[0]
+
+    def _call(self, fn: Callable, hedge: Callable, args: tuple, kwargs: dict):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit for {self.name} is open")
+            try:
+                result = self._hedged(fn, hedge, args, kwargs)
+            except RemoteConnectionError:
+                self.breaker.record_failure()
+                if attempt >= self.retries or self.breaker.state == OPEN:
+                    raise
+                delay = self.rnd.uniform(
+                    0, min(self.max_backoff, self.backoff * 2**attempt)
+                )
+                attempt += 1
+                instrumentation.count("resilience.retries", vm=self.name)
+                self.sleep(delay)
+                continue
+            except RemoteCommandError:
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
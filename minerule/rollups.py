@@ -0,0 +1,276 @@
+import datetime
+import logging
+from typing import Iterable
+
+from . import instrumentation
+from .utiltypes import HostUsage, TimeWindow, host_usage
+
+HOST_TABLE = "hostrollups"
+PAIR_TABLE = "pairrollups"
+
+PAIRS = """
+    WITH e AS (
+        SELECT
+            host,
+            access_timestamp,
+            ROW_NUMBER() OVER (PARTITION BY host ORDER BY access_timestamp) AS event_id,
+            {slot} AS slot
+        FROM socketevents
+        WHERE access_timestamp >= ? AND access_timestamp < ?
+    ),
+    o AS (SELECT -1 AS shift UNION ALL SELECT 0 UNION ALL SELECT 1)
+    SELECT c.host AS host, COALESCE(a.host, c.host) AS peer, COUNT(DISTINCT c.event_id) AS matches
+    FROM e AS c
+    CROSS JOIN o
+    JOIN e AS a ON a.slot = c.slot + o.shift AND a.host != c.host AND ABS({seconds}) <= ?
+    GROUP BY GROUPING SETS ((c.host, a.host), (c.host))
+"""
+
+
+def _midnight(day: datetime.date) -> datetime.datetime:
+    return datetime.datetime(day.year, day.month, day.day)
+
+
+def _day_window(day: datetime.date) -> TimeWindow:
+    start = _midnight(day).replace(tzinfo=datetime.timezone.utc).timestamp()
+    return TimeWindow(start, start + 86400)
+
+
+def _day_of(ts: float) -> datetime.date:
+    return datetime.datetime.utcfromtimestamp(ts).date()
+
+
+def merge_pair_counts(
+    counts: dict[str, dict[str, int]], rows: Iterable[tuple]
+) -> dict[str, dict[str, int]]:
+    for host, peer, matches in rows:
+        peers = counts.setdefault(host, {})
+        peers[peer] = peers.get(peer, 0) + int(matches)
+    return counts
+
+
+class SocketEventRollups:
+    def __init__(self, repository) -> None:
+        self.repository = repository
+
+    def _pairs(self) -> str:
+        return PAIRS.format(
+            slot=self.repository.SLOT.format("access_timestamp", "?"),
+            seconds=self.repository.SECONDS_BETWEEN.format(
+                "c.access_timestamp", "a.access_timestamp"
+            ),
+        )
+
+    def create_tables(self) -> None:
+        self.repository.execute(
+            f"CREATE TABLE IF NOT EXISTS {HOST_TABLE} (day DATE, host STRING, port INT64, accesses INT64)"
+        )
+        self.repository.execute(
+            f"CREATE TABLE IF NOT EXISTS {PAIR_TABLE} (day DATE, diff_seconds INT64, host STRING, peer STRING, matches INT64)"
+        )
+
+    def _days(
+        self,
+        select: str,
+        first: datetime.date,
+        last: datetime.date,
+        diff_seconds: int = None,
+    ) -> list[tuple]:
+        if diff_seconds is None:
+            return self.repository.execute(
+                f"SELECT {select} FROM {HOST_TABLE} WHERE day >= ? AND day < ?",
+                first,
+                last,
+            )
+        return self.repository.execute(
+            f"SELECT {select} FROM {PAIR_TABLE} WHERE diff_seconds = ? AND day >= ? AND day < ? AND day IN (SELECT day FROM {HOST_TABLE})",
+            diff_seconds,
+            first,
+            last,
+        )
+
+    def rolled_up_until(self, diff_seconds: int = None) -> datetime.date:
+        rows = self._days(
+            "MAX(day)", datetime.date.min, datetime.date.max, diff_seconds
+        )
+        last = rows[0][0] if rows else None
+        return last + datetime.timedelta(days=1) if last else None
+
+    def rolled_up_days(
+        self, first: datetime.date, last: datetime.date, diff_seconds: int = None
+    ) -> set[datetime.date]:
+        return {row[0] for row in self._days("DISTINCT day", first, last, diff_seconds)}
+
+    def roll_up_day(self, day: datetime.date, diff_seconds: int = 30) -> None:
+        window = _day_window(day)
+        start = datetime.datetime.utcfromtimestamp(window.from_time)
+        end = datetime.datetime.utcfromtimestamp(window.to_time)
+        with instrumentation.span("rollups.roll_up_day", day=day.isoformat()):
+            self.repository.execute(f"DELETE FROM {HOST_TABLE} WHERE day = ?", day)
+            self.repository.execute(
+                f"INSERT INTO {HOST_TABLE} (day, host, port, accesses) SELECT ?, host, port, COUNT(*) FROM socketevents WHERE access_timestamp >= ? AND access_timestamp < ? GROUP BY host, port",
+                day,
+                start,
+                end,
+            )
+            self.repository.execute(
+                f"DELETE FROM {PAIR_TABLE} WHERE day = ? AND diff_seconds = ?",
+                day,
+                diff_seconds,
+            )
+            self.repository.execute(
+                f"INSERT INTO {PAIR_TABLE} (day, diff_seconds, host, peer, matches) SELECT ?, ?, host, peer, matches FROM ({self._pairs()})",
+                day,
+                diff_seconds,
+                diff_seconds,
+                start,
+                end,
+                diff_seconds,
+            )
+        instrumentation.count("rollups.days")
+
+    def roll_up(
+        self,
+        since: datetime.date = None,
+        until: datetime.date = None,
+        diff_seconds: int = 30,
+    ) -> list[datetime.date]:
+        day = self.rolled_up_until(diff_seconds) or since
+        if day is None:
+            raise ValueError("No rollups exist yet, a start day is required")
+        until = until or datetime.datetime.utcnow().date()
+        days = []
+        while day < until:
+            logging.info("Rolling up socket events of %s", day)
+            self.roll_up_day(day, diff_seconds)
+            days.append(day)
+            day += datetime.timedelta(days=1)
+        return days
+
+    def host_usage(
+        self, first: datetime.date, last: datetime.date
+    ) -> dict[str, HostUsage]:
+        return host_usage(
+            self.repository.execute(
+                f"SELECT host, port, SUM(accesses) FROM {HOST_TABLE} WHERE day >= ? AND day < ? GROUP BY host, port",
+                first,
+                last,
+            )
+        )
+
+    def pair_counts(
+        self, first: datetime.date, last: datetime.date, diff_seconds: int = 30
+    ) -> list[tuple]:
+        return self.repository.execute(
+            f"SELECT host, peer, SUM(matches) FROM {PAIR_TABLE} WHERE diff_seconds = ? AND day >= ? AND day < ? GROUP BY host, peer",
+            diff_seconds,
+            first,
+            last,
+        )
+
+    def raw_pair_counts(self, tw: TimeWindow, diff_seconds: int = 30) -> list[tuple]:
+        return self.repository.execute(
+            self._pairs(),
+            diff_seconds,
+            datetime.datetime.utcfromtimestamp(tw.from_time),
+            datetime.datetime.utcfromtimestamp(tw.to_time),
+            diff_seconds,
+        )
+
+
+class RolledUpSocketEventRepository:
+    def __init__(
+        self,
+        repository,
+        rollups: SocketEventRollups,
+        snapshot: TimeWindow = None,
+        threshold: float = 0.95,
+    ) -> None:
+        self.repository = repository
+        self.rollups = rollups
+        self.snapshot = snapshot
+        self.threshold = threshold
+        self._correlated: dict[int, dict[str, set[str]]] = {}
+
+    def __getattr__(self, name: str):
+        return getattr(self.repository, name)
+
+    def split(
+        self, tw: TimeWindow, diff_seconds: int = None
+    ) -> tuple[list[tuple], list[TimeWindow]]:
+        first = _day_of(tw.from_time)
+        if _day_window(first).from_time < tw.from_time:
+            first += datetime.timedelta(days=1)
+        last = _day_of(tw.to_time)
+        if first >= last:
+            return [], [tw]
+        covered = self.rollups.rolled_up_days(first, last, diff_seconds)
+        days, edges, raw_from = [], [], tw.from_time
+        day = first
+        while day < last:
+            end = day + datetime.timedelta(days=1)
+            while end < last and (end in covered) == (day in covered):
+                end += datetime.timedelta(days=1)
+            if day in covered:
+                if raw_from < _day_window(day).from_time:
+                    edges.append(TimeWindow(raw_from, _day_window(day).from_time))
+                days.append((day, end))
+                raw_from = _day_window(end).from_time
+            day = end
+        if not days:
+            return [], [tw]
+        if raw_from < tw.to_time:
+            edges.append(TimeWindow(raw_from, tw.to_time))
+        return days, edges
+
+    def aggregate_host_usage(self, tw: TimeWindow) -> dict[str, HostUsage]:
+        days, edges = self.split(tw)
+        parts = [self.rollups.host_usage(*d) for d in days]
+        parts.extend(self.repository.aggregate_host_usage(edge) for edge in edges)
+        usage = {}
+        for part in parts:
+            for host, u in part.items():
+                for port, accesses in u.ports.items():
+                    usage.setdefault(host, HostUsage()).add(port, accesses)
+        instrumentation.count("rollups.raw_edges", len(edges))
+        return usage
+
+    def aggregate_on_hosts(self, tw: TimeWindow) -> set[str]:
+        return set(self.aggregate_host_usage(tw))
+
+    def correlated(self, diff_seconds: int = 30) -> dict[str, set[str]]:
+        if diff_seconds not in self._correlated:
+            days, edges = self.split(self.snapshot, diff_seconds)
+            counts = {}
+            for first, last in days:
+                merge_pair_counts(
+                    counts, self.rollups.pair_counts(first, last, diff_seconds)
+                )
+            for edge in edges:
+                merge_pair_counts(
+                    counts, self.rollups.raw_pair_counts(edge, diff_seconds)
+                )
+            usage = self.aggregate_host_usage(self.snapshot)
+            correlated = self._correlated[diff_seconds] = {}
+            for host, peers in counts.items():
+                groups = peers.pop(host, 0)
+                if not groups or usage.get(host, HostUsage()).accesses <= 1:
+                    continue
+                correlated[host] = {
+                    p for p, n in peers.items() if n / groups > self.threshold
+                }
+        return self._correlated[diff_seconds]
+
+    def find_correlated_hosts(self, host: str, diff_seconds: int = 30) -> set[str]:
+        if self.snapshot is None:
+            return self.repository.find_correlated_hosts(host, diff_seconds)
+        return set(self.correlated(diff_seconds).get(host, ()))
+
+    def find_correlated_hosts_many(
+        self, hosts: Iterable[str], diff_seconds: int = 30, max_in_flight: int = 1
+    ) -> dict[str, set[str]]:
+        if self.snapshot is None:
+            return self.repository.find_correlated_hosts_many(
+                hosts, diff_seconds, max_in_flight
+            )
+        return {host: self.find_correlated_hosts(host, diff_seconds) for host in hosts}
@@ -0,0 +1,214 @@
+import ipaddress
+import json
+import logging
+from typing import Iterable
+
+from .analyze import RouteRules, domain_extract, is_ip_address
+
+DEFAULT_CONTINENT = "central"
+PAC_DIRECTIVES = {"DIRECT", "PROXY", "SOCKS", "SOCKS4", "SOCKS5", "HTTP", "HTTPS"}
+
+
+class DomainSuffixTrie:
+    def __init__(self) -> None:
+        self.root = {}
+
+    @staticmethod
+    def _labels(domain: str) -> list[str]:
+        return list(reversed(domain.lower().rstrip(".").split(".")))
+
+    def insert(self, domain: str, value) -> None:
+        node = self.root
+        for label in self._labels(domain):
+            node = node.setdefault(label, {})
+        node[None] = value
+
+    def longest_suffix(self, domain: str):
+        node, result = self.root, None
+        for label in self._labels(domain):
+            if label not in node:
+                break
+            node = node[label]
+            if None in node:
+                result = node[None]
+        return result
+
+
+class CompiledRules:
+    def __init__(
+        self,
+        domain_suffixes: dict[str, str],
+        domains: dict[str, str],
+        networks: list[tuple[str, str]],
+        default: str = DEFAULT_CONTINENT,
+    ) -> None:
+        self.domain_suffixes = domain_suffixes
+        self.domains = domains
+        self.networks = networks
+        self.default = default
+
+    def entries(self) -> list[tuple[str, str, str]]:
+        result = [("DOMAIN", d, c) for d, c in sorted(self.domains.items())]
+        result.extend(
+            ("DOMAIN-SUFFIX", d, c) for d, c in sorted(self.domain_suffixes.items())
+        )
+        for network, continent in self.networks:
+            kind = "IP-CIDR6" if ":" in network else "IP-CIDR"
+            result.append((kind, network, continent))
+        return result
+
+
+def compile_rules(
+    rules: RouteRules,
+    central_hosts: Iterable[str] = (),
+    default: str = DEFAULT_CONTINENT,
+) -> CompiledRules:
+    routes = {h: default for h in central_hosts}
+    for continent, hosts in rules.items():
+        for host in hosts:
+            routes[host] = continent
+
+    registered: dict[str, set[str]] = {}
+    networks: dict[str, list] = {}
+    for host, continent in routes.items():
+        if is_ip_address(host):
+            networks.setdefault(continent, []).append(ipaddress.ip_network(host))
+        else:
+            extracted = domain_extract(host)
+            key = host.lower()
+            if extracted.domain and extracted.suffix:
+                key = f"{extracted.domain}.{extracted.suffix}"
+            registered.setdefault(key, set()).add(continent)
+
+    suffixes = DomainSuffixTrie()
+    domain_suffixes = {}
+    for domain, continents in registered.items():
+        if len(continents) == 1:
+            continent = continents.pop()
+            suffixes.insert(domain, continent)
+            if continent != default:
+                domain_suffixes[domain] = continent
+    domains = {}
+    for host, continent in routes.items():
+        if is_ip_address(host) or continent == default:
+            continue
+        if suffixes.longest_suffix(host) != continent:
+            domains[host.lower()] = continent
+
+    compiled_networks = []
+    for continent in sorted(networks):
+        if continent == default:
+            continue
+        for version in (4, 6):
+            collapsed = ipaddress.collapse_addresses(
+                n for n in networks[continent] if n.version == version
+            )
+            compiled_networks.extend((str(n), continent) for n in collapsed)
+    return CompiledRules(domain_suffixes, domains, compiled_networks, default)
+
+
+def _policy(policies: dict[str, str], continent: str) -> str:
+    if policies and continent in policies:
+        return policies[continent]
+    return "DIRECT" if continent == "domestic" else continent
+
+
+def _pac_policy(policies: dict[str, str], continent: str) -> str:
+    if not policies or continent not in policies:
+        if continent != "domestic":
+            logging.warning("No PAC policy for %s, routing it DIRECT", continent)
+        return "DIRECT"
+    policy = policies[continent]
+    for directive in policy.split(";"):
+        if not directive.split() or directive.split()[0] not in PAC_DIRECTIVES:
+            raise ValueError(f"Invalid PAC policy for {continent}: {policy}")
+    return policy
+
+
+def to_clash(compiled: CompiledRules, policies: dict[str, str] = None) -> str:
+    lines = ["rules:"]
+    for kind, value, continent in compiled.entries():
+        rule = f"{kind},{value},{_policy(policies, continent)}"
+        if kind.startswith("IP-CIDR"):
+            rule += ",no-resolve"
+        lines.append(f"  - {rule}")
+    lines.append(f"  - MATCH,{_policy(policies, compiled.default)}")
+    return "\n".join(lines) + "\n"
+
+
+def to_shadowrocket(compiled: CompiledRules, policies: dict[str, str] = None) -> str:
+    lines = ["[Rule]"]
+    for kind, value, continent in compiled.entries():
+        rule = f"{kind},{value},{_policy(policies, continent)}"
+        if kind.startswith("IP-CIDR"):
+            rule += ",no-resolve"
+        lines.append(rule)
+    lines.append(f"FINAL,{_policy(policies, compiled.default)}")
+    return "\n".join(lines) + "\n"
+
+
+PAC_TEMPLATE = """var domains = %(domains)s;
+var suffixes = %(suffixes)s;
+var networks = %(networks)s;
+var networks6 = %(networks6)s;
+var fallback = %(fallback)s;
+
+function FindProxyForURL(url, host) {
+  host = host.toLowerCase().replace(/^\\[|\\]$/g, "");
+  if (domains.hasOwnProperty(host)) {
+    return domains[host];
+  }
+  var labels = host.split(".");
+  for (var i = 0; i < labels.length; i++) {
+    var suffix = labels.slice(i).join(".");
+    if (suffixes.hasOwnProperty(suffix)) {
+      return suffixes[suffix];
+    }
+  }
+  if (/^\\d+\\.\\d+\\.\\d+\\.\\d+$/.test(host)) {
+    for (var j = 0; j < networks.length; j++) {
+      if (isInNet(host, networks[j][0], networks[j][1])) {
+        return networks[j][2];
+      }
+    }
+  }
+  if (host.indexOf(":") >= 0 && typeof isInNetEx === "function") {
+    for (var k = 0; k < networks6.length; k++) {
+      if (isInNetEx(host, networks6[k][0])) {
+        return networks6[k][1];
+      }
+    }
+  }
+  return fallback;
+}
+"""
+
+
+def to_pac(compiled: CompiledRules, policies: dict[str, str] = None) -> str:
+    policies = {
+        c: _pac_policy(policies, c)
+        for c in {compiled.default}.union(c for _, _, c in compiled.entries())
+    }
+    networks, networks6 = [], []
+    for network, continent in compiled.networks:
+        n = ipaddress.ip_network(network)
+        if n.version == 4:
+            networks.append(
+                [str(n.network_address), str(n.netmask), policies[continent]]
+            )
+        else:
+            networks6.append([str(n), policies[continent]])
+    return PAC_TEMPLATE % {
+        "domains": json.dumps(
+            {d: policies[c] for d, c in sorted(compiled.domains.items())}
+        ),
+        "suffixes": json.dumps(
+            {d: policies[c] for d, c in sorted(compiled.domain_suffixes.items())}
+        ),
+        "networks": json.dumps(networks),
+        "networks6": json.dumps(networks6),
+        "fallback": json.dumps(policies[compiled.default]),
+    }
+
+
+FORMATS = {"clash": to_clash, "shadowrocket": to_shadowrocket, "pac": to_pac}
@@ -0,0 +1,293 @@
+import json
+import uuid
+from typing import Callable
+
+from . import instrumentation
+from .analyze import RouteRules
+
+VERSION_KEY = "#version"
+
+
+class RuleDiff:
+    def __init__(
+        self,
+        from_version: int,
+        to_version: int,
+        added: dict[str, str] = None,
+        removed: dict[str, str] = None,
+        moved: dict[str, tuple[str, str]] = None,
+    ) -> None:
+        self.from_version = from_version
+        self.to_version = to_version
+        self.added = added or {}
+        self.removed = removed or {}
+        self.moved = moved or {}
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.moved)
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed) + len(self.moved)
+
+    def to_dict(self) -> dict:
+        return {
+            "fromVersion": self.from_version,
+            "toVersion": self.to_version,
+            "added": self.added,
+            "removed": self.removed,
+            "moved": {h: list(m) for h, m in self.moved.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, obj: dict):
+        return cls(
+            int(obj["fromVersion"]),
+            int(obj["toVersion"]),
+            dict(obj["added"]),
+            dict(obj["removed"]),
+            {h: tuple(m) for h, m in obj["moved"].items()},
+        )
+
+
+def _routes(rules: RouteRules) -> dict[str, str]:
+    return {h: continent for continent, hosts in rules.items() for h in hosts}
+
+
+def diff_rules(
+    old: RouteRules, new: RouteRules, from_version: int = 0, to_version: int = None
+) -> RuleDiff:
+    old_routes, new_routes = _routes(old), _routes(new)
+    diff = RuleDiff(
+        from_version, from_version + 1 if to_version is None else to_version
+    )
+    for host, continent in new_routes.items():
+        previous = old_routes.get(host)
+        if previous is None:
+            diff.added[host] = continent
+        elif previous != continent:
+            diff.moved[host] = (previous, continent)
+    for host, continent in old_routes.items():
+        if host not in new_routes:
+            diff.removed[host] = continent
+    return diff
+
+
+def apply_diff(rules: RouteRules, diff: RuleDiff) -> RouteRules:
+    routes = _routes(rules)
+    for host in diff.removed:
+        routes.pop(host, None)
+    routes.update(diff.added)
+    routes.update({h: m[1] for h, m in diff.moved.items()})
+    result = {continent: [] for continent in rules}
+    for host, continent in routes.items():
+        result.setdefault(continent, []).append(host)
+    for continent in result:
+        result[continent].sort()
+    return result
+
+
+class RuleSnapshotRepository:
+    def __init__(self, table="rulesnapshots") -> None:
+        if isinstance(table, str):
+            import boto3
+
+            table = boto3.resource("dynamodb").Table(table)
+        self.table = table
+
+    @staticmethod
+    def schema() -> dict:
+        return {
+            "KeySchema": [
+                {"AttributeName": "ruleSet", "KeyType": "HASH"},
+                {"AttributeName": "host", "KeyType": "RANGE"},
+            ],
+            "AttributeDefinitions": [
+                {"AttributeName": "ruleSet", "AttributeType": "S"},
+                {"AttributeName": "host", "AttributeType": "S"},
+            ],
+        }
+
+    def _query(self, rule_set: str) -> list[dict]:
+        from boto3.dynamodb.conditions import Key
+
+        kwargs = {"KeyConditionExpression": Key("ruleSet").eq(rule_set)}
+        items = []
+        while True:
+            page = self.table.query(**kwargs)
+            items.extend(page["Items"])
+            if "LastEvaluatedKey" not in page:
+                return items
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def find(self, rule_set: str) -> tuple[int, RouteRules]:
+        version, rules = 0, {}
+        for item in self._query(rule_set):
+            if item["host"] == VERSION_KEY:
+                version = int(item["version"])
+            else:
+                rules.setdefault(item["continent"], []).append(item["host"])
+        for continent in rules:
+            rules[continent].sort()
+        return version, rules
+
+    def journal(self, rule_set: str, diff: RuleDiff) -> str:
+        journal = f"{rule_set}#{diff.to_version}#{uuid.uuid4().hex}"
+        changes = [(h, None, c) for h, c in diff.added.items()]
+        changes.extend((h, c, None) for h, c in diff.removed.items())
+        changes.extend((h, *m) for h, m in diff.moved.items())
+        for host, previous, continent in changes:
+            item = {"ruleSet": journal, "host": host, "fromVersion": diff.from_version}
+            if previous is not None:
+                item["previous"] = previous
+            if continent is not None:
+                item["continent"] = continent
+            self.table.put_item(Item=item)
+        return journal
+
+    def discard(self, journal: str) -> None:
+        for item in self._query(journal):
+            self.table.delete_item(Key={"ruleSet": journal, "host": item["host"]})
+
+    def commit(self, rule_set: str, diff: RuleDiff, journal: str) -> None:
+        from boto3.dynamodb.conditions import Attr
+
+        if diff.from_version == 0:
+            condition = Attr("host").not_exists()
+        else:
+            condition = Attr("version").eq(diff.from_version) & (
+                Attr("published").not_exists() | Attr("published").eq(True)
+            )
+        self.table.put_item(
+            Item={
+                "ruleSet": rule_set,
+                "host": VERSION_KEY,
+                "version": diff.to_version,
+                "journal": journal,
+                "published": False,
+            },
+            ConditionExpression=condition,
+        )
+
+    def pending(self, rule_set: str) -> RuleDiff:
+        marker = self.table.get_item(
+            Key={"ruleSet": rule_set, "host": VERSION_KEY}
+        ).get("Item")
+        if not marker or marker.get("published", True):
+            return None
+        items = self._query(marker["journal"])
+        diff = RuleDiff(int(items[0]["fromVersion"]), int(marker["version"]))
+        for item in items:
+            if "previous" not in item:
+                diff.added[item["host"]] = item["continent"]
+            elif "continent" not in item:
+                diff.removed[item["host"]] = item["previous"]
+            else:
+                diff.moved[item["host"]] = (item["previous"], item["continent"])
+        return diff
+
+    def apply(self, rule_set: str, diff: RuleDiff) -> None:
+        with instrumentation.span("rulediffs.apply", rule_set=rule_set):
+            for host in diff.removed:
+                self.table.delete_item(Key={"ruleSet": rule_set, "host": host})
+            changes = {**diff.added, **{h: m[1] for h, m in diff.moved.items()}}
+            for host, continent in changes.items():
+                self.table.put_item(
+                    Item={
+                        "ruleSet": rule_set,
+                        "host": host,
+                        "continent": continent,
+                        "version": diff.to_version,
+                    }
+                )
+
+    def mark_published(self, rule_set: str, diff: RuleDiff) -> None:
+        marker = self.table.get_item(
+            Key={"ruleSet": rule_set, "host": VERSION_KEY}
+        ).get("Item", {})
+        self.table.put_item(
+            Item={
+                "ruleSet": rule_set,
+                "host": VERSION_KEY,
+                "version": diff.to_version,
+                "published": True,
+            }
+        )
+        if "journal" in marker:
+            self.discard(marker["journal"])
+
+
+class S3DiffSink:
+    def __init__(
+        self, bucket: str, prefix: str = "", rule_set: str = "default", client=None
+    ) -> None:
+        if client is None:
+            import boto3
+
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.rule_set = rule_set
+
+    def __call__(self, diff: RuleDiff) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{self.rule_set}/{diff.to_version:08d}.json",
+            Body=json.dumps(diff.to_dict()).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def snapshot(self, version: int, rules: RouteRules) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{self.rule_set}/snapshots/{version:08d}.json",
+            Body=json.dumps({"version": version, "rules": rules}).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+class RuleDiffPublisher:
+    def __init__(
+        self,
+        repository: RuleSnapshotRepository,
+        sink: Callable[[RuleDiff], None] = None,
+        rule_set: str = "default",
+        snapshot: Callable[[int, RouteRules], None] = None,
+        snapshot_every: int = 10,
+    ) -> None:
+        self.repository = repository
+        self.sink = sink
+        self.rule_set = rule_set
+        self.snapshot = snapshot
+        self.snapshot_every = snapshot_every
+
+    def _deliver(self, diff: RuleDiff) -> None:
+        self.repository.apply(self.rule_set, diff)
+        if self.sink:
+            self.sink(diff)
+        if self.snapshot and diff.to_version % self.snapshot_every == 0:
+            self.snapshot(*self.repository.find(self.rule_set))
+            instrumentation.count("rulediffs.snapshots")
+        self.repository.mark_published(self.rule_set, diff)
+
+    def publish(self, rules: RouteRules) -> RuleDiff:
+        pending = self.repository.pending(self.rule_set)
+        if pending is not None:
+            instrumentation.count("rulediffs.recovered")
+            self._deliver(pending)
+        version, previous = self.repository.find(self.rule_set)
+        diff = diff_rules(previous, rules, version)
+        instrumentation.count("rulediffs.added", len(diff.added))
+        instrumentation.count("rulediffs.removed", len(diff.removed))
+        instrumentation.count("rulediffs.moved", len(diff.moved))
+        if diff.is_empty():
+            diff.to_version = version
+            return diff
+        journal = self.repository.journal(self.rule_set, diff)
+        try:
+            self.repository.commit(self.rule_set, diff, journal)
+        except Exception:
+            self.repository.discard(journal)
+            raise
+        self._deliver(diff)
+        return diff
@@ -0,0 +1,252 @@
+import bisect
+import ipaddress
+import mmap
+import struct
+import sys
+from array import array
+from typing import Iterable
+
+from .analyze import RouteRules
+from .rulecompiler import DEFAULT_CONTINENT, CompiledRules, compile_rules
+
+MAGIC = b"MRM1"
+HEADER = struct.Struct("<4sB3x9I")
+BYTE_ORDERS = {"little": 0, "big": 1}
+
+
+class _DomainTrieBuilder:
+    def __init__(self) -> None:
+        self.children: list[dict[int, int]] = [{}]
+        self.suffix_values = [-1]
+        self.exact_values = [-1]
+
+    def insert(self, labels: list[int], value: int, exact: bool) -> None:
+        node = 0
+        for label in labels:
+            if label not in self.children[node]:
+                self.children.append({})
+                self.suffix_values.append(-1)
+                self.exact_values.append(-1)
+                self.children[node][label] = len(self.children) - 1
+            node = self.children[node][label]
+        (self.exact_values if exact else self.suffix_values)[node] = value
+
+
+class _IpTrieBuilder:
+    def __init__(self) -> None:
+        self.zero = array("i", [-1])
+        self.one = array("i", [-1])
+        self.values = array("i", [-1])
+
+    def insert(self, network, value: int) -> None:
+        node = 0
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - i)) & 1
+            branch = self.one if bit else self.zero
+            if branch[node] < 0:
+                branch[node] = len(self.values)
+                self.zero.append(-1)
+                self.one.append(-1)
+                self.values.append(-1)
+            node = branch[node]
+        self.values[node] = value
+
+
+def _encode_strings(strings: list[str]) -> bytes:
+    return b"\0".join(s.encode("utf-8") for s in strings)
+
+
+def dumps(compiled: CompiledRules) -> bytes:
+    values = sorted(
+        {compiled.default, *compiled.domains.values()}.union(
+            compiled.domain_suffixes.values(), (c for _, c in compiled.networks)
+        )
+    )
+    value_ids = {v: i for i, v in enumerate(values)}
+    labels: dict[str, int] = {}
+    domains = _DomainTrieBuilder()
+    for entries, exact in ((compiled.domain_suffixes, False), (compiled.domains, True)):
+        for domain, continent in entries.items():
+            ids = [
+                labels.setdefault(label, len(labels))
+                for label in reversed(domain.lower().rstrip(".").split("."))
+            ]
+            domains.insert(ids, value_ids[continent], exact)
+    ip_tries = {4: _IpTrieBuilder(), 6: _IpTrieBuilder()}
+    for network, continent in compiled.networks:
+        n = ipaddress.ip_network(network)
+        ip_tries[n.version].insert(n, value_ids[continent])
+
+    edge_starts = array("i")
+    edge_labels = array("i")
+    edge_children = array("i")
+    for children in domains.children:
+        edge_starts.append(len(edge_labels))
+        for label in sorted(children):
+            edge_labels.append(label)
+            edge_children.append(children[label])
+    edge_starts.append(len(edge_labels))
+
+    sections = [
+        _encode_strings(values),
+        _encode_strings(sorted(labels, key=labels.get)),
+        edge_starts.tobytes(),
+        edge_labels.tobytes(),
+        edge_children.tobytes(),
+        array("i", domains.suffix_values).tobytes(),
+        array("i", domains.exact_values).tobytes(),
+    ]
+    for version in (4, 6):
+        trie = ip_tries[version]
+        sections.extend(
+            [trie.zero.tobytes(), trie.one.tobytes(), trie.values.tobytes()]
+        )
+    string_sizes = [len(sections[0]), len(sections[1])]
+    padded = []
+    for section in sections:
+        padded.append(section + b"\0" * (-len(section) % 4))
+    header = HEADER.pack(
+        MAGIC,
+        BYTE_ORDERS[sys.byteorder],
+        value_ids[compiled.default],
+        len(values),
+        len(labels),
+        string_sizes[0],
+        string_sizes[1],
+        len(domains.children),
+        len(edge_labels),
+        len(ip_tries[4].values),
+        len(ip_tries[6].values),
+    )
+    return header + b"".join(padded)
+
+
+class RouteMatcher:
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        (
+            magic,
+            byte_order,
+            default,
+            value_count,
+            label_count,
+            values_size,
+            labels_size,
+            node_count,
+            edge_count,
+            ip4_count,
+            ip6_count,
+        ) = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a route matcher file")
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError("Route matcher file was written with another byte order")
+        offset = HEADER.size
+
+        def take(size: int) -> memoryview:
+            nonlocal offset
+            section = view[offset : offset + size]
+            offset += size + (-size % 4)
+            return section
+
+        def take_ints(count: int) -> memoryview:
+            return take(count * 4).cast("i")
+
+        self.values = bytes(take(values_size)).decode("utf-8").split("\0")
+        labels = bytes(take(labels_size)).decode("utf-8").split("\0")
+        self.labels = (
+            {label: i for i, label in enumerate(labels)} if label_count else {}
+        )
+        self.default = self.values[default]
+        self.edge_starts = take_ints(node_count + 1)
+        self.edge_labels = take_ints(edge_count)
+        self.edge_children = take_ints(edge_count)
+        self.suffix_values = take_ints(node_count)
+        self.exact_values = take_ints(node_count)
+        self.ip_tries = {
+            4: (take_ints(ip4_count), take_ints(ip4_count), take_ints(ip4_count), 32),
+            6: (take_ints(ip6_count), take_ints(ip6_count), take_ints(ip6_count), 128),
+        }
+
+    @classmethod
+    def from_compiled(cls, compiled: CompiledRules):
+        return cls(dumps(compiled))
+
+    @classmethod
+    def from_rules(
+        cls,
+        rules: RouteRules,
+        central_hosts: Iterable[str] = (),
+        default: str = DEFAULT_CONTINENT,
+    ):
+        return cls.from_compiled(compile_rules(rules, central_hosts, default))
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as fp:
+            fp.write(self.buffer)
+
+    def close(self) -> None:
+        for name in (
+            "edge_starts",
+            "edge_labels",
+            "edge_children",
+            "suffix_values",
+            "exact_values",
+        ):
+            getattr(self, name).release()
+        for trie in self.ip_tries.values():
+            for section in trie[:3]:
+                section.release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def lookup_domain(self, host: str) -> str:
+        node, result = 0, -1
+        labels, edge_labels = self.labels, self.edge_labels
+        edge_starts, suffix_values = self.edge_starts, self.suffix_values
+        parts = host.lower().rstrip(".").split(".")
+        for part in reversed(parts):
+            label = labels.get(part)
+            if label is None:
+                break
+            hi = edge_starts[node + 1]
+            j = bisect.bisect_left(edge_labels, label, edge_starts[node], hi)
+            if j == hi or edge_labels[j] != label:
+                break
+            node = self.edge_children[j]
+            if suffix_values[node] >= 0:
+                result = suffix_values[node]
+        else:
+            if self.exact_values[node] >= 0:
+                result = self.exact_values[node]
+        return self.values[result] if result >= 0 else self.default
+
+    def lookup_ip(self, address) -> str:
+        if isinstance(address, str):
+            address = ipaddress.ip_address(address)
+        zero, one, values, bits = self.ip_tries[address.version]
+        value = int(address)
+        node, result = 0, values[0]
+        for i in range(bits - 1, -1, -1):
+            node = one[node] if (value >> i) & 1 else zero[node]
+            if node < 0:
+                break
+            if values[node] >= 0:
+                result = values[node]
+        return self.values[result] if result >= 0 else self.default
+
+    def lookup(self, host: str) -> str:
+        if ":" not in host and not host[-1:].isdigit():
+            return self.lookup_domain(host)
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return self.lookup_domain(host)
+        return self.lookup_ip(address)
@@ -0,0 +1,380 @@
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from typing import Callable, Iterable
+
+from . import instrumentation
+from .analyze import (
+    RouteEvaluator,
+    RouteRuleAnalyzer,
+    RouteRules,
+    domain_extract,
+    is_ip_address,
+)
+from .utiltypes import HostUsage, TimeWindow, hottest_first
+
+
+def shard_key(host: str) -> str:
+    if is_ip_address(host):
+        return host
+    return domain_extract(host).domain or host
+
+
+def shard_of(host: str, total_shards: int) -> int:
+    digest = hashlib.sha1(shard_key(host).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % total_shards
+
+
+class ShardCluster:
+    def __init__(self, continent: str, hosts: list[str], links: list[str] = None):
+        self.continent = continent
+        self.hosts = hosts
+        self.links = links or []
+
+
+class ShardCheckpoint:
+    def __init__(
+        self,
+        run_id: str,
+        shard: int,
+        total_shards: int,
+        snapshot: TimeWindow,
+        remaining: list[str],
+        clusters: list[ShardCluster] = None,
+        refreshed: bool = False,
+        done: bool = False,
+        persisted: int = None,
+    ) -> None:
+        self.run_id = run_id
+        self.shard = shard
+        self.total_shards = total_shards
+        self.snapshot = snapshot
+        self.remaining = remaining
+        self.clusters = clusters or []
+        self.refreshed = refreshed
+        self.done = done
+        self.persisted = persisted
+
+
+def _chunks(values: list, size: int) -> list[list]:
+    return [values[i : i + size] for i in range(0, len(values), size)]
+
+
+class ShardCheckpointRepository:
+    def __init__(self, table="rulecheckpoints", chunk_size: int = 1000) -> None:
+        if isinstance(table, str):
+            import boto3
+
+            table = boto3.resource("dynamodb").Table(table)
+        self.table = table
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def schema() -> dict:
+        return {
+            "KeySchema": [
+                {"AttributeName": "runId", "KeyType": "HASH"},
+                {"AttributeName": "part", "KeyType": "RANGE"},
+            ],
+            "AttributeDefinitions": [
+                {"AttributeName": "runId", "AttributeType": "S"},
+                {"AttributeName": "part", "AttributeType": "S"},
+            ],
+        }
+
+    @staticmethod
+    def _part(shard: int, *suffix: str) -> str:
+        return "#".join([f"{shard:06d}", *suffix])
+
+    def _item(self, obj: ShardCheckpoint, *suffix: str, **values) -> dict:
+        return {
+            "runId": obj.run_id,
+            "part": self._part(obj.shard, *suffix),
+            "shard": obj.shard,
+            **values,
+        }
+
+    def _checkpoint_to_dict(self, obj: ShardCheckpoint) -> dict:
+        return self._item(
+            obj,
+            totalShards=obj.total_shards,
+            fromTime=Decimal(str(obj.snapshot.from_time)),
+            toTime=Decimal(str(obj.snapshot.to_time)),
+            clusterCount=len(obj.clusters),
+            refreshed=obj.refreshed,
+            done=obj.done,
+        )
+
+    def _host_items(self, obj: ShardCheckpoint) -> list[dict]:
+        hosts = set(obj.remaining).union(h for c in obj.clusters for h in c.hosts)
+        return [
+            self._item(obj, "hosts", f"{i:06d}", hosts=chunk)
+            for i, chunk in enumerate(_chunks(sorted(hosts), self.chunk_size))
+        ]
+
+    def _cluster_items(self, obj: ShardCheckpoint, n: int) -> list[dict]:
+        cluster = obj.clusters[n]
+        hosts = _chunks(cluster.hosts, self.chunk_size)
+        links = _chunks(cluster.links, self.chunk_size)
+        pieces = max(len(hosts), len(links), 1)
+        return [
+            self._item(
+                obj,
+                "cluster",
+                f"{n:08d}",
+                f"{k:04d}",
+                continent=cluster.continent,
+                hosts=hosts[k] if k < len(hosts) else [],
+                links=links[k] if k < len(links) else [],
+                pieces=pieces,
+            )
+            for k in range(pieces)
+        ]
+
+    @classmethod
+    def _dict_to_checkpoint(cls, items: list[dict]) -> ShardCheckpoint:
+        header, hosts, pieces = None, [], {}
+        for item in items:
+            part = item["part"].split("#")
+            if len(part) == 1:
+                header = item
+            elif part[1] == "hosts":
+                hosts.extend(item["hosts"])
+            else:
+                pieces.setdefault(int(part[2]), {})[int(part[3])] = item
+        if header is None:
+            return None
+        clusters = []
+        for n in range(int(header["clusterCount"])):
+            items = [pieces[n][k] for k in range(int(pieces[n][0]["pieces"]))]
+            clusters.append(
+                ShardCluster(
+                    items[0]["continent"],
+                    [h for item in items for h in item["hosts"]],
+                    [h for item in items for h in item["links"]],
+                )
+            )
+        clustered = {h for c in clusters for h in c.hosts}
+        return ShardCheckpoint(
+            header["runId"],
+            int(header["shard"]),
+            int(header["totalShards"]),
+            TimeWindow(float(header["fromTime"]), float(header["toTime"])),
+            sorted(set(hosts) - clustered),
+            clusters,
+            header["refreshed"],
+            header["done"],
+            len(clusters),
+        )
+
+    def save(self, checkpoint: ShardCheckpoint) -> None:
+        items = []
+        if checkpoint.persisted is None:
+            items.extend(self._host_items(checkpoint))
+        for n in range(checkpoint.persisted or 0, len(checkpoint.clusters)):
+            items.extend(self._cluster_items(checkpoint, n))
+        for item in items:
+            self.table.put_item(Item=item)
+        self.table.put_item(Item=self._checkpoint_to_dict(checkpoint))
+        checkpoint.persisted = len(checkpoint.clusters)
+
+    def _query(self, condition) -> list[dict]:
+        kwargs = {"KeyConditionExpression": condition}
+        result = []
+        while True:
+            page = self.table.query(**kwargs)
+            result.extend(page["Items"])
+            if "LastEvaluatedKey" not in page:
+                return result
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def find(self, run_id: str, shard: int) -> ShardCheckpoint:
+        from boto3.dynamodb.conditions import Key
+
+        return self._dict_to_checkpoint(
+            self._query(
+                Key("runId").eq(run_id) & Key("part").begins_with(self._part(shard))
+            )
+        )
+
+    def find_all(self, run_id: str) -> list[ShardCheckpoint]:
+        from boto3.dynamodb.conditions import Key
+
+        shards: dict[int, list[dict]] = {}
+        for item in self._query(Key("runId").eq(run_id)):
+            shards.setdefault(int(item["shard"]), []).append(item)
+        checkpoints = (self._dict_to_checkpoint(shards[s]) for s in sorted(shards))
+        return [c for c in checkpoints if c is not None]
+
+
+class ShardedRuleRunner:
+    def __init__(
+        self,
+        analyzer: RouteRuleAnalyzer,
+        checkpoints: ShardCheckpointRepository,
+        total_shards: int,
+        checkpoint_every: int = 50,
+    ) -> None:
+        self.analyzer = analyzer
+        self.checkpoints = checkpoints
+        self.total_shards = total_shards
+        self.checkpoint_every = checkpoint_every
+
+    def shard_hosts(self, hosts: Iterable[str], shard: int) -> set[str]:
+        return {h for h in hosts if shard_of(h, self.total_shards) == shard}
+
+    def usage(self, snapshot: TimeWindow) -> dict[str, HostUsage]:
+        return self.analyzer.socket_event_repository.aggregate_host_usage(snapshot)
+
+    def _start(
+        self, run_id: str, shard: int, snapshot: TimeWindow, hosts: Iterable[str]
+    ) -> ShardCheckpoint:
+        checkpoint = ShardCheckpoint(
+            run_id,
+            shard,
+            self.total_shards,
+            snapshot,
+            sorted(self.shard_hosts(hosts, shard)),
+        )
+        self.checkpoints.save(checkpoint)
+        return checkpoint
+
+    def run_shard(
+        self,
+        run_id: str,
+        shard: int,
+        snapshot: TimeWindow,
+        ping_count: int,
+        usage: dict[str, HostUsage] = None,
+    ) -> ShardCheckpoint:
+        checkpoint = self.checkpoints.find(run_id, shard)
+        if checkpoint is not None and checkpoint.done:
+            return checkpoint
+        if usage is None:
+            usage = self.usage(snapshot if checkpoint is None else checkpoint.snapshot)
+        if checkpoint is None:
+            checkpoint = self._start(run_id, shard, snapshot, usage)
+        else:
+            logging.info(
+                "Resuming shard %d of run %s with %d hosts remaining",
+                shard,
+                run_id,
+                len(checkpoint.remaining),
+            )
+        if not checkpoint.refreshed:
+            remaining = set(checkpoint.remaining)
+            order = [h for h in hottest_first(usage) if h in remaining]
+            order.extend(sorted(remaining.difference(order)))
+            with instrumentation.span("sharding.refresh_all", shard=shard):
+                self.analyzer.refresh_runner.refresh_all(
+                    order, ping_count, {h: u.top_port for h, u in usage.items()}
+                )
+            checkpoint.refreshed = True
+            self.checkpoints.save(checkpoint)
+        weights = {h: u.accesses for h, u in usage.items()}
+        hosts = set(checkpoint.remaining)
+        pending = 0
+        while hosts:
+            seed = self.analyzer.host_statistic_repository.find(min(hosts))
+            hosts.remove(seed.host)
+            links = set()
+            statistics = self.analyzer.find_related_hosts(seed, hosts, links)
+            members = [e.host for e in statistics]
+            checkpoint.clusters.append(
+                ShardCluster(
+                    RouteEvaluator.determine_route_continent(statistics, weights),
+                    members,
+                    sorted(
+                        h
+                        for h in links.difference(members)
+                        if shard_of(h, self.total_shards) != shard
+                    ),
+                )
+            )
+            checkpoint.remaining = sorted(hosts)
+            pending += 1
+            if pending >= self.checkpoint_every:
+                self.checkpoints.save(checkpoint)
+                pending = 0
+        checkpoint.done = True
+        self.checkpoints.save(checkpoint)
+        return checkpoint
+
+    def merge(self, run_id: str, usage: dict[str, HostUsage] = None) -> RouteRules:
+        checkpoints = self.checkpoints.find_all(run_id)
+        done = {c.shard for c in checkpoints if c.done}
+        missing = set(range(self.total_shards)) - done
+        if missing:
+            raise RuntimeError(f"Shards not finished for run {run_id}: {missing}")
+        clusters = [c for cp in checkpoints for c in cp.clusters]
+        parents = list(range(len(clusters)))
+
+        def root(i: int) -> int:
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        owners = {h: i for i, c in enumerate(clusters) for h in c.hosts}
+        for i, cluster in enumerate(clusters):
+            for link in cluster.links:
+                if link in owners:
+                    parents[root(owners[link])] = root(i)
+        groups: dict[int, list[ShardCluster]] = {}
+        for i, cluster in enumerate(clusters):
+            groups.setdefault(root(i), []).append(cluster)
+
+        route_rules, weights = self.analyzer._init_rules(), None
+        for group in groups.values():
+            hosts = sorted(h for c in group for h in c.hosts)
+            if len(group) == 1:
+                continent = group[0].continent
+            else:
+                instrumentation.count("sharding.reconciled_clusters")
+                if weights is None:
+                    if usage is None:
+                        usage = self.usage(checkpoints[0].snapshot)
+                    weights = {h: u.accesses for h, u in usage.items()}
+                continent = RouteEvaluator.determine_route_continent(
+                    [self.analyzer.host_statistic_repository.find(h) for h in hosts],
+                    weights,
+                )
+            if continent in route_rules:
+                route_rules[continent].extend(hosts)
+        for continent in route_rules:
+            route_rules[continent].sort()
+        return route_rules
+
+
+def _run_shard(
+    factory: Callable[[], ShardedRuleRunner],
+    run_id: str,
+    shard: int,
+    snapshot: TimeWindow,
+    ping_count: int,
+    usage: dict[str, HostUsage],
+) -> int:
+    factory().run_shard(run_id, shard, snapshot, ping_count, usage)
+    return shard
+
+
+def run_local(
+    factory: Callable[[], ShardedRuleRunner],
+    run_id: str,
+    snapshot: TimeWindow,
+    ping_count: int,
+    processes: int = None,
+) -> RouteRules:
+    runner = factory()
+    usage = runner.usage(snapshot)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                _run_shard, factory, run_id, shard, snapshot, ping_count, usage
+            )
+            for shard in range(runner.total_shards)
+        ]
+        for future in futures:
+            future.result()
+    return runner.merge(run_id, usage)
@@ -1,8 +1,12 @@
+import json
+import logging
+import shlex
 from decimal import Decimal
-import jc
-import fabric
-from invoke.exceptions import Failure, ThreadException
-from paramiko import PKey
+from typing import TYPE_CHECKING, Iterable
+from . import instrumentation
+
+if TYPE_CHECKING:
+    from paramiko import PKey
 
 
 class RemoteCommandError(RuntimeError):
@@ -11,6 +15,10 @@ class RemoteCommandError(RuntimeError):
         self.message = message
 
 
+class RemoteConnectionError(RemoteCommandError):
+    pass
+
+
 class PingResult:
     def __init__(
         self,
@@ -31,8 +39,165 @@ class PingResult:
         self.round_trip_ms_stddev = round_trip_ms_stddev
 
 
+class TcpConnectResult:
+    def __init__(
+        self,
+        destination_ip: str = None,
+        port: int = None,
+        attempts: int = None,
+        successes: int = None,
+        connect_ms_min: Decimal = None,
+        connect_ms_avg: Decimal = None,
+        connect_ms_max: Decimal = None,
+    ) -> None:
+        self.destination_ip = destination_ip
+        self.port = port
+        self.attempts = attempts
+        self.successes = successes
+        self.connect_ms_min = connect_ms_min
+        self.connect_ms_avg = connect_ms_avg
+        self.connect_ms_max = connect_ms_max
+
+
+class MtrHop:
+    def __init__(
+        self,
+        index: int,
+        host: str,
+        loss_percent: Decimal = None,
+        sent: int = None,
+        last_ms: Decimal = None,
+        avg_ms: Decimal = None,
+        best_ms: Decimal = None,
+        worst_ms: Decimal = None,
+        stddev_ms: Decimal = None,
+    ) -> None:
+        self.index = index
+        self.host = host
+        self.loss_percent = loss_percent
+        self.sent = sent
+        self.last_ms = last_ms
+        self.avg_ms = avg_ms
+        self.best_ms = best_ms
+        self.worst_ms = worst_ms
+        self.stddev_ms = stddev_ms
+
+
+class MtrResult:
+    def __init__(self, destination: str = None, hops: list[MtrHop] = None) -> None:
+        self.destination = destination
+        self.hops = hops or []
+
+    @property
+    def reached(self) -> bool:
+        if not self.hops or self.hops[-1].loss_percent is None:
+            return False
+        return self.hops[-1].loss_percent < 100
+
+
+TCP_CONNECT_SCRIPT = """for target in {targets}; do
+  host="${{target%:*}}"; port="${{target##*:}}"
+  ip=$(getent ahosts "$host" | awk 'NR==1{{print $1}}')
+  if [ -z "$ip" ]; then echo "$target - 0 0"; continue; fi
+  for i in $(seq {count}); do
+    start=$(date +%s%N)
+    if timeout {timeout} bash -c "exec 3<>/dev/tcp/$ip/$port" 2>/dev/null; then
+      echo "$target $ip 1 $((($(date +%s%N) - start) / 1000))"
+    else
+      echo "$target $ip 0 0"
+    fi
+  done
+done"""
+
+MTR_SEPARATOR = "--- mtr ---"
+MTR_SCRIPT = """for host in {hosts}; do
+  echo "{separator} $host"
+  mtr --json --no-dns --report-cycles {cycles} "$host" 2>/dev/null || echo "{{}}"
+done"""
+
+
+PING_SEPARATOR = "=== ping ==="
+PING_SCRIPT = """for host in {hosts}; do
+  echo "{separator} $host"
+  ping -c{count} -q "$host" 2>/dev/null
+done
+true"""
+
+RESOLVE_SCRIPT = """for host in {hosts}; do
+  echo "$host $(getent ahosts "$host" | awk 'NR==1{{print $1}}')"
+done"""
+
+
+def parse_resolve(stdout: str) -> dict[str, str]:
+    result = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            result[fields[0]] = fields[1]
+    return result
+
+
+def _decimal(value) -> Decimal:
+    return None if value is None else Decimal(str(value))
+
+
+def parse_tcp_connect(stdout: str) -> dict[tuple[str, int], TcpConnectResult]:
+    samples: dict[tuple[str, int], list] = {}
+    addresses = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        host, _, port = fields[0].rpartition(":")
+        key = (host, int(port))
+        samples.setdefault(key, [])
+        if fields[1] == "-":
+            continue
+        addresses[key] = fields[1]
+        samples[key].append(int(fields[3]) if fields[2] == "1" else None)
+    result = {}
+    for key, values in samples.items():
+        if key not in addresses:
+            continue
+        times = [Decimal(v) / 1000 for v in values if v is not None]
+        probe = TcpConnectResult(addresses[key], key[1], len(values), len(times))
+        if times:
+            probe.connect_ms_min = min(times)
+            probe.connect_ms_max = max(times)
+            probe.connect_ms_avg = sum(times) / len(times)
+        result[key] = probe
+    return result
+
+
+def parse_mtr(stdout: str) -> dict[str, MtrResult]:
+    result = {}
+    for chunk in stdout.split(MTR_SEPARATOR)[1:]:
+        host, _, body = chunk.strip().partition("\n")
+        report = json.loads(body or "{}").get("report")
+        if not report:
+            continue
+        hops = [
+            MtrHop(
+                int(hub["count"]),
+                hub["host"],
+                _decimal(hub.get("Loss%")),
+                hub.get("Snt"),
+                _decimal(hub.get("Last")),
+                _decimal(hub.get("Avg")),
+                _decimal(hub.get("Best")),
+                _decimal(hub.get("Wrst")),
+                _decimal(hub.get("StDev")),
+            )
+            for hub in report.get("hubs", [])
+        ]
+        result[host.strip()] = MtrResult(host.strip(), hops)
+    return result
+
+
 class ShellAgent:
-    def __init__(self, host: str, user: str, pkey: PKey = None) -> None:
+    def __init__(self, host: str, user: str, pkey: "PKey" = None) -> None:
+        import fabric
+
         if pkey:
             self.connection = fabric.Connection(
                 host,
@@ -42,23 +207,39 @@ class ShellAgent:
         else:
             self.connection = fabric.Connection(host, user=user)
 
-    def _run_command(self, command: str):
-        cmd_name = command.split(" ")[0]
+    def _run(self, command: str, cmd_name: str = None) -> str:
+        from invoke.exceptions import Failure, ThreadException
+        from paramiko import SSHException
+
+        cmd_name = cmd_name or command.split(" ")[0]
         try:
-            result = self.connection.run(command, hide=True)
+            with instrumentation.span(
+                "shellagent.command", command=cmd_name, vm=self.connection.host
+            ):
+                result = self.connection.run(command, hide=True)
         except (Failure, ThreadException) as err:
             raise RemoteCommandError(f"Failed to run command: {cmd_name}") from err
+        except (OSError, SSHException) as err:
+            raise RemoteConnectionError(
+                f"Failed to connect to {self.connection.host}"
+            ) from err
         if not result.stdout:
             raise RemoteCommandError(f"Output of command {cmd_name} is empty")
+        return result.stdout
+
+    def _run_command(self, command: str):
+        import jc
+
+        cmd_name = command.split(" ")[0]
+        stdout = self._run(command, cmd_name)
         try:
-            return jc.parse(cmd_name, result.stdout)
+            with instrumentation.span("shellagent.parse", command=cmd_name):
+                return jc.parse(cmd_name, stdout)
         except BaseException:
-            raise RemoteCommandError(
-                f"Failed to parse {cmd_name} stdout: {result.stdout}"
-            )
+            raise RemoteCommandError(f"Failed to parse {cmd_name} stdout: {stdout}")
 
-    def ping(self, host: str, count: int) -> PingResult:
-        result = self._run_command(f"ping -c{count} -q {host}")
+    @staticmethod
+    def _ping_result(result: dict) -> PingResult:
         if result.keys() >= {
             "destination_ip",
             "packets_transmitted",
@@ -87,3 +268,70 @@ class ShellAgent:
             return statistics
         else:
             raise RemoteCommandError("Missing key attributes from ping result")
+
+    def ping(self, host: str, count: int) -> PingResult:
+        return self._ping_result(self._run_command(f"ping -c{count} -q {host}"))
+
+    def ping_many(self, hosts: Iterable[str], count: int) -> dict[str, PingResult]:
+        import jc
+
+        script = PING_SCRIPT.format(
+            hosts=" ".join(shlex.quote(h) for h in hosts),
+            separator=PING_SEPARATOR,
+            count=count,
+        )
+        stdout = self._run(f"bash -c {shlex.quote(script)}", "ping")
+        result = {}
+        with instrumentation.span("shellagent.parse", command="ping"):
+            for chunk in stdout.split(PING_SEPARATOR)[1:]:
+                host, _, body = chunk.strip().partition("\n")
+                if not body.strip():
+                    continue
+                try:
+                    result[host.strip()] = self._ping_result(jc.parse("ping", body))
+                except Exception:
+                    logging.warning("Failed to parse ping stdout of %s: %s", host, body)
+                    instrumentation.count("shellagent.parse_errors", command="ping")
+        return result
+
+    def resolve_many(self, hosts: Iterable[str]) -> dict[str, str]:
+        script = RESOLVE_SCRIPT.format(hosts=" ".join(shlex.quote(h) for h in hosts))
+        stdout = self._run(f"bash -c {shlex.quote(script)}", "getent")
+        return parse_resolve(stdout)
+
+    def tcp_connect_many(
+        self, targets: Iterable[tuple[str, int]], count: int, timeout: int = 2
+    ) -> dict[tuple[str, int], TcpConnectResult]:
+        script = TCP_CONNECT_SCRIPT.format(
+            targets=" ".join(shlex.quote(f"{h}:{p}") for h, p in targets),
+            count=count,
+            timeout=timeout,
+        )
+        stdout = self._run(f"bash -c {shlex.quote(script)}", "tcp_connect")
+        with instrumentation.span("shellagent.parse", command="tcp_connect"):
+            return parse_tcp_connect(stdout)
+
+    def tcp_connect(self, host: str, port: int, count: int) -> TcpConnectResult:
+        result = self.tcp_connect_many([(host, port)], count).get((host, port))
+        if result is None:
+            raise RemoteCommandError(f"Failed to resolve {host}")
+        return result
+
+    def mtr_many(self, hosts: Iterable[str], cycles: int) -> dict[str, MtrResult]:
+        script = MTR_SCRIPT.format(
+            hosts=" ".join(shlex.quote(h) for h in hosts),
+            separator=MTR_SEPARATOR,
+            cycles=cycles,
+        )
+        stdout = self._run(f"bash -c {shlex.quote(script)}", "mtr")
+        with instrumentation.span("shellagent.parse", command="mtr"):
+            try:
+                return parse_mtr(stdout)
+            except ValueError:
+                raise RemoteCommandError(f"Failed to parse mtr stdout: {stdout}")
+
+    def mtr(self, host: str, cycles: int) -> MtrResult:
+        result = self.mtr_many([host], cycles).get(host)
+        if result is None:
+            raise RemoteCommandError(f"Failed to trace {host}")
+        return result
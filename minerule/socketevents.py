@@ -1,4 +1,5 @@
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable
 from google.cloud.bigquery import (
     Client,
     SchemaField,
@@ -7,8 +8,10 @@ from google.cloud.bigquery import (
     ScalarQueryParameter,
     SqlTypeNames,
 )
-from datetime import datetime
-from .utiltypes import TimeWindow
+from datetime import date, datetime
+from . import instrumentation
+from .querycache import QueryCache
+from .utiltypes import HostUsage, TimeWindow, host_slots, host_usage
 
 
 class SocketEventRepository:
@@ -18,15 +21,27 @@ class SocketEventRepository:
         SchemaField("access_timestamp", "TIMESTAMP", mode="REQUIRED"),
     ]
     TABLE_NAME = "socketevents"
+    SECONDS_BETWEEN = "TIMESTAMP_DIFF({0}, {1}, SECOND)"
+    SLOT = "DIV(UNIX_SECONDS({0}), {1})"
 
-    def __init__(self, client: Client, dataset_id: str) -> None:
+    def __init__(
+        self,
+        client: Client,
+        dataset_id: str,
+        cache: QueryCache = None,
+        storage_read_threshold: int = None,
+    ) -> None:
         self.client = client
         self.dataset_ref = DatasetReference.from_string(dataset_id, client.project)
+        self.cache = cache
+        self.storage_read_threshold = storage_read_threshold
 
     @classmethod
-    def create_instance(cls, dataset_id: str, project: str = None):
+    def create_instance(
+        cls, dataset_id: str, project: str = None, cache: QueryCache = None
+    ):
         client = Client(project) if project else Client()
-        return cls(client, dataset_id)
+        return cls(client, dataset_id, cache)
 
     def _query_parameter(self, value) -> ScalarQueryParameter:
         type_name: str
@@ -36,25 +51,77 @@ class SocketEventRepository:
             type_name = SqlTypeNames.STRING
         elif type(value) == datetime:
             type_name = SqlTypeNames.TIMESTAMP
+        elif isinstance(value, date):
+            type_name = SqlTypeNames.DATE
         else:
             raise RuntimeError("Can not recognize value type: " + type(value))
         return ScalarQueryParameter(None, type_name, value)
 
     def _query(self, sql: str, result_extractor: Callable, *params):
-        return result_extractor(
-            self.client.query(
+        if not self.cache:
+            return self._run_query(sql, result_extractor, *params)
+        params = self.cache.normalize_all(params)
+        key = self.cache.key(sql, (self.dataset_ref.path,) + params)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._run_query(sql, result_extractor, *params)
+            self.cache.put(key, result)
+        return result
+
+    def _run_query(self, sql: str, result_extractor: Callable, *params):
+        with instrumentation.span("socketevents.query", backend="bigquery"):
+            job = self.client.query(
                 sql,
                 job_config=QueryJobConfig(
                     default_dataset=self.dataset_ref,
                     query_parameters=[self._query_parameter(param) for param in params],
                 ),
             )
-        )
+            result = result_extractor(job)
+        if isinstance(getattr(job, "total_bytes_processed", None), int):
+            instrumentation.count(
+                "socketevents.bytes_processed",
+                job.total_bytes_processed,
+                backend="bigquery",
+            )
+        instrumentation.count("socketevents.rows_read", len(result), backend="bigquery")
+        return result
+
+    def execute(self, sql: str, *params) -> list[tuple]:
+        return self._run_query(sql, lambda job: [tuple(row) for row in job], *params)
+
+    def _extract_hosts(self, job) -> set[str]:
+        if self.storage_read_threshold is None:
+            return {row.host for row in job}
+        rows = job.result()
+        if rows.total_rows < self.storage_read_threshold:
+            return {row.host for row in rows}
+        table = rows.to_arrow(create_bqstorage_client=True)
+        return set(table.column("host").to_pylist())
 
     def aggregate_on_hosts(self, tw: TimeWindow) -> set[str]:
         return self._query(
             "SELECT DISTINCT host from socketevents WHERE access_timestamp >= ? AND access_timestamp < ?",
-            lambda job: {row.host for row in job},
+            self._extract_hosts,
+            datetime.utcfromtimestamp(tw.from_time),
+            datetime.utcfromtimestamp(tw.to_time),
+        )
+
+    def aggregate_host_usage(self, tw: TimeWindow) -> dict[str, HostUsage]:
+        return self._query(
+            "SELECT host, port, COUNT(*) AS accesses FROM socketevents WHERE access_timestamp >= ? AND access_timestamp < ? GROUP BY host, port",
+            lambda job: host_usage([(row.host, row.port, row.accesses) for row in job]),
+            datetime.utcfromtimestamp(tw.from_time),
+            datetime.utcfromtimestamp(tw.to_time),
+        )
+
+    def aggregate_host_slots(
+        self, tw: TimeWindow, diff_seconds: int = 30
+    ) -> dict[str, list[int]]:
+        return self._query(
+            "SELECT DISTINCT host, DIV(UNIX_SECONDS(access_timestamp), ?) AS slot FROM socketevents WHERE access_timestamp >= ? AND access_timestamp < ? ORDER BY host, slot",
+            lambda job: host_slots([(row.host, row.slot) for row in job]),
+            diff_seconds,
             datetime.utcfromtimestamp(tw.from_time),
             datetime.utcfromtimestamp(tw.to_time),
         )
@@ -82,7 +149,20 @@ class SocketEventRepository:
             ) t
             WHERE scoring > 0.95
         """,
-            lambda job: {row.host for row in job},
+            self._extract_hosts,
             host,
             diff_seconds,
         )
+
+    def find_correlated_hosts_many(
+        self, hosts: Iterable[str], diff_seconds: int = 30, max_in_flight: int = 8
+    ) -> dict[str, set[str]]:
+        result = {}
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = {
+                executor.submit(self.find_correlated_hosts, host, diff_seconds): host
+                for host in set(hosts)
+            }
+            for future in as_completed(futures):
+                result[futures[future]] = future.result()
+        return result
@@ -0,0 +1,152 @@
+import itertools
+from typing import Iterable
+
+from . import instrumentation
+from .analyze import RouteEvaluator
+from .hoststatistics import HostStatistic
+from .parallel import ParallelRuleCalculator
+
+
+def _latency(statistic: HostStatistic, vantage: str) -> float:
+    ping = statistic.ping_result(vantage)
+    if ping and ping.packets_received and ping.round_trip_ms_avg is not None:
+        return float(ping.round_trip_ms_avg)
+    tcp = statistic.tcp_connect.get(vantage)
+    if tcp and tcp.successes and tcp.connect_ms_avg is not None:
+        return float(tcp.connect_ms_avg)
+    return None
+
+
+class TopologyReport:
+    def __init__(
+        self,
+        vantages: list[str],
+        coverage: float,
+        expected_latency_ms: float,
+        routes: dict[str, float],
+    ) -> None:
+        self.vantages = vantages
+        self.coverage = coverage
+        self.expected_latency_ms = expected_latency_ms
+        self.routes = routes
+
+    def to_dict(self) -> dict:
+        return {
+            "vantages": self.vantages,
+            "vms": len(self.vantages),
+            "coverage": self.coverage,
+            "expectedLatencyMs": self.expected_latency_ms,
+            "routes": self.routes,
+        }
+
+
+class TopologySimulator:
+    def __init__(
+        self,
+        clusters: Iterable[list[HostStatistic]],
+        weights: dict[str, float] = None,
+    ) -> None:
+        clusters = list(clusters)
+        weights = weights or {}
+        self.vantages = ParallelRuleCalculator.columns(
+            {s.host: s for cluster in clusters for s in cluster}
+        )
+        self.index = {v: i for i, v in enumerate(self.vantages)}
+        self.groups: dict[tuple, list] = {}
+        self.total_weight = 0.0
+        width = len(self.vantages)
+        for cluster in clusters:
+            scores = RouteEvaluator.continent_scores(cluster, weights)
+            order = list(scores)
+            ranking = tuple(
+                self.index[v]
+                for v in sorted(
+                    (v for v in order if scores[v] > 0),
+                    key=lambda v: (-scores[v], order.index(v)),
+                )
+            )
+            group = self.groups.setdefault(ranking, [0.0, [0.0] * width, [0.0] * width])
+            for s in cluster:
+                weight = float(weights.get(s.host, 1.0))
+                self.total_weight += weight
+                group[0] += weight
+                for i in ranking:
+                    latency = _latency(s, self.vantages[i])
+                    if latency is not None:
+                        group[1][i] += weight * latency
+                        group[2][i] += weight
+
+    def mask(self, vantages: Iterable[str]) -> int:
+        result = 0
+        for v in vantages:
+            if v not in self.index:
+                raise ValueError(f"No statistics for vantage {v}")
+            result |= 1 << self.index[v]
+        return result
+
+    def candidates(self, required: Iterable[str] = ("central",)) -> list[int]:
+        required = self.mask(v for v in required if v in self.index)
+        optional = [1 << i for i in range(len(self.vantages)) if not required >> i & 1]
+        return [
+            required | sum(c)
+            for n in range(len(optional) + 1)
+            for c in itertools.combinations(optional, n)
+        ]
+
+    def _accumulate(self, masks: list[int]) -> dict[int, list]:
+        width = len(self.vantages)
+        totals = {m: [0.0, [0.0] * width, [0.0] * width, [0.0] * width] for m in masks}
+        for ranking, (weight, latency_sums, latency_weights) in self.groups.items():
+            for mask in masks:
+                i = next((i for i in ranking if mask >> i & 1), None)
+                if i is None:
+                    continue
+                total = totals[mask]
+                total[0] += weight
+                total[1][i] += weight
+                total[2][i] += latency_sums[i]
+                total[3][i] += latency_weights[i]
+        return totals
+
+    def evaluate(
+        self,
+        topologies: Iterable[Iterable[str]] = None,
+        required: Iterable[str] = ("central",),
+    ) -> list[TopologyReport]:
+        masks = (
+            self.candidates(required)
+            if topologies is None
+            else [self.mask(t) for t in topologies]
+        )
+        with instrumentation.span("topology.evaluate", topologies=len(masks)):
+            totals = self._accumulate(masks)
+        reports = []
+        for mask in masks:
+            covered, routed, latency_sums, latency_weights = totals[mask]
+            measured = sum(latency_weights)
+            reports.append(
+                TopologyReport(
+                    [v for i, v in enumerate(self.vantages) if mask >> i & 1],
+                    covered / self.total_weight if self.total_weight else 0.0,
+                    sum(latency_sums) / measured if measured else None,
+                    {
+                        self.vantages[i]: routed[i] / self.total_weight
+                        for i in range(len(self.vantages))
+                        if routed[i]
+                    },
+                )
+            )
+        if topologies is not None:
+            return reports
+        reports.sort(
+            key=lambda r: (
+                -r.coverage,
+                (
+                    float("inf")
+                    if r.expected_latency_ms is None
+                    else r.expected_latency_ms
+                ),
+                len(r.vantages),
+            )
+        )
+        return reports
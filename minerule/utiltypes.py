@@ -17,3 +17,37 @@ class TimeWindow:
             current_time - datetime.timedelta(days=days_delta).total_seconds(),
             current_time,
         )
+
+
+class HostUsage:
+    def __init__(self, accesses: int = 0, ports: dict[int, int] = None) -> None:
+        self.accesses = accesses
+        self.ports = ports or {}
+
+    @property
+    def top_port(self) -> int:
+        if not self.ports:
+            return None
+        return min(self.ports, key=lambda p: (-self.ports[p], p))
+
+    def add(self, port: int, accesses: int) -> None:
+        self.accesses += accesses
+        self.ports[port] = self.ports.get(port, 0) + accesses
+
+
+def host_usage(rows) -> dict[str, HostUsage]:
+    result = {}
+    for host, port, accesses in rows:
+        result.setdefault(host, HostUsage()).add(port, accesses)
+    return result
+
+
+def hottest_first(usage: dict[str, HostUsage]) -> list[str]:
+    return sorted(usage, key=lambda h: (-usage[h].accesses, h))
+
+
+def host_slots(rows) -> dict[str, list[int]]:
+    result = {}
+    for host, slot in rows:
+        result.setdefault(host, []).append(slot)
+    return result
@@ -4,13 +4,20 @@ from minerule.analyze import (
     RouteEvaluator,
     HostStatisticsRefreshRunner,
     RouteRuleAnalyzer,
+    RuleCursor,
     is_ip_address,
     is_same_top_domain,
 )
 from unittest.mock import MagicMock
 from minerule.hoststatistics import HostStatistic, HostStatisticRepository
-from minerule.shellagent import PingResult, RemoteCommandError, ShellAgent
+from minerule.shellagent import (
+    PingResult,
+    RemoteCommandError,
+    ShellAgent,
+    TcpConnectResult,
+)
 from minerule.socketevents import SocketEventRepository
+from minerule.utiltypes import HostUsage
 
 
 def test_is_ip_address():
@@ -70,6 +77,127 @@ class TestHostStatisticsRefreshRunner:
         runner.refresh("baidu.com", 10)
         repo.save.assert_called_once()
 
+    def test_refresh_all_deduplicates_ips(
+        self,
+        setup: tuple[HostStatisticRepository, ShellAgent, ShellAgent],
+    ):
+        (repo, central_vm, domestic_vm) = setup
+        repo.exists = MagicMock(return_value=False)
+        repo.ip_exists = MagicMock(return_value=False)
+        ips = {"a.com": "1.1.1.1", "b.com": "1.1.1.1", "c.com": "2.2.2.2"}
+        central_vm.resolve_many = MagicMock(
+            side_effect=lambda hosts: {h: ips[h] for h in hosts}
+        )
+        central_vm.ping_many = MagicMock(
+            return_value={
+                "1.1.1.1": PingResult("1.1.1.1", 4, 4),
+                "2.2.2.2": PingResult("2.2.2.2", 4, 2),
+            }
+        )
+        domestic_vm.resolve_many = MagicMock(return_value={"a.com": "3.3.3.3"})
+        domestic_vm.ping_many = MagicMock(side_effect=RemoteCommandError("error"))
+        runner = HostStatisticsRefreshRunner(repo, central_vm, domestic_vm)
+        runner.refresh_all(["a.com", "b.com", "c.com", "1.1.1.1"], 4, batch_size=2)
+        assert [c.args[0] for c in central_vm.ping_many.call_args_list] == [
+            ["1.1.1.1"],
+            ["2.2.2.2"],
+        ]
+        saved = {c.args[0].host: c.args[0] for c in repo.save.call_args_list}
+        assert set(saved) == {"a.com", "b.com", "c.com", "1.1.1.1"}
+        assert saved["b.com"].central.packets_received == 4
+        assert saved["c.com"].central.destination_ip == "2.2.2.2"
+        assert saved["1.1.1.1"].central.destination_ip == "1.1.1.1"
+        assert saved["a.com"].domestic is None
+
+    def test_refresh_all_retries_failed_ips(
+        self,
+        setup: tuple[HostStatisticRepository, ShellAgent, ShellAgent],
+    ):
+        (repo, central_vm, domestic_vm) = setup
+        repo.exists = MagicMock(return_value=False)
+        repo.ip_exists = MagicMock(return_value=False)
+        for vm in (central_vm, domestic_vm):
+            vm.resolve_many = MagicMock(
+                side_effect=lambda hosts: {h: "1.1.1.1" for h in hosts}
+            )
+        central_vm.ping_many = MagicMock(
+            side_effect=[
+                RemoteCommandError("error"),
+                {"1.1.1.1": PingResult("1.1.1.1", 4, 4)},
+            ]
+        )
+        domestic_vm.ping_many = MagicMock(
+            return_value={"1.1.1.1": PingResult("1.1.1.1", 4, 4)}
+        )
+        runner = HostStatisticsRefreshRunner(repo, central_vm, domestic_vm)
+        runner.refresh_all(["a.com", "b.com"], 4, batch_size=1)
+        assert central_vm.ping_many.call_count == 2
+        assert domestic_vm.ping_many.call_count == 1
+        saved = {c.args[0].host: c.args[0] for c in repo.save.call_args_list}
+        assert saved["a.com"].central is None
+        assert saved["b.com"].central.packets_received == 4
+
+    def test_refresh_all_stops_at_deadline(
+        self,
+        setup: tuple[HostStatisticRepository, ShellAgent, ShellAgent],
+    ):
+        (repo, central_vm, domestic_vm) = setup
+        repo.exists = MagicMock(return_value=False)
+        repo.ip_exists = MagicMock(return_value=False)
+        now = [0.0]
+
+        def ping_many(ips, count):
+            now[0] += 5.0
+            return {"1.1.1.1": PingResult("1.1.1.1", 4, 4)}
+
+        for vm in (central_vm, domestic_vm):
+            vm.resolve_many = MagicMock(
+                side_effect=lambda hosts: {h: "1.1.1.1" for h in hosts}
+            )
+            vm.ping_many = MagicMock(side_effect=ping_many)
+        runner = HostStatisticsRefreshRunner(repo, central_vm, domestic_vm)
+        runner.clock = lambda: now[0]
+        pending = runner.refresh_all(
+            ["a.com", "b.com", "c.com"], 4, batch_size=2, deadline=3.0
+        )
+        assert pending == ["a.com", "b.com", "c.com"]
+        central_vm.ping_many.assert_called_once()
+        domestic_vm.ping_many.assert_not_called()
+        repo.save.assert_not_called()
+
+    def test_refresh_all_tcp_fallback(
+        self,
+        setup: tuple[HostStatisticRepository, ShellAgent, ShellAgent],
+        other_vm: ShellAgent,
+    ):
+        (repo, central_vm, domestic_vm) = setup
+        repo.exists = MagicMock(return_value=False)
+        repo.ip_exists = MagicMock(return_value=False)
+        resolved = {"a.com": "1.1.1.1", "b.com": "1.1.1.1"}
+        for vm in (central_vm, domestic_vm, other_vm):
+            vm.resolve_many = MagicMock(return_value=resolved)
+        central_vm.ping_many = MagicMock(
+            return_value={"1.1.1.1": PingResult("1.1.1.1", 4, 4)}
+        )
+        domestic_vm.ping_many = MagicMock(side_effect=RemoteCommandError("error"))
+        other_vm.ping_many = MagicMock(
+            return_value={"1.1.1.1": PingResult("1.1.1.1", 4, 0)}
+        )
+        probe = TcpConnectResult("1.1.1.1", 443, 4, 4)
+        domestic_vm.tcp_connect_many = MagicMock(
+            return_value={("a.com", 443): probe, ("b.com", 443): probe}
+        )
+        other_vm.tcp_connect_many = MagicMock(return_value={})
+        runner = HostStatisticsRefreshRunner(repo, central_vm, domestic_vm, ap=other_vm)
+        runner.refresh_all(["a.com", "b.com"], 4, {"a.com": 443, "b.com": 443})
+        central_vm.tcp_connect_many.assert_not_called()
+        domestic_vm.tcp_connect_many.assert_called_once_with(
+            [("a.com", 443), ("b.com", 443)], count=4
+        )
+        assert repo.save.call_count == 2
+        saved = repo.save.call_args[0][0]
+        assert saved.tcp_connect == {"domestic": probe}
+
 
 class TestRouteEvaluator:
     @classmethod
@@ -135,6 +263,40 @@ class TestRouteEvaluator:
         )
         assert RouteEvaluator.determine_route_continent([s1, s2]) == "domestic"
 
+    def test_determine_route_continent_tcp_fallback(self):
+        s1 = self.statistic(
+            central=self.ping_result(10, 5),
+            tcp_connect={"domestic": TcpConnectResult("0.0.0.0", 443, 4, 4)},
+        )
+        s2 = self.statistic(
+            central=self.ping_result(10, 5), domestic=self.ping_result(10, 9)
+        )
+        assert RouteEvaluator.determine_route_continent([s1, s2]) == "domestic"
+        s3 = self.statistic(
+            central=self.ping_result(10, 5),
+            tcp_connect={"ap": TcpConnectResult("0.0.0.0", 443, 4, 4)},
+        )
+        assert RouteEvaluator.determine_route_continent([s3]) == "ap"
+
+    def test_determine_route_continent_weighted(self):
+        s1 = HostStatistic(
+            "hot.com",
+            decimal.Decimal("16000000"),
+            False,
+            central=self.ping_result(10, 5),
+            domestic=self.ping_result(10, 10),
+        )
+        s2 = HostStatistic(
+            "cold.com",
+            decimal.Decimal("16000000"),
+            False,
+            central=self.ping_result(10, 10),
+            domestic=self.ping_result(10, 2),
+        )
+        f = RouteEvaluator.determine_route_continent
+        assert f([s1, s2]) == "central"
+        assert f([s1, s2], {"hot.com": 100, "cold.com": 1}) == "domestic"
+
 
 class TestRouteRuleAnalyzer:
     @pytest.fixture
@@ -222,3 +384,95 @@ class TestRouteRuleAnalyzer:
         assert result[0].host == "0.0.0.0"
         assert result[1].host == "1.1.1.1"
         assert result[2].host == "2.2.2.2"
+
+    def test_find_related_hosts_concurrent_correlation(
+        self,
+        setup: tuple[SocketEventRepository, HostStatisticRepository, RouteRuleAnalyzer],
+    ):
+        (socket_event_repository, host_statistic_repository, analyzer) = setup
+        analyzer.max_in_flight_queries = 4
+        socket_event_repository.find_correlated_hosts_many.side_effect = [
+            {"baidu.com": {"api.bing.com"}},
+            {"api.bing.com": set()},
+        ]
+        host_statistic_repository.find.return_value = self.statistic(
+            "api.bing.com", False
+        )
+        s = self.statistic("baidu.com", False)
+        result = analyzer.find_related_hosts(s, {"api.bing.com", "others.com"})
+        assert [e.host for e in result] == ["baidu.com", "api.bing.com"]
+        socket_event_repository.find_correlated_hosts.assert_not_called()
+        assert socket_event_repository.find_correlated_hosts_many.call_count == 2
+
+    def test_calculate_rules_hottest_first(
+        self,
+        setup: tuple[SocketEventRepository, HostStatisticRepository, RouteRuleAnalyzer],
+    ):
+        (socket_event_repository, host_statistic_repository, analyzer) = setup
+        analyzer.refresh_runner = MagicMock(other_vms={})
+        socket_event_repository.aggregate_host_usage.return_value = {
+            "cold.com": HostUsage(1, {80: 1}),
+            "hot.org": HostUsage(50, {443: 40, 80: 10}),
+            "warm.net": HostUsage(5, {443: 5}),
+        }
+        socket_event_repository.find_correlated_hosts.return_value = set()
+        seeds = []
+
+        def find(host):
+            seeds.append(host)
+            return HostStatistic(
+                host, decimal.Decimal(), False, domestic=PingResult("0.0.0.0", 4, 4)
+            )
+
+        host_statistic_repository.find.side_effect = find
+        rules = analyzer.calculate_rules(1, 4)
+        analyzer.refresh_runner.refresh_all.assert_called_once_with(
+            ["hot.org", "warm.net", "cold.com"],
+            4,
+            {"cold.com": 80, "hot.org": 443, "warm.net": 443},
+            hot=0,
+        )
+        assert seeds == ["hot.org", "warm.net", "cold.com"]
+        assert rules == {"domestic": ["hot.org", "warm.net", "cold.com"]}
+
+    def test_calculate_rules_until_deadline(
+        self,
+        setup: tuple[SocketEventRepository, HostStatisticRepository, RouteRuleAnalyzer],
+    ):
+        (socket_event_repository, host_statistic_repository, analyzer) = setup
+        analyzer.refresh_runner = MagicMock(other_vms={})
+        socket_event_repository.aggregate_host_usage.return_value = {
+            "a.com": HostUsage(3, {443: 3}),
+            "b.com": HostUsage(2, {443: 2}),
+            "c.com": HostUsage(1, {443: 1}),
+        }
+        socket_event_repository.find_correlated_hosts.return_value = set()
+        host_statistic_repository.find.side_effect = lambda h: HostStatistic(
+            h, decimal.Decimal(), False, domestic=PingResult("0.0.0.0", 4, 4)
+        )
+        now = [0.0]
+
+        def refresh_all(batch, *args, **kwargs):
+            now[0] += 3.0
+            return ["b.com"] if "b.com" in batch else []
+
+        analyzer.refresh_runner.refresh_all.side_effect = refresh_all
+        rules, cursor = analyzer.calculate_rules_until(
+            10.0, 4, cursor=None, batch_size=1, clock=lambda: now[0], refresh_share=0.8
+        )
+        assert rules == {"domestic": ["a.com"]}
+        assert cursor.remaining == ["b.com", "c.com"]
+        assert [
+            c[0][0] for c in analyzer.refresh_runner.refresh_all.call_args_list
+        ] == [["a.com"], ["b.com"]]
+        assert {
+            c[1]["deadline"] for c in analyzer.refresh_runner.refresh_all.call_args_list
+        } == {8.0}
+        analyzer.refresh_runner.refresh_all.side_effect = None
+        cursor = RuleCursor.from_dict(cursor.to_dict())
+        rules, cursor = analyzer.calculate_rules_until(None, 4, cursor=cursor)
+        assert rules == {"domestic": ["a.com", "b.com", "c.com"]}
+        assert cursor is None
+        analyzer.refresh_runner.refresh_all.assert_called_with(
+            ["b.com", "c.com"], 4, {"a.com": 443, "b.com": 443, "c.com": 443}, hot=0
+        )
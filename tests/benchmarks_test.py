@@ -0,0 +1,76 @@
+import csv
+import json
+import pathlib
+from datetime import datetime
+
+from benchmarks.__main__ import main
+from benchmarks.fakes import InMemorySocketEventRepository, InMemoryTable
+from benchmarks.workloads import SyntheticTopology
+from minerule.hoststatistics import HostStatistic, HostStatisticRepository
+from minerule.shellagent import PingResult
+from minerule.utiltypes import TimeWindow
+
+
+def socket_events() -> InMemorySocketEventRepository:
+    with open(pathlib.Path(__file__).parent / "socketevents.csv") as fp:
+        return InMemorySocketEventRepository(
+            [
+                (
+                    row["host"],
+                    datetime.fromisoformat(
+                        row["access_timestamp"].replace("Z", "+00:00")
+                    ).timestamp(),
+                )
+                for row in csv.DictReader(fp)
+            ]
+        )
+
+
+def test_in_memory_socket_event_repository():
+    repo = socket_events()
+    hosts = repo.aggregate_on_hosts(TimeWindow(946684801, 946684833))
+    assert {"foo1", "bar1", "foo2"} == hosts
+    assert repo.find_correlated_hosts("foo1", 1) == {"bar1"}
+    assert repo.find_correlated_hosts("bar1", 1) == {"foo1"}
+    assert not repo.find_correlated_hosts("foo2", 1)
+
+
+def test_in_memory_table():
+    repo = HostStatisticRepository(InMemoryTable())
+    repo.save(HostStatistic("foo.com", 1, False, central=PingResult("0.0.0.0", 1, 1)))
+    assert repo.exists("foo.com")
+    assert not repo.exists("bar.com")
+    assert repo.ip_exists("0.0.0.0")
+    assert repo.find_by_ip("0.0.0.0")[0].host == "foo.com"
+
+
+def test_synthetic_topology():
+    topology = SyntheticTopology(100, seed=1)
+    assert len(topology.hosts) == 100
+    assert all(topology.resolve(h) for h in topology.hosts)
+    assert SyntheticTopology(100, seed=1).host_ips == topology.host_ips
+
+
+def test_main(tmp_path):
+    output = tmp_path / "bench.jsonl"
+    main(["socketevents.memory", "refresh", "--hosts", "50", "--output", str(output)])
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["benchmark"] for r in results] == ["socketevents.memory", "refresh"]
+    assert results[1]["calls"]["central_vm"]["ping_many"] == 1
+    assert all(r["wall_time_s"] >= 0 and r["peak_memory_bytes"] > 0 for r in results)
+
+
+def test_rulematcher(tmp_path):
+    output = tmp_path / "bench.jsonl"
+    main(["rulematcher", "--hosts", "50", "--lookups", "100", "--output", str(output)])
+    result = json.loads(output.read_text())
+    assert result["lookups"] == 100
+    assert result["file_size_bytes"] > 0
+
+
+def test_cooccurrence(tmp_path):
+    output = tmp_path / "bench.jsonl"
+    main(["cooccurrence", "--hosts", "50", "--output", str(output)])
+    result = json.loads(output.read_text())
+    assert [t["bands"] for t in result["tradeoff"]] == [8, 16, 32, 64]
+    assert all(t["precision"] == 1.0 for t in result["tradeoff"])
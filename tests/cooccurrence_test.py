@@ -0,0 +1,70 @@
+import pytest
+from unittest.mock import MagicMock
+
+from benchmarks.fakes import InMemorySocketEventRepository
+from benchmarks.workloads import SyntheticTopology
+from minerule.cooccurrence import (
+    CooccurrenceIndex,
+    MinHasher,
+    SketchedSocketEventRepository,
+    recall_precision,
+)
+from minerule.utiltypes import TimeWindow
+
+WINDOW = TimeWindow(0, 86400)
+
+
+def test_minhash_signature():
+    hasher = MinHasher(32, seed=1)
+    assert hasher.signature([1, 2, 3]) == hasher.signature([3, 2, 1])
+    assert hasher.signature([1, 2, 3]) != hasher.signature([4, 5, 6])
+    assert len(hasher.signature([])) == 32
+
+
+def test_index_candidates():
+    index = CooccurrenceIndex(
+        {"foo1": [1, 11, 21], "bar1": [1, 11, 21], "foo2": [23], "foo6": [500, 900]},
+        num_perm=8,
+        bands=8,
+    )
+    assert index.candidates("foo1") == {"bar1"}
+    assert index.candidates("foo6") == set()
+    assert "foo2" not in index.keys
+    with pytest.raises(ValueError):
+        CooccurrenceIndex({}, num_perm=10, bands=4)
+
+
+def test_sketch_matches_exact_path():
+    topology = SyntheticTopology(300, seed=3)
+    repo = InMemorySocketEventRepository(topology.socket_events(0, 86000, 300))
+    exact = repo.find_correlated_hosts_many(topology.hosts)
+    sketch = SketchedSocketEventRepository(repo, WINDOW, num_perm=64, bands=64)
+    approximate = sketch.find_correlated_hosts_many(topology.hosts)
+    recall, precision = recall_precision(approximate, exact)
+    assert precision == 1.0
+    assert recall > 0.9
+    assert sketch.aggregate_on_hosts(WINDOW) == repo.aggregate_on_hosts(WINDOW)
+
+
+def test_sketch_verifies_only_hosts_with_candidates():
+    repo = InMemorySocketEventRepository(
+        [("foo1", 0), ("bar1", 50), ("foo1", 1000), ("bar1", 1050), ("foo2", 5000)]
+    )
+    exact = MagicMock(wraps=repo.find_correlated_hosts_many)
+    repo.find_correlated_hosts_many = exact
+    sketch = SketchedSocketEventRepository(repo, WINDOW, num_perm=8, bands=8)
+    assert sketch.find_correlated_hosts("foo1", 10) == set()
+    exact.assert_not_called()
+    assert sketch.find_correlated_hosts_many(["foo1", "foo2"], 60) == {
+        "foo1": {"bar1"},
+        "foo2": set(),
+    }
+    exact.assert_called_once_with(["foo1"], 60, 1)
+    assert sketch.find_correlated_hosts("bar1", 120) == {"foo1"}
+    assert sorted(sketch._indexes) == [10, 60, 120]
+
+
+def test_recall_precision():
+    assert recall_precision({"a": {"b"}}, {"a": {"b", "c"}}) == (0.5, 1.0)
+    assert recall_precision({"a": {"b", "d"}}, {"a": {"b"}}) == (1.0, 0.5)
+    assert recall_precision({}, {}) == (1.0, 1.0)
@@ -1,7 +1,8 @@
+import threading
 import time
 from decimal import Decimal
 import pytest
-from minerule.shellagent import PingResult
+from minerule.shellagent import MtrHop, MtrResult, PingResult, TcpConnectResult
 from minerule.hoststatistics import HostStatistic, HostStatisticRepository
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
@@ -132,6 +133,62 @@ class TestHostStatisticRepository:
         assert v.other_continents["NA"].packets_received == 3
         assert not repo.find_by_ip("3.3.3.3")
 
+    def test_probe_round_trip(self, foo: HostStatistic):
+        foo.tcp_connect = {
+            "central": TcpConnectResult("0.0.0.0", 443, 4, 3, Decimal("1.5"))
+        }
+        foo.mtr = {
+            "ap": MtrResult("foo.com", [MtrHop(1, "10.0.0.1", Decimal("100.0"), 10)])
+        }
+        v = HostStatisticRepository._dict_to_host_statistic(
+            HostStatisticRepository._host_statistic_to_dict(foo)
+        )
+        assert v.tcp_connect["central"].port == 443
+        assert v.tcp_connect["central"].successes == 3
+        assert v.tcp_connect["central"].connect_ms_min == Decimal("1.5")
+        assert v.tcp_connect["central"].connect_ms_avg is None
+        assert v.mtr["ap"].hops[0].host == "10.0.0.1"
+        assert v.mtr["ap"].hops[0].sent == 10
+        assert not v.mtr["ap"].reached
+        assert not MtrResult("foo.com", [MtrHop(1, "10.0.0.1", None, 10)]).reached
+        assert v.ip_addresses() == {"0.0.0.0"}
+
+    @pytest.fixture
+    def paged(self) -> HostStatisticRepository:
+        from benchmarks.fakes import InMemoryTable
+
+        repo = HostStatisticRepository(InMemoryTable(page_size=3))
+        for i in range(20):
+            repo.save(
+                HostStatistic(
+                    f"h{i}.com",
+                    Decimal(i),
+                    False,
+                    central=PingResult("9.9.9.9" if i == 17 else f"10.0.0.{i}"),
+                )
+            )
+        return repo
+
+    @pytest.mark.parametrize("segments", [1, 4])
+    def test_iter_scan_pages(self, paged: HostStatisticRepository, segments: int):
+        hosts = [s.host for s in paged.iter_scan(total_segments=segments)]
+        assert sorted(hosts) == sorted(f"h{i}.com" for i in range(20))
+        paged.total_segments = segments
+        assert paged.ip_exists("9.9.9.9")
+        assert not paged.ip_exists("8.8.8.8")
+        assert [s.host for s in paged.find_by_ip("9.9.9.9")] == ["h17.com"]
+
+    def test_iter_scan_early_exit(self, paged: HostStatisticRepository):
+        scans = []
+        scan = paged.table.scan
+        paged.table.scan = lambda **kwargs: scans.append(kwargs) or scan(**kwargs)
+        next(paged.iter_scan())
+        assert len(scans) == 1
+        iterator = paged.iter_scan(total_segments=4)
+        next(iterator)
+        iterator.close()
+        assert not [t for t in threading.enumerate() if "hoststatistics" in t.name]
+
 
 class TestHostStatistic:
     def test_no_ip_addresses(self, foo: HostStatistic):
@@ -165,3 +222,8 @@ class TestHostStatistic:
         s = foo.ip_addresses()
         assert type(s) == set
         assert s == {"0.0.0.0", "1.1.1.1"}
+
+    def test_default_continents_not_shared(self):
+        s1 = HostStatistic("a", Decimal(0), False)
+        s1.other_continents["ap"] = PingResult("0.0.0.0")
+        assert HostStatistic("b", Decimal(0), False).other_continents == {}
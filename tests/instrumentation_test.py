@@ -0,0 +1,76 @@
+import logging
+from unittest.mock import MagicMock
+import pytest
+from minerule import instrumentation
+from minerule.hoststatistics import HostStatisticRepository
+from minerule.instrumentation import LogSink, PrometheusSink, Sink, prometheus_text
+
+
+@pytest.fixture
+def recorder():
+    yield instrumentation.enable()
+    instrumentation.disable()
+
+
+def test_disabled():
+    instrumentation.disable()
+    with instrumentation.span("foo"):
+        instrumentation.count("bar")
+    assert instrumentation.recorder() is None
+    assert instrumentation.span("foo") is instrumentation.span("bar")
+
+
+def test_span(recorder: instrumentation.Recorder):
+    with instrumentation.span("foo", vm="central"):
+        pass
+    with pytest.raises(ValueError):
+        with instrumentation.span("foo", vm="central"):
+            raise ValueError()
+    histogram = recorder.histograms[("foo_seconds", (("vm", "central"),))]
+    assert histogram.count == 2
+    assert recorder.counters[("foo_errors", (("vm", "central"),))] == 1
+
+
+def test_counters(recorder: instrumentation.Recorder):
+    instrumentation.count("foo")
+    instrumentation.count("foo", 2)
+    instrumentation.gauge("bar", 5, vm="ap")
+    assert recorder.counters[("foo", ())] == 3
+    assert recorder.gauges[("bar", (("vm", "ap"),))] == 5
+
+
+def test_sinks(caplog, tmp_path):
+    sink = MagicMock(spec=Sink)
+    path = tmp_path / "metrics.prom"
+    instrumentation.enable(sink, LogSink(), PrometheusSink(str(path)))
+    with caplog.at_level(logging.INFO):
+        with instrumentation.span("foo", vm="central"):
+            instrumentation.count("bar")
+    instrumentation.flush()
+    instrumentation.disable()
+    sink.on_span.assert_called_once()
+    sink.on_metric.assert_any_call("counter", "bar", 1, {})
+    sink.flush.assert_called_once()
+    assert '"span": "foo"' in caplog.text
+    assert "minerule_bar_total 1" in path.read_text()
+
+
+def test_prometheus_text(recorder: instrumentation.Recorder):
+    instrumentation.observe("foo_seconds", 0.002, vm="central")
+    instrumentation.count("bar", 3)
+    text = prometheus_text(recorder)
+    assert "# TYPE minerule_bar_total counter\nminerule_bar_total 3\n" in text
+    assert 'minerule_foo_seconds_bucket{vm="central",le="0.001"} 0' in text
+    assert 'minerule_foo_seconds_bucket{vm="central",le="0.005"} 1' in text
+    assert 'minerule_foo_seconds_bucket{vm="central",le="+Inf"} 1' in text
+    assert 'minerule_foo_seconds_count{vm="central"} 1' in text
+
+
+def test_repository_metrics(recorder: instrumentation.Recorder):
+    table = MagicMock()
+    table.scan.return_value = {"Count": 1, "ScannedCount": 10}
+    HostStatisticRepository(table).ip_exists("0.0.0.0")
+    labels = (("operation", "ip_exists"),)
+    assert recorder.counters[("hoststatistics.items_scanned", labels)] == 10
+    assert recorder.counters[("hoststatistics.items_read", labels)] == 1
+    assert recorder.histograms[("hoststatistics.scan_seconds", labels)].count == 1
@@ -0,0 +1,56 @@
+import pathlib
+import pytest
+from minerule.localevents import DuckDBSocketEventRepository
+from minerule.utiltypes import TimeWindow
+
+CSV_PATH = str(pathlib.Path(__file__).parent / "socketevents.csv")
+
+
+@pytest.fixture(scope="module")
+def repo() -> DuckDBSocketEventRepository:
+    repo = DuckDBSocketEventRepository.create_instance(CSV_PATH)
+    yield repo
+    repo.connection.close()
+
+
+@pytest.fixture
+def parquet_repo(tmp_path) -> DuckDBSocketEventRepository:
+    path = tmp_path / "socketevents.parquet"
+    DuckDBSocketEventRepository.create_instance(CSV_PATH).connection.execute(
+        f"COPY socketevents TO '{path}' (FORMAT PARQUET)"
+    )
+    repo = DuckDBSocketEventRepository.create_instance(str(path))
+    yield repo
+    repo.connection.close()
+
+
+class TestDuckDBSocketEventRepository:
+    def test_aggregate_on_hosts(self, repo: DuckDBSocketEventRepository):
+        hosts = repo.aggregate_on_hosts(TimeWindow(946684801, 946684833))
+        assert {"foo1", "bar1", "foo2"} == hosts
+
+    def test_find_correlated_hosts(self, repo: DuckDBSocketEventRepository):
+        assert repo.find_correlated_hosts("foo1", 1) == {"bar1"}
+        assert repo.find_correlated_hosts("bar1", 1) == {"foo1"}
+        assert not repo.find_correlated_hosts("foo2", 1)
+
+    def test_aggregate_host_usage(self, repo: DuckDBSocketEventRepository):
+        usage = repo.aggregate_host_usage(TimeWindow(946684801, 946684833))
+        assert {h: u.top_port for h, u in usage.items()} == {
+            "foo1": 443,
+            "bar1": 443,
+            "foo2": 443,
+        }
+        assert all(u.accesses > 0 for u in usage.values())
+
+    def test_aggregate_host_slots(self, repo: DuckDBSocketEventRepository):
+        slots = repo.aggregate_host_slots(TimeWindow(946684801, 946684833), 10)
+        assert slots["foo1"] == [94668480, 94668481, 94668482]
+        assert slots["foo2"] == [94668482]
+        slots = repo.aggregate_host_slots(TimeWindow(946684801, 946684833), 60)
+        assert slots["foo1"] == [15778080]
+
+    def test_parquet_source(self, parquet_repo: DuckDBSocketEventRepository):
+        hosts = parquet_repo.aggregate_on_hosts(TimeWindow(946684801, 946684833))
+        assert {"foo1", "bar1", "foo2"} == hosts
+        assert parquet_repo.find_correlated_hosts("foo1", 1) == {"bar1"}
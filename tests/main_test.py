@@ -0,0 +1,147 @@
+import base64
+import datetime
+import json
+import pathlib
+import subprocess
+import sys
+from unittest.mock import MagicMock
+import pytest
+import main
+
+
+@pytest.fixture
+def factories(monkeypatch):
+    mocks = {
+        "socketevents": MagicMock(),
+        "hoststatistics": MagicMock(),
+        "shellagent": MagicMock(),
+    }
+    monkeypatch.setattr(main, "_instances", {})
+    monkeypatch.setattr(main, "_new_socket_event_repository", mocks["socketevents"])
+    monkeypatch.setattr(main, "_new_host_statistic_repository", mocks["hoststatistics"])
+    monkeypatch.setattr(main, "_new_shell_agent", mocks["shellagent"])
+    mocks["socketevents"].return_value.aggregate_on_hosts.return_value = set()
+    mocks["socketevents"].return_value.aggregate_host_usage.return_value = {}
+    return mocks
+
+
+def event(**args) -> dict:
+    return {"data": base64.b64encode(json.dumps(args).encode("utf-8"))}
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, main; "
+        "print([m for m in ('fabric', 'boto3', 'google.cloud.bigquery', 'tldextract') if m in sys.modules])"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=pathlib.Path(__file__).parent.parent,
+        text=True,
+    )
+    assert output.strip() == "[]"
+
+
+def test_handle_event_reuses_clients(factories):
+    e = event(
+        HostsQuery={"dataset_id": "foo", "days_delta": 2},
+        Proxies={
+            "central_vm": {"host": "1.1.1.1", "user": "root"},
+            "domestic_vm": {"host": "2.2.2.2", "user": "root"},
+            "other_vms": {"ap": {"host": "3.3.3.3", "user": "root"}},
+        },
+        ping_count=5,
+    )
+    assert main.handle_event(e, None) == {"domestic": [], "ap": []}
+    assert main.handle_event(e, None) == {"domestic": [], "ap": []}
+    factories["socketevents"].assert_called_once_with("foo", None)
+    factories["hoststatistics"].assert_called_once_with("hoststatistics")
+    assert factories["shellagent"].call_count == 3
+
+
+def test_handle_diff_event(factories):
+    from benchmarks.fakes import InMemoryTable
+    from minerule.rulediffs import RuleSnapshotRepository
+
+    table = InMemoryTable("ruleSet", "host")
+    main._instances[("rulesnapshots", "rulesnapshots")] = RuleSnapshotRepository(table)
+    e = event(
+        HostsQuery={"dataset_id": "foo"},
+        Proxies={
+            "central_vm": {"host": "1.1.1.1", "user": "root"},
+            "domestic_vm": {"host": "2.2.2.2", "user": "root"},
+        },
+        ping_count=1,
+    )
+    diff = main.handle_diff_event(e, None)
+    assert diff["fromVersion"] == 0 and diff["toVersion"] == 0
+    assert not diff["added"]
+
+
+def test_handle_event_with_budget(factories):
+    e = event(
+        HostsQuery={"dataset_id": "foo"},
+        Proxies={
+            "central_vm": {"host": "1.1.1.1", "user": "root"},
+            "domestic_vm": {"host": "2.2.2.2", "user": "root"},
+        },
+        Budget={"seconds": 60},
+        ping_count=1,
+    )
+    assert main.handle_event(e, None) == {"rules": {"domestic": []}, "cursor": None}
+
+
+def test_handle_rollup_event(factories):
+    repository = factories["socketevents"].return_value
+    repository.execute.return_value = [(None,)]
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=3)).date()
+    e = event(HostsQuery={"dataset_id": "foo"}, Rollups={"since": since.isoformat()})
+    assert main.handle_rollup_event(e, None) == [
+        (since + datetime.timedelta(days=i)).isoformat() for i in range(3)
+    ]
+
+
+def test_handle_topology_event(factories):
+    from decimal import Decimal
+    from minerule.hoststatistics import HostStatistic
+    from minerule.shellagent import PingResult
+    from minerule.utiltypes import HostUsage
+
+    factories["socketevents"].return_value.aggregate_host_usage.return_value = {
+        "a.com": HostUsage(3, {443: 3})
+    }
+    statistics = [
+        HostStatistic("a.com", Decimal(0), False, central=PingResult("0.0.0.0", 4, 4)),
+        HostStatistic("b.com", Decimal(0), False, domestic=PingResult("0.0.0.0", 4, 4)),
+    ]
+    repository = factories["hoststatistics"].return_value
+    repository.iter_scan.return_value = statistics
+    repository.find.side_effect = {s.host: s for s in statistics}.get
+    factories["socketevents"].return_value.find_correlated_hosts.return_value = set()
+    e = event(HostsQuery={"dataset_id": "foo"}, Topology={"required": []})
+    reports = main.handle_topology_event(e, None)
+    assert reports[0]["vantages"] == ["central"]
+    assert reports[0]["coverage"] == 1.0
+
+
+def test_route_rule_analyzer_scheduler(factories):
+    analyzer = main.route_rule_analyzer(
+        {
+            "HostsQuery": {"dataset_id": "foo"},
+            "Proxies": {
+                "central_vm": {"host": "1.1.1.1", "user": "root"},
+                "domestic_vm": {"host": "2.2.2.2", "user": "root"},
+            },
+            "Scheduler": {"vm_rate": 5, "hot_hosts": 10, "reprobe_after_seconds": 60},
+        }
+    )
+    assert analyzer.refresh_runner.scheduler.vm_rate == 5
+    assert (analyzer.hot_hosts, analyzer.reprobe_after) == (10, 60)
+
+
+def test_hedged_agent_uses_own_connection(factories):
+    agent = main.shell_agent(
+        {"host": "1.1.1.1", "user": "root", "resilience": {"hedge_after": 1.0}}
+    )
+    assert factories["shellagent"].call_count == 2
+    assert agent.hedge_agent is not None
@@ -0,0 +1,101 @@
+import pytest
+from benchmarks.fakes import (
+    FakeShellAgent,
+    InMemorySocketEventRepository,
+    InMemoryTable,
+)
+from benchmarks.workloads import SyntheticTopology
+from minerule.analyze import (
+    HostStatisticsRefreshRunner,
+    RouteEvaluator,
+    RouteRuleAnalyzer,
+)
+from minerule.hoststatistics import HostStatistic, HostStatisticRepository
+from minerule.parallel import ParallelRuleCalculator
+from minerule.shellagent import PingResult
+
+
+def statistic(host: str, **kw) -> HostStatistic:
+    kw.setdefault("other_continents", {})
+    return HostStatistic(host, 0, False, **kw)
+
+
+def ping(c1, c2) -> PingResult:
+    return PingResult("0.0.0.0", c1, c2)
+
+
+@pytest.mark.parametrize(
+    "statistics",
+    [
+        [statistic("a", central=ping(10, 10))],
+        [statistic("a", domestic=ping(10, 10))],
+        [statistic("a", other_continents={"ap": ping(10, 10)})],
+        [statistic("a", central=ping(10, 8), domestic=ping(10, 10))],
+        [
+            statistic("a", central=ping(10, 8), domestic=ping(10, 10)),
+            statistic("b", central=ping(10, 9), domestic=ping(10, 8)),
+        ],
+        [
+            statistic("a", central=ping(10, 8), other_continents={"ap": ping(10, 10)}),
+            statistic("b", central=ping(10, 9), other_continents={"ap": ping(10, 8)}),
+        ],
+        [
+            statistic("a", domestic=ping(10, 8)),
+            statistic("b", other_continents={"ap": ping(10, 8)}),
+        ],
+        [
+            statistic("a", domestic=ping(10, 1)),
+            statistic("b", domestic=ping(10, 1), other_continents={"ap": ping(10, 10)}),
+        ],
+    ],
+)
+def test_score_matches_route_evaluator(statistics: list[HostStatistic]):
+    calculator = ParallelRuleCalculator(None)
+    by_host = {s.host: s for s in statistics}
+    assert calculator.score(by_host, [sorted(by_host)]) == [
+        RouteEvaluator.determine_route_continent(statistics)
+    ]
+
+
+def test_cluster():
+    statistics = {
+        "api.baidu.com": statistic("api.baidu.com"),
+        "www.baidu.com": statistic("www.baidu.com"),
+        "bing.com": statistic("bing.com", central=PingResult("1.1.1.1")),
+        "1.1.1.1": HostStatistic("1.1.1.1", 0, True, other_continents={}),
+        "google.com": statistic("google.com"),
+        "gstatic.com": statistic("gstatic.com"),
+        "qq.com": statistic("qq.com"),
+    }
+    clusters = ParallelRuleCalculator(None).cluster(
+        statistics, {"google.com": {"gstatic.com"}}
+    )
+    assert clusters == [
+        ["1.1.1.1", "bing.com"],
+        ["api.baidu.com", "www.baidu.com"],
+        ["google.com", "gstatic.com"],
+        ["qq.com"],
+    ]
+
+
+def test_deterministic_across_processes():
+    topology = SyntheticTopology(200, seed=5)
+    repository = HostStatisticRepository(InMemoryTable())
+    vms = {c: FakeShellAgent(c, topology) for c in SyntheticTopology.CONTINENTS}
+    runner = HostStatisticsRefreshRunner(
+        repository, vms.pop("central"), vms.pop("domestic"), **vms
+    )
+    runner.refresh_all(topology.hosts, 4)
+    events = InMemorySocketEventRepository(topology.socket_events(0, 86400, 200))
+    analyzer = RouteRuleAnalyzer(events, repository, runner)
+    statistics = {h: repository.find(h) for h in topology.hosts}
+    correlated = events.find_correlated_hosts_many(topology.hosts)
+    serial = ParallelRuleCalculator(analyzer, 1).calculate_rules_from(
+        statistics, correlated
+    )
+    parallel = ParallelRuleCalculator(analyzer, 2).calculate_rules_from(
+        statistics, correlated
+    )
+    assert serial == parallel
+    assert set(serial) == {"domestic", "ap", "eu"}
+    assert any(serial.values())
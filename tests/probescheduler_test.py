@@ -0,0 +1,233 @@
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from minerule import instrumentation
+from minerule.analyze import HostStatisticsRefreshRunner
+from minerule.hoststatistics import HostStatistic
+from minerule.probescheduler import (
+    LANE_BACKGROUND,
+    LANE_HOT,
+    LANE_NEW,
+    ProbeScheduler,
+    TokenBucket,
+)
+from minerule.shellagent import PingResult
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 2, clock)
+    assert bucket.try_acquire() and bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.delay() == 0.5
+    clock.sleep(0.5)
+    assert bucket.try_acquire()
+    clock.sleep(10)
+    assert bucket.tokens <= 2
+
+
+def test_priority_lanes():
+    scheduler = ProbeScheduler(batch_size=2)
+    batches = []
+
+    def dispatch(targets):
+        return batches.append(targets) or {}
+
+    scheduler.submit("vm", "b1", dispatch, lane=LANE_BACKGROUND)
+    scheduler.submit("vm", "n1", dispatch, lane=LANE_NEW)
+    scheduler.submit("vm", "h1", dispatch, lane=LANE_HOT)
+    scheduler.submit("vm", "n2", dispatch, lane=LANE_NEW)
+    assert scheduler.queue_depth("vm") == {"hot": 1, "new": 2, "background": 1}
+    scheduler._drain("vm")
+    assert batches == [["h1", "n1"], ["n2", "b1"]]
+    assert scheduler.stats()["vm"]["dispatched"] == 4
+
+
+def test_lanes_share_one_queue():
+    scheduler = ProbeScheduler(batch_size=2)
+    calls = []
+
+    def background(targets):
+        calls.append(("background", targets))
+        return {t: "b" for t in targets}
+
+    def hot(targets):
+        calls.append(("hot", targets))
+        return {t: "h" for t in targets}
+
+    futures = [
+        scheduler.submit("vm", f"b{i}", background, lane=LANE_BACKGROUND)
+        for i in range(3)
+    ]
+    assert scheduler.probe({"vm": (["h1", "h2"], hot)}, lane=LANE_HOT) == {
+        "vm": {"h1": "h", "h2": "h"}
+    }
+    assert [f.result(timeout=5) for f in futures] == ["b", "b", "b"]
+    assert calls == [
+        ("hot", ["h1", "h2"]),
+        ("background", ["b0", "b1"]),
+        ("background", ["b2"]),
+    ]
+
+
+def test_concurrent_probes_keep_their_dispatch():
+    scheduler = ProbeScheduler(batch_size=3)
+
+    def ping(targets):
+        return {t: ("ping", t) for t in targets}
+
+    def tcp(targets):
+        return {t: ("tcp", t) for t in targets}
+
+    targets = [f"h{i}" for i in range(20)]
+    with ThreadPoolExecutor(2) as executor:
+        pings = executor.submit(scheduler.probe, {"vm": (targets, ping)})
+        tcps = executor.submit(scheduler.probe, {"vm": (targets, tcp)})
+        assert pings.result()["vm"] == {t: ("ping", t) for t in targets}
+        assert tcps.result()["vm"] == {t: ("tcp", t) for t in targets}
+
+
+def test_vm_rate_limit():
+    clock = FakeClock()
+    scheduler = ProbeScheduler(
+        vm_rate=10, vm_burst=5, batch_size=100, clock=clock, sleep=clock.sleep
+    )
+    batches = []
+
+    def dispatch(targets):
+        batches.append((clock.now, len(targets)))
+        return {t: t.upper() for t in targets}
+
+    result = scheduler.probe({"vm": ([f"h{i}" for i in range(25)], dispatch)})
+    assert result["vm"]["h3"] == "H3"
+    assert sum(n for _, n in batches) == 25
+    assert batches[0] == (0.0, 5)
+    assert clock.now >= 2.0
+
+
+def test_domain_rate_limit():
+    clock = FakeClock()
+    scheduler = ProbeScheduler(
+        domain_rate=1, domain_burst=1, batch_size=10, clock=clock, sleep=clock.sleep
+    )
+    batches = []
+    scheduler.probe(
+        {"vm": (["a1", "a2", "b1"], lambda t: batches.append(t) or {})},
+        {"a1": "a", "a2": "a", "b1": "b"},
+    )
+    assert batches == [["a1", "b1"], ["a2"]]
+    assert clock.now == 1.0
+
+
+def test_deferred_task_keeps_vm_bucket_within_capacity():
+    clock = FakeClock()
+    scheduler = ProbeScheduler(
+        vm_rate=1, vm_burst=2, domain_rate=1, domain_burst=1, clock=clock
+    )
+    scheduler.submit("vm", "a1", dict.fromkeys, "a")
+    scheduler.submit("vm", "a2", dict.fromkeys, "a")
+    batch, wait = scheduler._next_batch("vm")
+    assert [task.target for task in batch] == ["a1"]
+    assert wait == 1.0
+    assert scheduler.vm_buckets["vm"].tokens <= scheduler.vm_buckets["vm"].capacity
+
+
+def test_failed_batch():
+    scheduler = ProbeScheduler()
+
+    def dispatch(targets):
+        raise RuntimeError("boom")
+
+    assert scheduler.probe({"vm": (["a"], dispatch)}) == {"vm": {}}
+
+
+def test_metrics():
+    recorder = instrumentation.enable()
+    try:
+        scheduler = ProbeScheduler()
+        scheduler.probe({"vm": (["a", "b"], lambda t: {})})
+        assert recorder.counters[("probescheduler.dispatched", (("vm", "vm"),))] == 2
+        depth = ("probescheduler.queue_depth", (("lane", "new"), ("vm", "vm")))
+        assert recorder.gauges[depth] == 0
+    finally:
+        instrumentation.disable()
+
+
+def test_refresh_runner_uses_scheduler():
+    repo = MagicMock()
+    repo.exists.return_value = False
+    repo.ip_exists.return_value = False
+    vms = [MagicMock(), MagicMock()]
+    for vm in vms:
+        vm.resolve_many.return_value = {"a.com": "1.1.1.1", "b.com": "1.1.1.1"}
+        vm.ping_many.side_effect = lambda ips, count: {
+            ip: PingResult(ip, count, count) for ip in ips
+        }
+    scheduler = ProbeScheduler(domain_rate=100)
+    runner = HostStatisticsRefreshRunner(repo, vms[0], vms[1], scheduler)
+    runner.refresh_all(["a.com", "b.com"], 3)
+    vms[0].ping_many.assert_called_once_with(["1.1.1.1"], count=3)
+    assert set(scheduler.domain_buckets) == {"a"}
+    saved = [c.args[0] for c in repo.save.call_args_list]
+    assert [s.domestic.packets_received for s in saved] == [3, 3]
+
+
+def test_refresh_stale_uses_background_lane():
+    repo = MagicMock()
+    now = time.time()
+    repo.find.side_effect = lambda h: {
+        "old.com": HostStatistic("old.com", now - 7200, False),
+        "new.com": HostStatistic("new.com", now, False),
+    }.get(h)
+    vms = [MagicMock(), MagicMock()]
+    for vm in vms:
+        vm.resolve_many.side_effect = lambda hosts: {h: "1.1.1.1" for h in hosts}
+        vm.ping_many.side_effect = lambda ips, count: {
+            ip: PingResult(ip, count, count) for ip in ips
+        }
+    recorder = instrumentation.enable()
+    try:
+        scheduler = ProbeScheduler()
+        runner = HostStatisticsRefreshRunner(repo, vms[0], vms[1], scheduler)
+        assert runner.refresh_stale(["old.com", "new.com", "gone.com"], 3, 3600) == 1
+        assert {s["dispatched"] for s in scheduler.stats().values()} == {2}
+        lanes = {dict(k[1])["lane"] for k in recorder.histograms if k[0].endswith("wait_seconds")}  # fmt: skip
+        assert lanes == {"background"}
+    finally:
+        instrumentation.disable()
+    assert [c.args[0].host for c in repo.save.call_args_list] == ["old.com"]
+    stop = threading.Event()
+    stop.set()
+    assert runner.refresh_stale(["old.com"], 3, 3600, stop=stop) == 0
+
+
+def test_probe_timeout_cancels_queued_tasks():
+    release = threading.Event()
+    calls = []
+
+    def dispatch(targets):
+        calls.append(targets)
+        release.wait(5)
+        return {t: t for t in targets}
+
+    scheduler = ProbeScheduler(batch_size=1, idle_seconds=0.01)
+    with pytest.raises(TimeoutError):
+        scheduler.probe({"central": ([1, 2], dispatch)}, timeout=0.05)
+    worker = scheduler.workers["central"]
+    release.set()
+    worker.join(5)
+    assert calls == [[1]]
+    assert scheduler.queue_depth("central")["new"] == 0
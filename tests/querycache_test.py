@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import MagicMock
+import pytest
+from minerule.querycache import QueryCache
+from minerule.socketevents import SocketEventRepository
+from minerule.utiltypes import TimeWindow
+
+
+@pytest.fixture
+def cache(tmp_path) -> QueryCache:
+    cache = QueryCache(str(tmp_path / "cache.sqlite3"), 60, 3600)
+    yield cache
+    cache.close()
+
+
+class TestQueryCache:
+    def test_normalize(self, cache: QueryCache):
+        assert cache.normalize(datetime(2000, 1, 1, 10, 59, 59)) == datetime(2000, 1, 1, 10)  # fmt: skip
+        assert cache.normalize("foo") == "foo"
+        assert cache.normalize(30) == 30
+
+    def test_key(self):
+        assert QueryCache.key("SELECT 1", ("a",)) == QueryCache.key(" SELECT\n 1 ", ("a",))  # fmt: skip
+        assert QueryCache.key("SELECT 1", ("a",)) != QueryCache.key("SELECT 1", ("b",))  # fmt: skip
+
+    def test_get_put(self, cache: QueryCache):
+        assert cache.get("k") is None
+        cache.put("k", {"foo"})
+        assert cache.get("k") == {"foo"}
+        assert cache.stats() == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+
+    def test_persistent(self, cache: QueryCache):
+        cache.put("k", {"foo"})
+        other = QueryCache(cache.path)
+        assert other.get("k") == {"foo"}
+        other.close()
+
+    def test_ttl(self, cache: QueryCache):
+        cache.put("k", {"foo"})
+        cache.ttl_seconds = 0
+        assert cache.get("k") is None
+        assert cache.evict_expired() == 1
+
+    def test_threads(self, cache: QueryCache):
+        def work(i: int):
+            cache.put(f"k{i % 10}", i)
+            return cache.get(f"k{i % 10}")
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(work, range(400)))
+        assert all(r is not None for r in results)
+        assert cache.stats()["hits"] + cache.stats()["misses"] == 400
+
+
+class TestSocketEventRepositoryCache:
+    def test_query_cached(self, cache: QueryCache):
+        client = MagicMock()
+        client.project = "foo"
+        client.query.return_value = [MagicMock(host="foo1")]
+        repo = SocketEventRepository(client, "bar", cache)
+        assert repo.aggregate_on_hosts(TimeWindow(946684810, 946771210)) == {"foo1"}
+        assert repo.aggregate_on_hosts(TimeWindow(946684820, 946771220)) == {"foo1"}
+        assert repo.find_correlated_hosts("foo1") == {"foo1"}
+        assert repo.find_correlated_hosts("foo1") == {"foo1"}
+        assert client.query.call_count == 2
+        assert cache.hits == 2
+        assert cache.misses == 2
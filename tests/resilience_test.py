@@ -0,0 +1,132 @@
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import pytest
+from minerule import instrumentation
+from minerule.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilientShellAgent,
+)
+from minerule.shellagent import PingResult, RemoteCommandError, RemoteConnectionError
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker("vm", failure_threshold=2, reset_timeout=10, clock=clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_retries_transient_errors():
+    agent = MagicMock()
+    agent.ping.side_effect = [
+        RemoteConnectionError("reset"),
+        PingResult("1.1.1.1", 1, 1),
+    ]
+    sleep = MagicMock()
+    resilient = ResilientShellAgent(agent, "vm", sleep=sleep)
+    assert resilient.ping("a.com", 1).destination_ip == "1.1.1.1"
+    assert agent.ping.call_count == 2
+    assert 0 <= sleep.call_args[0][0] <= 0.2
+    assert resilient.breaker.state == CLOSED
+
+
+def test_command_errors_are_not_retried():
+    agent = MagicMock()
+    agent.ping.side_effect = RemoteCommandError("unknown host")
+    resilient = ResilientShellAgent(agent, "vm", sleep=MagicMock())
+    with pytest.raises(RemoteCommandError):
+        resilient.ping("a.com", 1)
+    assert agent.ping.call_count == 1
+    assert resilient.breaker.failures == 0
+
+
+def test_dead_vm_fails_fast():
+    agent = MagicMock()
+    agent.ping.side_effect = RemoteConnectionError("timeout")
+    recorder = instrumentation.enable()
+    try:
+        resilient = ResilientShellAgent(
+            agent, "vm", CircuitBreaker("vm", 3), retries=5, sleep=MagicMock()
+        )
+        with pytest.raises(RemoteConnectionError):
+            resilient.ping("a.com", 1)
+        assert agent.ping.call_count == 3
+        for _ in range(10):
+            with pytest.raises(CircuitOpenError):
+                resilient.ping("a.com", 1)
+        assert agent.ping.call_count == 3
+        assert recorder.gauges[("resilience.breaker_state", (("vm", "vm"),))] == 2
+        assert (
+            recorder.counters[("resilience.breaker_rejections", (("vm", "vm"),))] == 10
+        )
+    finally:
+        instrumentation.disable()
+
+
+def test_hedged_request():
+    release = threading.Event()
+    calls = []
+
+    def ping(host, count):
+        calls.append(host)
+        if len(calls) == 1:
+            release.wait(5)
+            return PingResult("slow", count, count)
+        return PingResult("fast", count, count)
+
+    agent, hedge_agent = MagicMock(), MagicMock()
+    agent.ping.side_effect = ping
+    hedge_agent.ping.side_effect = ping
+    resilient = ResilientShellAgent(
+        agent, "vm", hedge_after=0.01, hedge_agent=hedge_agent
+    )
+    try:
+        assert resilient.ping("a.com", 1).destination_ip == "fast"
+        assert len(calls) == 2
+        agent.ping.assert_called_once_with("a.com", 1)
+        hedge_agent.ping.assert_called_once_with("a.com", 1)
+    finally:
+        release.set()
+        resilient.close()
+
+
+def test_no_hedge_without_separate_connection():
+    agent = MagicMock()
+    agent.ping.side_effect = lambda host, count: time.sleep(0.05) or PingResult()
+    resilient = ResilientShellAgent(agent, "vm", hedge_after=0.01)
+    resilient.ping("a.com", 1)
+    agent.ping.assert_called_once()
+    assert resilient._executor is None
+
+
+def test_passes_through_attributes():
+    agent = SimpleNamespace(connection=SimpleNamespace(host="1.2.3.4"))
+    assert ResilientShellAgent(agent, "vm").connection.host == "1.2.3.4"
@@ -0,0 +1,142 @@
+import datetime
+import pathlib
+
+import pytest
+
+from minerule.localevents import DuckDBSocketEventRepository
+from minerule.rollups import RolledUpSocketEventRepository, SocketEventRollups
+from minerule.utiltypes import TimeWindow
+
+CSV_PATH = str(pathlib.Path(__file__).parent / "socketevents.csv")
+DAY = datetime.date(2000, 1, 1)
+FULL_DAY = TimeWindow(946684800, 946684800 + 86400)
+
+
+@pytest.fixture
+def repo() -> DuckDBSocketEventRepository:
+    repo = DuckDBSocketEventRepository.create_instance(CSV_PATH)
+    yield repo
+    repo.connection.close()
+
+
+@pytest.fixture
+def rollups(repo: DuckDBSocketEventRepository) -> SocketEventRollups:
+    rollups = SocketEventRollups(repo)
+    rollups.create_tables()
+    return rollups
+
+
+@pytest.fixture
+def days_repo() -> DuckDBSocketEventRepository:
+    repo = DuckDBSocketEventRepository.create_instance(CSV_PATH)
+    repo.execute(
+        "CREATE TABLE events AS SELECT * FROM socketevents UNION ALL SELECT host, port, access_timestamp + INTERVAL 1 DAY FROM socketevents UNION ALL SELECT host, port, access_timestamp + INTERVAL 2 DAY FROM socketevents"
+    )
+    repo.execute("CREATE OR REPLACE TEMP VIEW socketevents AS SELECT * FROM events")
+    yield repo
+    repo.connection.close()
+
+
+def usage(repository, tw: TimeWindow) -> dict:
+    return {h: u.ports for h, u in repository.aggregate_host_usage(tw).items()}
+
+
+def test_roll_up_incrementally(rollups: SocketEventRollups):
+    assert rollups.rolled_up_until() is None
+    with pytest.raises(ValueError):
+        rollups.roll_up(until=DAY)
+    assert rollups.roll_up(DAY, DAY + datetime.timedelta(days=1), 1) == [DAY]
+    assert rollups.rolled_up_until() == DAY + datetime.timedelta(days=1)
+    assert rollups.roll_up(until=DAY + datetime.timedelta(days=1), diff_seconds=1) == []
+    with pytest.raises(ValueError):
+        rollups.roll_up(until=DAY + datetime.timedelta(days=1), diff_seconds=30)
+    rollups.roll_up_day(DAY, 1)
+    assert rollups.host_usage(DAY, DAY + datetime.timedelta(days=1))["foo1"].ports == {
+        443: 3
+    }
+
+
+def test_window_queries_match_raw_events(
+    repo: DuckDBSocketEventRepository, rollups: SocketEventRollups
+):
+    rollups.roll_up_day(DAY, 1)
+    rolled = RolledUpSocketEventRepository(repo, rollups, FULL_DAY)
+    assert rolled.split(FULL_DAY) == ([(DAY, DAY + datetime.timedelta(days=1))], [])
+    assert usage(rolled, FULL_DAY) == usage(repo, FULL_DAY)
+    assert rolled.aggregate_on_hosts(FULL_DAY) == repo.aggregate_on_hosts(FULL_DAY)
+    hosts = repo.aggregate_on_hosts(FULL_DAY)
+    for diff_seconds in (1, 5, 30):
+        assert rolled.find_correlated_hosts_many(hosts, diff_seconds) == {
+            h: repo.find_correlated_hosts(h, diff_seconds) for h in hosts
+        }
+
+
+def test_other_diff_seconds_read_raw_events(
+    repo: DuckDBSocketEventRepository, rollups: SocketEventRollups
+):
+    rollups.roll_up_day(DAY, 1)
+    assert rollups.rolled_up_until(1) == DAY + datetime.timedelta(days=1)
+    assert rollups.rolled_up_until(30) is None
+    rolled = RolledUpSocketEventRepository(repo, rollups, FULL_DAY)
+    assert rolled.split(FULL_DAY, 30) == ([], [FULL_DAY])
+    hosts = repo.aggregate_on_hosts(FULL_DAY)
+    assert rolled.find_correlated_hosts_many(hosts, 30) == {
+        h: repo.find_correlated_hosts(h, 30) for h in hosts
+    }
+    assert set(rolled._correlated) == {30}
+
+
+def test_window_edges_read_raw_events(
+    repo: DuckDBSocketEventRepository, rollups: SocketEventRollups
+):
+    rollups.roll_up_day(DAY, 1)
+    window = TimeWindow(946684810, 946684800 + 2 * 86400)
+    rolled = RolledUpSocketEventRepository(repo, rollups, window)
+    assert rolled.split(window) == ([], [window])
+    partial = TimeWindow(946684800 - 3600, 946684800 + 86400)
+    days, edges = rolled.split(partial)
+    assert days == [(DAY, DAY + datetime.timedelta(days=1))]
+    assert [(e.from_time, e.to_time) for e in edges] == [(946684800 - 3600, 946684800)]
+    assert usage(rolled, window) == usage(repo, window)
+    assert rolled.find_correlated_hosts("foo1", 1) == {"bar1"}
+
+
+def test_missing_days_read_raw_events(days_repo: DuckDBSocketEventRepository):
+    rollups = SocketEventRollups(days_repo)
+    rollups.create_tables()
+    rollups.roll_up_day(DAY, 1)
+    rollups.roll_up_day(DAY + datetime.timedelta(days=2), 1)
+    window = TimeWindow(FULL_DAY.from_time, FULL_DAY.from_time + 3 * 86400)
+    rolled = RolledUpSocketEventRepository(days_repo, rollups, window)
+    days, edges = rolled.split(window, 1)
+    assert days == [
+        (DAY, DAY + datetime.timedelta(days=1)),
+        (DAY + datetime.timedelta(days=2), DAY + datetime.timedelta(days=3)),
+    ]
+    assert [(e.from_time, e.to_time) for e in edges] == [
+        (FULL_DAY.to_time, FULL_DAY.to_time + 86400)
+    ]
+    assert usage(rolled, window) == usage(days_repo, window)
+    assert rolled.find_correlated_hosts("foo1", 1) == {"bar1"}
+    hosts = days_repo.aggregate_on_hosts(window)
+    assert rolled.find_correlated_hosts_many(hosts, 1) == {
+        h: days_repo.find_correlated_hosts(h, 1) for h in hosts
+    }
+
+
+def test_roll_up_resumes_after_partial_day(days_repo: DuckDBSocketEventRepository):
+    rollups = SocketEventRollups(days_repo)
+    rollups.create_tables()
+    second = DAY + datetime.timedelta(days=1)
+    assert rollups.roll_up(DAY, second + datetime.timedelta(days=1), 1) == [
+        DAY,
+        second,
+    ]
+    days_repo.execute("DELETE FROM pairrollups WHERE day = ?", second)
+    assert rollups.rolled_up_until(1) == second
+    assert rollups.rolled_up_days(DAY, second + datetime.timedelta(days=1), 1) == {DAY}
+    assert rollups.roll_up(
+        until=second + datetime.timedelta(days=1), diff_seconds=1
+    ) == [second]
+    days_repo.execute("DELETE FROM hostrollups WHERE day = ?", second)
+    assert rollups.rolled_up_until(1) == second
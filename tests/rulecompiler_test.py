@@ -0,0 +1,87 @@
+import pytest
+from minerule.rulecompiler import (
+    DomainSuffixTrie,
+    compile_rules,
+    to_clash,
+    to_pac,
+    to_shadowrocket,
+)
+
+RULES = {
+    "domestic": [
+        "www.baidu.com",
+        "api.baidu.com",
+        "qq.com",
+        "a.mixed.com",
+        "10.0.0.1",
+        "10.0.0.0",
+        "10.0.0.2",
+        "10.0.0.3",
+    ],
+    "ap": ["b.mixed.com", "192.168.1.1", "2001:db8::1"],
+}
+
+
+def test_domain_suffix_trie():
+    trie = DomainSuffixTrie()
+    trie.insert("baidu.com", "domestic")
+    trie.insert("api.baidu.com", "ap")
+    assert trie.longest_suffix("www.baidu.com") == "domestic"
+    assert trie.longest_suffix("v1.api.baidu.com") == "ap"
+    assert trie.longest_suffix("API.Baidu.com.") == "ap"
+    assert trie.longest_suffix("google.com") is None
+
+
+def test_compile_rules():
+    compiled = compile_rules(RULES, central_hosts=["c.mixed.com"])
+    assert compiled.domain_suffixes == {"baidu.com": "domestic", "qq.com": "domestic"}
+    assert compiled.domains == {"a.mixed.com": "domestic", "b.mixed.com": "ap"}
+    assert compiled.networks == [
+        ("192.168.1.1/32", "ap"),
+        ("2001:db8::1/128", "ap"),
+        ("10.0.0.0/30", "domestic"),
+    ]
+
+
+def test_compile_rules_central_conflict():
+    compiled = compile_rules({"domestic": ["www.baidu.com"]}, ["pan.baidu.com"])
+    assert compiled.domain_suffixes == {}
+    assert compiled.domains == {"www.baidu.com": "domestic"}
+
+
+def test_to_clash():
+    text = to_clash(compile_rules(RULES), {"ap": "tokyo"})
+    lines = text.splitlines()
+    assert lines[0] == "rules:"
+    assert "  - DOMAIN-SUFFIX,baidu.com,DIRECT" in lines
+    assert "  - DOMAIN-SUFFIX,mixed.com,DIRECT" not in lines
+    assert "  - IP-CIDR,10.0.0.0/30,DIRECT,no-resolve" in lines
+    assert "  - IP-CIDR6,2001:db8::1/128,tokyo,no-resolve" in lines
+    assert lines[-1] == "  - MATCH,central"
+
+
+def test_to_shadowrocket():
+    lines = to_shadowrocket(compile_rules(RULES)).splitlines()
+    assert lines[0] == "[Rule]"
+    assert "DOMAIN,b.mixed.com,ap" in lines
+    assert lines[-1] == "FINAL,central"
+
+
+def test_to_pac():
+    text = to_pac(compile_rules(RULES), {"central": "PROXY 1.1.1.1:8080"})
+    assert "function FindProxyForURL(url, host)" in text
+    assert '"baidu.com": "DIRECT"' in text
+    assert '["10.0.0.0", "255.255.255.252", "DIRECT"]' in text
+    assert 'var fallback = "PROXY 1.1.1.1:8080";' in text
+    assert '["2001:db8::1/128", "DIRECT"]' in text
+
+
+def test_to_pac_policies(caplog):
+    text = to_pac(compile_rules(RULES))
+    assert 'var fallback = "DIRECT";' in text
+    assert '"b.mixed.com": "DIRECT"' in text
+    assert "No PAC policy for ap" in caplog.text
+    text = to_pac(compile_rules(RULES), {"ap": "SOCKS5 2.2.2.2:1080; DIRECT"})
+    assert '["2001:db8::1/128", "SOCKS5 2.2.2.2:1080; DIRECT"]' in text
+    with pytest.raises(ValueError):
+        to_pac(compile_rules(RULES), {"ap": "ap"})
@@ -0,0 +1,142 @@
+import json
+from unittest.mock import MagicMock
+import pytest
+from botocore.exceptions import ClientError
+from benchmarks.fakes import InMemoryTable
+from minerule.rulediffs import (
+    RuleDiff,
+    RuleDiffPublisher,
+    RuleSnapshotRepository,
+    S3DiffSink,
+    apply_diff,
+    diff_rules,
+)
+
+OLD = {"domestic": ["baidu.com", "qq.com"], "ap": ["google.com"]}
+NEW = {"domestic": ["baidu.com", "google.com"], "ap": ["line.me"]}
+
+
+def repository() -> RuleSnapshotRepository:
+    return RuleSnapshotRepository(InMemoryTable("ruleSet", "host"))
+
+
+def test_diff_rules():
+    diff = diff_rules(OLD, NEW, 3)
+    assert (diff.from_version, diff.to_version) == (3, 4)
+    assert diff.added == {"line.me": "ap"}
+    assert diff.removed == {"qq.com": "domestic"}
+    assert diff.moved == {"google.com": ("ap", "domestic")}
+    assert len(diff) == 3
+    assert diff_rules(NEW, NEW).is_empty()
+
+
+def test_apply_diff():
+    assert apply_diff(OLD, diff_rules(OLD, NEW)) == NEW
+    assert apply_diff({}, diff_rules({}, NEW)) == NEW
+
+
+def test_to_dict():
+    diff = diff_rules(OLD, NEW, 1)
+    restored = RuleDiff.from_dict(diff.to_dict())
+    assert restored.to_dict() == diff.to_dict()
+    assert restored.moved == diff.moved
+
+
+def test_publish():
+    published = []
+    publisher = RuleDiffPublisher(repository(), published.append, "proxies")
+    first = publisher.publish(OLD)
+    assert (first.from_version, first.to_version) == (0, 1)
+    assert first.added == {
+        "baidu.com": "domestic",
+        "qq.com": "domestic",
+        "google.com": "ap",
+    }
+    second = publisher.publish(NEW)
+    assert (second.from_version, second.to_version) == (1, 2)
+    assert len(second) == 3
+    assert publisher.repository.find("proxies") == (2, NEW)
+    unchanged = publisher.publish(NEW)
+    assert unchanged.is_empty() and unchanged.to_version == 2
+    assert published == [first, second]
+    journals = {k[0] for k in publisher.repository.table.items if "#" in k[0]}
+    assert journals == set()
+
+
+def test_rule_sets_are_isolated():
+    repo = repository()
+    RuleDiffPublisher(repo, rule_set="a").publish(OLD)
+    assert repo.find("b") == (0, {})
+    assert repo.find("a") == (1, OLD)
+
+
+def test_publish_persists_before_sink():
+    repo = repository()
+    sink = MagicMock(side_effect=[RuntimeError("down"), None, None])
+    publisher = RuleDiffPublisher(repo, sink, "proxies")
+    with pytest.raises(RuntimeError):
+        publisher.publish(OLD)
+    assert repo.find("proxies") == (1, OLD)
+    assert repo.pending("proxies").added == diff_rules({}, OLD).added
+    second = publisher.publish(NEW)
+    assert [c.args[0].to_version for c in sink.call_args_list] == [1, 1, 2]
+    assert sink.call_args_list[1].args[0].to_dict() == diff_rules({}, OLD).to_dict()
+    assert second.from_version == 1
+    assert repo.pending("proxies") is None
+
+
+def test_publish_recovers_partial_apply():
+    repo = repository()
+    publisher = RuleDiffPublisher(repo, rule_set="proxies")
+    publisher.publish(OLD)
+    apply = repo.apply
+    repo.apply = MagicMock(side_effect=RuntimeError("boom"))
+    with pytest.raises(RuntimeError):
+        publisher.publish(NEW)
+    repo.apply = apply
+    diff = publisher.publish(NEW)
+    assert diff.is_empty() and diff.to_version == 2
+    assert repo.find("proxies") == (2, NEW)
+
+
+def test_commit_is_conditional():
+    repo = repository()
+    diff = diff_rules({}, OLD)
+    repo.commit("proxies", diff, repo.journal("proxies", diff))
+    with pytest.raises(ClientError):
+        repo.commit("proxies", diff, repo.journal("proxies", diff))
+
+
+def test_failed_commit_discards_journal():
+    repo = repository()
+    RuleDiffPublisher(repo, rule_set="proxies").publish(OLD)
+    repo.find = MagicMock(return_value=(0, {}))
+    with pytest.raises(ClientError):
+        RuleDiffPublisher(repo, rule_set="proxies").publish(NEW)
+    assert {k[0] for k in repo.table.items} == {"proxies"}
+
+
+def test_publish_snapshots():
+    snapshots = []
+    publisher = RuleDiffPublisher(
+        repository(),
+        rule_set="proxies",
+        snapshot=lambda version, rules: snapshots.append((version, rules)),
+        snapshot_every=2,
+    )
+    publisher.publish(OLD)
+    publisher.publish(NEW)
+    publisher.publish(OLD)
+    assert snapshots == [(2, NEW)]
+
+
+def test_s3_sink():
+    client = MagicMock()
+    S3DiffSink("bucket", "diffs/", "proxies", client)(diff_rules(OLD, NEW, 1))
+    kwargs = client.put_object.call_args.kwargs
+    assert kwargs["Key"] == "diffs/proxies/00000002.json"
+    assert json.loads(kwargs["Body"])["toVersion"] == 2
+    S3DiffSink("bucket", "diffs/", "proxies", client).snapshot(2, NEW)
+    kwargs = client.put_object.call_args.kwargs
+    assert kwargs["Key"] == "diffs/proxies/snapshots/00000002.json"
+    assert json.loads(kwargs["Body"]) == {"version": 2, "rules": NEW}
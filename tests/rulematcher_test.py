@@ -0,0 +1,72 @@
+import pytest
+from minerule.rulecompiler import CompiledRules
+from minerule.rulematcher import RouteMatcher
+
+COMPILED = CompiledRules(
+    {"baidu.com": "domestic", "google.com": "ap"},
+    {"maps.google.com": "eu", "a.mixed.com": "domestic"},
+    [
+        ("10.0.0.0/8", "domestic"),
+        ("10.1.0.0/16", "ap"),
+        ("2001:db8::/32", "eu"),
+    ],
+)
+
+
+@pytest.fixture
+def matcher() -> RouteMatcher:
+    return RouteMatcher.from_compiled(COMPILED)
+
+
+def test_lookup_domain(matcher: RouteMatcher):
+    assert matcher.lookup("baidu.com") == "domestic"
+    assert matcher.lookup("www.BAIDU.com") == "domestic"
+    assert matcher.lookup("google.com") == "ap"
+    assert matcher.lookup("maps.google.com") == "eu"
+    assert matcher.lookup("v2.maps.google.com") == "ap"
+    assert matcher.lookup("a.mixed.com") == "domestic"
+    assert matcher.lookup("b.mixed.com") == "central"
+    assert matcher.lookup("mixed.com") == "central"
+    assert matcher.lookup("com") == "central"
+    assert matcher.lookup("unknown.org") == "central"
+
+
+def test_lookup_ip(matcher: RouteMatcher):
+    assert matcher.lookup("10.2.3.4") == "domestic"
+    assert matcher.lookup("10.1.3.4") == "ap"
+    assert matcher.lookup("11.0.0.1") == "central"
+    assert matcher.lookup("2001:db8::1") == "eu"
+    assert matcher.lookup("2001:db9::1") == "central"
+
+
+def test_save_and_load(matcher: RouteMatcher, tmp_path):
+    path = str(tmp_path / "rules.bin")
+    matcher.save(path)
+    loaded = RouteMatcher.load(path)
+    try:
+        assert loaded.lookup("www.baidu.com") == "domestic"
+        assert loaded.lookup("maps.google.com") == "eu"
+        assert loaded.lookup("10.1.3.4") == "ap"
+    finally:
+        loaded.close()
+
+
+def test_empty_rules():
+    matcher = RouteMatcher.from_compiled(CompiledRules({}, {}, []))
+    assert matcher.lookup("baidu.com") == "central"
+    assert matcher.lookup("1.1.1.1") == "central"
+
+
+def test_from_rules():
+    matcher = RouteMatcher.from_rules(
+        {"domestic": ["www.baidu.com", "10.0.0.1"], "ap": ["google.com"]}
+    )
+    assert matcher.lookup("pan.baidu.com") == "domestic"
+    assert matcher.lookup("10.0.0.1") == "domestic"
+    assert matcher.lookup("10.0.0.2") == "central"
+    assert matcher.lookup("mail.google.com") == "ap"
+
+
+def test_invalid_file():
+    with pytest.raises(ValueError):
+        RouteMatcher(b"\0" * 64)
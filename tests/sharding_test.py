@@ -0,0 +1,188 @@
+from unittest.mock import MagicMock
+import pytest
+from benchmarks.fakes import (
+    FakeShellAgent,
+    InMemorySocketEventRepository,
+    InMemoryTable,
+)
+from benchmarks.workloads import SyntheticTopology
+from minerule.analyze import HostStatisticsRefreshRunner, RouteRuleAnalyzer
+from minerule.hoststatistics import HostStatistic, HostStatisticRepository
+from minerule.sharding import (
+    ShardCheckpoint,
+    ShardCheckpointRepository,
+    ShardCluster,
+    ShardedRuleRunner,
+    shard_of,
+)
+from minerule.shellagent import PingResult
+from minerule.utiltypes import HostUsage, TimeWindow
+
+SNAPSHOT = TimeWindow(946684800, 946771200)
+
+
+@pytest.fixture
+def topology() -> SyntheticTopology:
+    return SyntheticTopology(80, seed=3)
+
+
+def analyzer(topology: SyntheticTopology) -> RouteRuleAnalyzer:
+    events = topology.socket_events(SNAPSHOT.from_time, 86000, 80)
+    repository = HostStatisticRepository(InMemoryTable())
+    vms = {c: FakeShellAgent(c, topology) for c in SyntheticTopology.CONTINENTS}
+    runner = HostStatisticsRefreshRunner(
+        repository, vms.pop("central"), vms.pop("domestic"), **vms
+    )
+    return RouteRuleAnalyzer(InMemorySocketEventRepository(events), repository, runner)
+
+
+def checkpoints() -> ShardCheckpointRepository:
+    return ShardCheckpointRepository(InMemoryTable("runId", "part"))
+
+
+def test_shard_of():
+    assert shard_of("api.baidu.com", 8) == shard_of("www.baidu.com", 8)
+    assert shard_of("baidu.com", 8) == shard_of("baidu.cn", 8)
+    assert 0 <= shard_of("8.8.8.8", 8) < 8
+
+
+def test_checkpoint_repository():
+    repo = checkpoints()
+    repo.save(
+        ShardCheckpoint(
+            "r1", 0, 2, SNAPSHOT, ["b"], [ShardCluster("ap", ["a"], ["c"])], True
+        )
+    )
+    cp = repo.find("r1", 0)
+    assert cp.snapshot.from_time == SNAPSHOT.from_time
+    assert cp.remaining == ["b"]
+    assert cp.clusters[0].continent == "ap"
+    assert cp.clusters[0].hosts == ["a"]
+    assert cp.clusters[0].links == ["c"]
+    assert cp.refreshed and not cp.done
+    assert repo.find("r1", 1) is None
+    assert len(repo.find_all("r1")) == 1
+
+
+def test_checkpoint_repository_chunks():
+    table = InMemoryTable("runId", "part")
+    repo = ShardCheckpointRepository(table, chunk_size=2)
+    hosts = [f"h{i}" for i in range(7)]
+    checkpoint = ShardCheckpoint("r1", 3, 4, SNAPSHOT, hosts)
+    repo.save(checkpoint)
+    checkpoint.clusters.append(ShardCluster("ap", hosts[:5], ["x", "y", "z"]))
+    checkpoint.remaining = hosts[5:]
+    repo.save(checkpoint)
+    assert max(len(item.get("hosts", ())) for item in table.items.values()) == 2
+    cp = repo.find("r1", 3)
+    assert cp.remaining == hosts[5:]
+    assert cp.clusters[0].hosts == hosts[:5]
+    assert cp.clusters[0].links == ["x", "y", "z"]
+
+    checkpoint.clusters.append(ShardCluster("ap", hosts[5:]))
+    table.put_item(Item=repo._cluster_items(checkpoint, 1)[0])
+    assert len(repo.find("r1", 3).clusters) == 1
+    assert len(repo.find_all("r1")) == 1
+
+
+def test_checkpoint_repository_ignores_stale_pieces():
+    table = InMemoryTable("runId", "part")
+    repo = ShardCheckpointRepository(table, chunk_size=2)
+    hosts = [f"h{i}" for i in range(6)]
+    stale = ShardCheckpoint("r1", 0, 1, SNAPSHOT, hosts, [ShardCluster("ap", hosts)])
+    repo.save(stale)
+    checkpoint = ShardCheckpoint("r1", 0, 1, SNAPSHOT, hosts)
+    checkpoint.persisted = 0
+    checkpoint.clusters.append(ShardCluster("domestic", hosts[:2]))
+    checkpoint.remaining = hosts[2:]
+    repo.save(checkpoint)
+    cp = repo.find("r1", 0)
+    assert [(c.continent, c.hosts) for c in cp.clusters] == [("domestic", hosts[:2])]
+    assert cp.remaining == hosts[2:]
+
+
+def test_run_and_merge(topology: SyntheticTopology):
+    a = analyzer(topology)
+    runner = ShardedRuleRunner(a, checkpoints(), 3)
+    usage = runner.usage(SNAPSHOT)
+    a.socket_event_repository.aggregate_host_usage = MagicMock()
+    for shard in range(3):
+        assert runner.run_shard("r1", shard, SNAPSHOT, 1, usage).done
+    a.socket_event_repository.aggregate_host_usage.assert_not_called()
+    rules = runner.merge("r1", usage)
+    clustered = [
+        h for cp in runner.checkpoints.find_all("r1") for c in cp.clusters for h in c.hosts  # fmt: skip
+    ]
+    assert sorted(clustered) == sorted(topology.hosts)
+    routed = [h for hosts in rules.values() for h in hosts]
+    assert len(routed) == len(set(routed))
+    assert set(routed) <= set(topology.hosts)
+
+
+def test_merge_unfinished(topology: SyntheticTopology):
+    runner = ShardedRuleRunner(analyzer(topology), checkpoints(), 2)
+    runner.run_shard("r1", 0, SNAPSHOT, 1)
+    with pytest.raises(RuntimeError):
+        runner.merge("r1")
+
+
+def test_resume(topology: SyntheticTopology):
+    a = analyzer(topology)
+    repo = checkpoints()
+    a.refresh_runner.refresh_all(topology.hosts, 1)
+    find = a.host_statistic_repository.find
+    found = [find(h) for h in sorted(topology.hosts)[:5]]
+    a.host_statistic_repository.find = MagicMock(
+        side_effect=found + [RuntimeError("boom")]
+    )
+    with pytest.raises(RuntimeError):
+        ShardedRuleRunner(a, repo, 1, checkpoint_every=1).run_shard("r1", 0, SNAPSHOT, 1)  # fmt: skip
+    partial = repo.find("r1", 0)
+    assert partial.clusters and partial.remaining and not partial.done
+    a.host_statistic_repository.find = find
+    done = ShardedRuleRunner(a, repo, 1).run_shard("r1", 0, SNAPSHOT, 1)
+    clustered = [h for c in done.clusters for h in c.hosts]
+    assert sorted(clustered) == sorted(topology.hosts)
+
+
+def test_merge_reconciles_linked_clusters():
+    a = MagicMock()
+    a._init_rules.return_value = {"domestic": [], "ap": []}
+    a.host_statistic_repository.find.side_effect = lambda h: HostStatistic(
+        h, 0, False, domestic=PingResult("0.0.0.0", 10, 10)
+    )
+    repo = checkpoints()
+    repo.save(
+        ShardCheckpoint("r1", 0, 2, SNAPSHOT, [], [ShardCluster("ap", ["a.com"], ["1.1.1.1"])], True, True)  # fmt: skip
+    )
+    repo.save(
+        ShardCheckpoint("r1", 1, 2, SNAPSHOT, [], [ShardCluster("domestic", ["1.1.1.1"])], True, True)  # fmt: skip
+    )
+    rules = ShardedRuleRunner(a, repo, 2).merge("r1")
+    assert rules == {"domestic": ["1.1.1.1", "a.com"], "ap": []}
+
+
+def test_merge_weights_reconciled_clusters():
+    a = MagicMock()
+    a._init_rules.side_effect = lambda: {"central": [], "domestic": []}
+    pings = {"a.com": (10, 5), "1.1.1.1": (5, 10)}
+    a.host_statistic_repository.find.side_effect = lambda h: HostStatistic(
+        h,
+        0,
+        False,
+        central=PingResult("0.0.0.0", 10, pings[h][0]),
+        domestic=PingResult("0.0.0.0", 10, pings[h][1]),
+    )
+    repo = checkpoints()
+    repo.save(
+        ShardCheckpoint("r1", 0, 2, SNAPSHOT, [], [ShardCluster("central", ["a.com"], ["1.1.1.1"])], True, True)  # fmt: skip
+    )
+    repo.save(
+        ShardCheckpoint("r1", 1, 2, SNAPSHOT, [], [ShardCluster("domestic", ["1.1.1.1"])], True, True)  # fmt: skip
+    )
+    usage = {"a.com": HostUsage(1, {443: 1}), "1.1.1.1": HostUsage(10, {443: 10})}
+    rules = ShardedRuleRunner(a, repo, 2).merge("r1", usage)
+    assert rules == {"central": [], "domestic": ["1.1.1.1", "a.com"]}
+    a.socket_event_repository.aggregate_host_usage.return_value = {}
+    rules = ShardedRuleRunner(a, repo, 2).merge("r1")
+    assert rules == {"central": ["1.1.1.1", "a.com"], "domestic": []}
@@ -1,4 +1,5 @@
 import io
+import json
 import os
 import pathlib
 
@@ -11,7 +12,15 @@ import pytest
 from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.primitives import serialization
 
-from minerule.shellagent import RemoteCommandError, ShellAgent
+from minerule.shellagent import (
+    MTR_SEPARATOR,
+    PING_SEPARATOR,
+    RemoteCommandError,
+    ShellAgent,
+    parse_mtr,
+    parse_resolve,
+    parse_tcp_connect,
+)
 
 
 class TestShellAgent:
@@ -59,6 +68,59 @@ class TestShellAgent:
         assert result["round_trip_ms_stddev"] == 0.078
 
 
+def test_parse_tcp_connect():
+    result = parse_tcp_connect(
+        "a.com:443 1.2.3.4 1 1500\n"
+        "a.com:443 1.2.3.4 0 0\n"
+        "a.com:443 1.2.3.4 1 2500\n"
+        "b.com:80 - 0 0\n"
+    )
+    assert set(result) == {("a.com", 443)}
+    probe = result[("a.com", 443)]
+    assert probe.destination_ip == "1.2.3.4"
+    assert (probe.attempts, probe.successes) == (3, 2)
+    assert probe.connect_ms_min == 1.5
+    assert probe.connect_ms_avg == 2
+    assert probe.connect_ms_max == 2.5
+
+
+def test_parse_resolve():
+    assert parse_resolve("a.com 1.2.3.4\nb.com \nc.com ::1\n") == {
+        "a.com": "1.2.3.4",
+        "c.com": "::1",
+    }
+
+
+def test_parse_mtr():
+    report = {
+        "report": {
+            "mtr": {"dst": "a.com"},
+            "hubs": [
+                {"count": "1", "host": "10.0.0.1", "Loss%": 0.0, "Snt": 10},
+                {"count": 2, "host": "1.2.3.4", "Loss%": 20.0, "Avg": 31.5},
+            ],
+        }
+    }
+    result = parse_mtr(
+        f"{MTR_SEPARATOR} a.com\n{json.dumps(report)}\n{MTR_SEPARATOR} b.com\n{{}}\n"
+    )
+    assert set(result) == {"a.com"}
+    assert [h.index for h in result["a.com"].hops] == [1, 2]
+    assert result["a.com"].hops[1].avg_ms == 31.5
+    assert result["a.com"].reached
+
+
+def test_ping_many_skips_unparsable_chunks():
+    body = (pathlib.Path(__file__).parent / "ping_stdout").read_text()
+    agent = ShellAgent.__new__(ShellAgent)
+    agent._run = lambda command, cmd_name: (
+        f"{PING_SEPARATOR} a.com\n{body}\n{PING_SEPARATOR} b.com\nPING b.com\n"
+    )
+    result = agent.ping_many(["a.com", "b.com"], 3)
+    assert set(result) == {"a.com"}
+    assert result["a.com"].packets_received == 3
+
+
 class Ed25519:
     def __init__(self) -> None:
         key = ed25519.Ed25519PrivateKey.generate()
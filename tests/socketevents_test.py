@@ -1,4 +1,5 @@
 import pathlib
+from unittest.mock import MagicMock
 import pytest
 from google.cloud.bigquery import (
     Client,
@@ -38,3 +39,26 @@ class TestSocketEventRepository:
         assert repo.find_correlated_hosts("foo1", 1) == {"bar1"}
         assert repo.find_correlated_hosts("bar1", 1) == {"foo1"}
         assert not repo.find_correlated_hosts("foo2", 1)
+
+
+class TestSocketEventRepositoryConcurrency:
+    def test_find_correlated_hosts_many(self):
+        client = MagicMock()
+        client.project = "foo"
+        client.query.side_effect = lambda sql, job_config: [
+            MagicMock(host=job_config.query_parameters[0].value + "_peer")
+        ]
+        repo = SocketEventRepository(client, "bar")
+        result = repo.find_correlated_hosts_many(["h1", "h2", "h3"], 1, 2)
+        assert result == {"h1": {"h1_peer"}, "h2": {"h2_peer"}, "h3": {"h3_peer"}}
+        assert client.query.call_count == 3
+
+    def test_storage_read_api(self):
+        client = MagicMock()
+        client.project = "foo"
+        rows = client.query.return_value.result.return_value
+        rows.total_rows = 10
+        rows.to_arrow.return_value.column.return_value.to_pylist.return_value = ["a"]
+        repo = SocketEventRepository(client, "bar", storage_read_threshold=5)
+        assert repo.find_correlated_hosts("h1") == {"a"}
+        rows.to_arrow.assert_called_once_with(create_bqstorage_client=True)
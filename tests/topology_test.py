@@ -0,0 +1,106 @@
+from decimal import Decimal
+
+import pytest
+
+from minerule.hoststatistics import HostStatistic
+from minerule.shellagent import PingResult, TcpConnectResult
+from minerule.topology import TopologySimulator
+
+
+def ping(received: int, avg: str = None) -> PingResult:
+    return PingResult(
+        "0.0.0.0", 4, received, round_trip_ms_avg=Decimal(avg) if avg else None
+    )
+
+
+@pytest.fixture
+def simulator() -> TopologySimulator:
+    statistics = [
+        HostStatistic(
+            "a.com",
+            Decimal(0),
+            False,
+            central=ping(2, "200"),
+            domestic=ping(4, "20"),
+            other_continents={"ap": ping(4, "50")},
+        ),
+        HostStatistic(
+            "b.com",
+            Decimal(0),
+            False,
+            central=ping(0),
+            domestic=ping(0),
+            other_continents={"ap": ping(4, "80")},
+        ),
+        HostStatistic(
+            "c.com",
+            Decimal(0),
+            False,
+            central=ping(0),
+            domestic=ping(0),
+            tcp_connect={
+                "eu": TcpConnectResult("0.0.0.0", 443, 4, 4, None, Decimal("30"))
+            },
+        ),
+    ]
+    return TopologySimulator(
+        [[s] for s in statistics], {"a.com": 2, "b.com": 1, "c.com": 1}
+    )
+
+
+def test_vantages(simulator: TopologySimulator):
+    assert simulator.vantages == ["central", "domestic", "ap", "eu"]
+    assert len(simulator.candidates()) == 8
+    assert len(simulator.candidates(())) == 16
+
+
+def test_evaluate_topologies(simulator: TopologySimulator):
+    central, full = simulator.evaluate(
+        [["central"], ["central", "domestic", "ap", "eu"]]
+    )
+    assert full.vantages == ["central", "domestic", "ap", "eu"]
+    assert full.coverage == 1.0
+    assert full.routes == {"domestic": 0.5, "ap": 0.25, "eu": 0.25}
+    assert full.expected_latency_ms == pytest.approx((2 * 20 + 80 + 30) / 4)
+    assert central.coverage == 0.5
+    assert central.expected_latency_ms == pytest.approx(200)
+
+
+def test_evaluate_all_subsets(simulator: TopologySimulator):
+    reports = simulator.evaluate()
+    assert reports[0].coverage == 1.0
+    assert reports[0].vantages == ["central", "domestic", "ap", "eu"]
+    by_vantages = {tuple(r.vantages): r for r in reports}
+    without_domestic = by_vantages[("central", "ap", "eu")]
+    assert without_domestic.coverage == 1.0
+    assert without_domestic.routes == {"ap": 0.75, "eu": 0.25}
+    assert without_domestic.to_dict()["vms"] == 3
+    with pytest.raises(ValueError):
+        simulator.evaluate([["na"]])
+
+
+def test_clusters_route_together():
+    statistics = [
+        HostStatistic(
+            "a.com",
+            Decimal(0),
+            False,
+            central=ping(1, "200"),
+            domestic=ping(4, "20"),
+            other_continents={"ap": ping(2, "50")},
+        ),
+        HostStatistic(
+            "cdn.a.com",
+            Decimal(0),
+            False,
+            central=ping(1, "180"),
+            domestic=ping(0),
+            other_continents={"ap": ping(4, "60")},
+        ),
+    ]
+    simulator = TopologySimulator([statistics])
+    full, central = simulator.evaluate([["central", "domestic", "ap"], ["central"]])
+    assert full.routes == {"ap": 1.0}
+    assert full.expected_latency_ms == pytest.approx(55)
+    assert central.routes == {"central": 1.0}
+    assert central.expected_latency_ms == pytest.approx(190)